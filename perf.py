@@ -37,6 +37,17 @@ def args4(a, b, c, d):
     raise NotImplementedError()
 
 
+@dispatch('a', get_key_lookup=get_key_lookup, specialize_threshold=100)
+def specialized_args1(a):
+    raise NotImplementedError()
+
+
+@dispatch('a', 'b', 'c', 'd', get_key_lookup=get_key_lookup,
+          specialize_threshold=100)
+def specialized_args4(a, b, c, d):
+    raise NotImplementedError()
+
+
 class Foo(object):
     pass
 
@@ -65,6 +76,8 @@ args1.register(myargs1, a=Foo)
 args2.register(myargs2, a=Foo, b=Foo)
 args3.register(myargs3, a=Foo, b=Foo, c=Foo)
 args4.register(myargs4, a=Foo, b=Foo, c=Foo, d=Foo)
+specialized_args1.register(myargs1, a=Foo)
+specialized_args4.register(myargs4, a=Foo, b=Foo, c=Foo, d=Foo)
 
 
 def docall0():
@@ -87,6 +100,14 @@ def docall4():
     args4(Foo(), Foo(), Foo(), Foo())
 
 
+def specialized_docall1():
+    specialized_args1(Foo())
+
+
+def specialized_docall4():
+    specialized_args4(Foo(), Foo(), Foo(), Foo())
+
+
 def plain_docall0():
     myargs0()
 
@@ -110,6 +131,14 @@ print(timeit.timeit("docall3()", setup="from __main__ import docall3"))
 print("dispatch 4 args")
 print(timeit.timeit("docall4()", setup="from __main__ import docall4"))
 
+print("specialized dispatch 1 args")
+print(timeit.timeit("specialized_docall1()",
+                    setup="from __main__ import specialized_docall1"))
+
+print("specialized dispatch 4 args")
+print(timeit.timeit("specialized_docall4()",
+                    setup="from __main__ import specialized_docall4"))
+
 print("Plain func 0 args")
 print(timeit.timeit("plain_docall0()",
                     setup="from __main__ import plain_docall0"))
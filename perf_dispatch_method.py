@@ -0,0 +1,119 @@
+import timeit
+
+from reg import dispatch_method, methodify
+from reg import DictCachingKeyLookup
+
+
+def get_key_lookup(r):
+    return DictCachingKeyLookup(r)
+
+
+class Foo(object):
+    pass
+
+
+class App(object):
+    @dispatch_method('a', get_key_lookup=get_key_lookup)
+    def method(self, a):
+        raise NotImplementedError()
+
+    @dispatch_method('a', get_key_lookup=get_key_lookup)
+    def methodified(self, a):
+        raise NotImplementedError()
+
+    @dispatch_method('a', get_key_lookup=get_key_lookup,
+                     specialize_threshold=100)
+    def specialized_wrapper(self, a):
+        raise NotImplementedError()
+
+    @dispatch_method('a', get_key_lookup=get_key_lookup,
+                     specialize_threshold=100)
+    def specialized_methodified(self, a):
+        raise NotImplementedError()
+
+    @dispatch_method('a', get_key_lookup=get_key_lookup, per_class=True)
+    def per_class_methodified(self, a):
+        raise NotImplementedError()
+
+
+def mymethod(app, a):
+    return "method"
+
+
+def myfunc(a):
+    return "func"
+
+
+App.method.register(mymethod, a=Foo)
+App.methodified.register(methodify(myfunc), a=Foo)
+# without its marker, the wrapper is called like any other method
+wrapper = methodify(myfunc)
+del wrapper._methodified
+App.specialized_wrapper.register(wrapper, a=Foo)
+App.specialized_methodified.register(methodify(myfunc), a=Foo)
+App.per_class_methodified.register(methodify(myfunc), a=Foo)
+
+app = App()
+
+
+def docall_method():
+    app.method(Foo())
+
+
+def docall_methodified():
+    app.methodified(Foo())
+
+
+def docall_specialized_wrapper():
+    app.specialized_wrapper(Foo())
+
+
+def docall_specialized_methodified():
+    app.specialized_methodified(Foo())
+
+
+def docall_per_class_methodified():
+    app.per_class_methodified(Foo())
+
+
+def plain_docall():
+    myfunc(Foo())
+
+
+print("dispatch method")
+print(timeit.timeit("docall_method()",
+                    setup="from __main__ import docall_method"))
+
+print("dispatch method, methodified")
+print(timeit.timeit("docall_methodified()",
+                    setup="from __main__ import docall_methodified"))
+
+
+def best_time(name):
+    """The time of 1000000 calls, from the best of many short runs.
+
+    This keeps noise out of the comparison of close timings.
+    """
+    return 5 * min(timeit.repeat(
+        name + "()", setup="from __main__ import " + name,
+        repeat=15, number=200000))
+
+
+print("specialized dispatch method, through the methodify wrapper")
+wrapper_time = best_time("docall_specialized_wrapper")
+print(wrapper_time)
+
+print("specialized dispatch method, methodified")
+methodified_time = best_time("docall_specialized_methodified")
+print(methodified_time)
+print("gain over the wrapper: {0:.0%}".format(
+    1 - methodified_time / wrapper_time))
+
+print("per class dispatch method, methodified")
+print(timeit.timeit(
+    "docall_per_class_methodified()",
+    setup="from __main__ import docall_per_class_methodified"))
+
+print("Plain func")
+print(timeit.timeit("plain_docall()",
+                    setup="from __main__ import plain_docall"))
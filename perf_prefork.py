@@ -0,0 +1,94 @@
+import gc
+import os
+import sys
+
+import reg
+from reg import dispatch, DictCachingKeyLookup
+
+
+WORKERS = 16
+
+
+def make_classes(count):
+    bases = [type('Base%d' % i, (object,), {}) for i in range(count)]
+    return bases + [type('Sub%d' % i, (base,), {}) for i, base in
+                    enumerate(bases)]
+
+
+def make_impl(value):
+    return lambda obj, other: value
+
+
+def make_dispatches(count, classes):
+    dispatches = []
+    for i in range(count):
+        @dispatch('obj', 'other', get_key_lookup=DictCachingKeyLookup)
+        def func(obj, other):
+            return None
+        for j, cls in enumerate(classes[:len(classes) // 2]):
+            func.register(make_impl(j), obj=cls, other=cls)
+        dispatches.append(func)
+    return dispatches
+
+
+def memory():
+    """Private and shared memory of this process in kB."""
+    private = shared = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            field, value = line.split()[:2]
+            if field.startswith('Private_'):
+                private += int(value)
+            elif field.startswith('Shared_'):
+                shared += int(value)
+    return private, shared
+
+
+def work(dispatches, classes):
+    instances = [cls() for cls in classes]
+    for func in dispatches:
+        for obj in instances:
+            for other in instances:
+                func(obj, other)
+    gc.collect()
+
+
+def bench(preforked):
+    classes = make_classes(20)
+    dispatches = make_dispatches(200, classes)
+    # the parent serves requests before forking too
+    work(dispatches, classes)
+    if preforked:
+        reg.prefork(classes)
+    children = []
+    for i in range(WORKERS):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            work(dispatches, classes)
+            os.write(write, ('%d %d' % memory()).encode())
+            os._exit(0)
+        os.close(write)
+        children.append((pid, read))
+    private = shared = 0
+    for pid, read in children:
+        with os.fdopen(read) as f:
+            p, s = f.read().split()
+        os.waitpid(pid, 0)
+        private += int(p)
+        shared += int(s)
+    return private // WORKERS, shared // WORKERS
+
+
+def main():
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        sys.exit("This needs /proc/self/smaps_rollup (Linux 4.14 or later)")
+    preforked = sys.argv[1:] == ['prefork']
+    private, shared = bench(preforked)
+    print("%s: private %d kB, shared %d kB per worker" % (
+        "prefork" if preforked else "no prefork", private, shared))
+
+
+if __name__ == '__main__':
+    main()
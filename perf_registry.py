@@ -0,0 +1,86 @@
+import timeit
+
+from reg.predicate import PredicateRegistry, match_instance
+
+
+# Three levels of classes for each of the four predicates, so that a
+# lookup with leaf classes has to search 3 ** 4 permutations.
+def make_classes(prefix, count):
+    bases = [type('%sBase%d' % (prefix, i), (object,), {})
+             for i in range(count)]
+    subs = [type('%sSub%d' % (prefix, i), (base,), {}) for i, base in
+            enumerate(bases)]
+    leaves = [type('%sLeaf%d' % (prefix, i), (sub,), {}) for i, sub in
+              enumerate(subs)]
+    return bases, leaves
+
+
+def make_registry(registrations, max_bitmask_values):
+    PredicateRegistry.max_bitmask_values = max_bitmask_values
+    r = PredicateRegistry(match_instance('a'), match_instance('b'),
+                          match_instance('c'), match_instance('d'))
+    # 18 ** 4 > 100000 distinct keys
+    a, a_leaves = make_classes('A', 18)
+    b, b_leaves = make_classes('B', 18)
+    c, c_leaves = make_classes('C', 18)
+    d, d_leaves = make_classes('D', 18)
+    keys = []
+    for i in range(registrations):
+        w, x, y, z = (i % 18, i // 18 % 18, i // 18 ** 2 % 18,
+                      i // 18 ** 3 % 18)
+        r.register((a[w], b[x], c[y], d[z]), 'value %d' % i)
+        keys.append((a_leaves[w], b_leaves[x], c_leaves[y], d_leaves[z]))
+    return r, keys
+
+
+def bench(registrations, max_bitmask_values):
+    r, keys = make_registry(registrations, max_bitmask_values)
+    keys = keys[:10]
+    number = 200
+
+    def lookup():
+        for key in keys:
+            r.component(key)
+    return min(timeit.repeat(lookup, number=number, repeat=5)
+               ) / number / len(keys)
+
+
+print("\nUncached 4 predicate lookups (miss path), per lookup")
+print("=====================================================")
+for registrations in [10, 1000, 100000]:
+    print("%d registrations" % registrations)
+    print("  bitmasks: {0:.2f}us".format(
+        bench(registrations, 1000000) * 1e6))
+    print("  sets:     {0:.2f}us".format(bench(registrations, 0) * 1e6))
+
+
+def make_sparse_registry(max_bitmask_values):
+    # Deep hierarchies where every class is registered, but only in
+    # combination with object for all the other predicates.
+    PredicateRegistry.max_bitmask_values = max_bitmask_values
+    r = PredicateRegistry(match_instance('a'), match_instance('b'),
+                          match_instance('c'), match_instance('d'))
+    key = []
+    for d in range(4):
+        classes = [object]
+        for i in range(6):
+            classes.append(type('Level%d' % i, (classes[-1],), {}))
+            registration = [object] * 4
+            registration[d] = classes[-1]
+            r.register(tuple(registration), 'value %d %d' % (d, i))
+        key.append(type('Leaf', (classes[-1],), {}))
+    r.register((object,) * 4, 'default')
+    return r, tuple(key)
+
+
+def bench_sparse(max_bitmask_values):
+    r, key = make_sparse_registry(max_bitmask_values)
+    number = 200
+    return min(timeit.repeat(lambda: list(r.all(key)), number=number,
+                             repeat=5)) / number
+
+
+print("\nUncached 4 predicate lookups of all matches, deep hierarchies")
+print("=============================================================")
+print("  bitmasks: {0:.2f}us".format(bench_sparse(1000000) * 1e6))
+print("  sets:     {0:.2f}us".format(bench_sparse(0) * 1e6))
@@ -1,9 +1,14 @@
 # flake8: noqa
-from .dispatch import dispatch, Dispatch, LookupEntry
+from .dispatch import (dispatch, Dispatch, LookupEntry, warm_dispatches,
+                       prefork)
 from .context import (dispatch_method, DispatchMethod,
-                      methodify, clean_dispatch_methods)
-from .arginfo import arginfo
+                      methodify, clean_dispatch_methods,
+                      freeze_dispatch_methods)
+from .arginfo import arginfo, ArgInfo
 from .error import RegistrationError
 from .predicate import (Predicate, KeyIndex, ClassIndex,
                         match_key, match_instance, match_class)
-from .cache import DictCachingKeyLookup, LruCachingKeyLookup
+from .cache import (DictCachingKeyLookup, LruCachingKeyLookup,
+                    WeakCachingKeyLookup, CacheInfo, SharedCache,
+                    SharedCachingKeyLookup)
+from .snapshot import write_snapshot, load_snapshot
@@ -1,84 +1,235 @@
 from __future__ import unicode_literals
 import inspect
+from collections import namedtuple
+from functools import partial
+
+
+class ArgInfo(namedtuple('ArgInfo', [
+        'args', 'varargs', 'keywords', 'defaults',
+        'kwonlyargs', 'kwonlydefaults', 'posonlyargs'])):
+    """Information about the arguments of a callable.
+
+    The first four items are those of :class:`inspect.ArgSpec`.
+
+    * ``args``: the names of the positional arguments, including the
+      positional-only ones.
+
+    * ``varargs``: the name of the ``*`` argument, or ``None``.
+
+    * ``keywords``: the name of the ``**`` argument, or ``None``.
+
+    * ``defaults``: the defaults of the last positional arguments, or
+      ``None``.
+
+    * ``kwonlyargs``: the names of the keyword-only arguments.
+
+    * ``kwonlydefaults``: a dict with the defaults of the keyword-only
+      arguments, or ``None``.
+
+    * ``posonlyargs``: the names of the positional-only arguments,
+      which come first in ``args``.
+    """
+
+    __slots__ = ()
 
 
 def arginfo(callable):
     """Get information about the arguments of a callable.
 
-    Returns a :class:`inspect.ArgSpec` object as for
-    :func:`inspect.getargspec`.
+    Returns a :class:`reg.ArgInfo` object, which has the items of an
+    :class:`inspect.ArgSpec` object as for :func:`inspect.getargspec`,
+    and describes keyword-only and positional-only arguments too.
 
-    :func:`inspect.getargspec` returns information about the arguments
-    of a function. arginfo also works for classes and instances with a
-    __call__ defined. Unlike getargspec, arginfo treats bound methods
-    like functions, so that the self argument is not reported.
+    arginfo also works for classes, instances with a __call__ defined
+    and :func:`functools.partial` objects. Unlike getargspec, arginfo
+    treats bound methods like functions, so that the self argument is
+    not reported. It inspects the code object of Python functions,
+    and falls back on :func:`inspect.signature` for other callables,
+    such as builtins.
 
     arginfo returns ``None`` if given something that is not callable.
 
-    arginfo caches previous calls (except for instances with a
-    __call__), making calling it repeatedly cheap.
+    arginfo caches what it finds out about a code object, making
+    calling it repeatedly cheap, also for other functions, bound
+    methods and partials with the same code.
 
     This was originally inspired by the pytest.core varnames() function,
     but has been completely rewritten to handle class constructors,
     also show other getarginfo() information, and for readability.
     """
+    if inspect.isfunction(callable):
+        return function_arginfo(callable)
+    if inspect.ismethod(callable):
+        return remove_first(arginfo(callable.__func__))
+    if isinstance(callable, partial):
+        return partial_arginfo(arginfo(callable.func), callable.args,
+                               callable.keywords or {})
+    if inspect.isclass(callable):
+        # in Python 2, __init__ is an unbound method
+        init = get_class_init(callable)
+        init = getattr(init, '__func__', init)
+        if inspect.isfunction(init):
+            return remove_first(function_arginfo(init))
+        return remove_first(signature_arginfo(init))
     try:
-        return arginfo._cache[callable]
-    except KeyError:
-        # Try to get __call__ function from the cache.
-        try:
-            return arginfo._cache[callable.__call__]
-        except (AttributeError, KeyError):
-            pass
-    func, cache_key, remove_self = get_callable_info(callable)
-    if func is None:
+        call = callable.__call__
+    except AttributeError:
         return None
-    result = inspect.getargspec(func)
-    if remove_self:
-        args = result.args[1:]
-        result = inspect.ArgSpec(args, result.varargs, result.keywords,
-                                 result.defaults)
-    arginfo._cache[cache_key] = result
-    return result
+    if inspect.ismethod(call):
+        return arginfo(call)
+    return signature_arginfo(callable)
 
 
 def is_cached(callable):
-    if callable in arginfo._cache:
-        return True
-    return callable.__call__ in arginfo._cache
+    code = get_code(callable)
+    return code is not None and code in arginfo._cache
 
 
 arginfo._cache = {}
 arginfo.is_cached = is_cached
 
 
-def get_callable_info(callable):
-    """Get information about a callable.
+def get_code(callable):
+    """Get the code object arginfo inspects for a callable.
+
+    Returns ``None`` if there is none.
+    """
+    if inspect.isfunction(callable):
+        return callable.__code__
+    if inspect.ismethod(callable):
+        return get_code(callable.__func__)
+    if isinstance(callable, partial):
+        return get_code(callable.func)
+    if inspect.isclass(callable):
+        init = get_class_init(callable)
+        return get_code(getattr(init, '__func__', init))
+    call = getattr(callable, '__call__', None)
+    if inspect.ismethod(call):
+        return get_code(call)
+    return None
+
+
+def function_arginfo(func):
+    """Get information about the arguments of a Python function.
+
+    What the code object tells is cached. The defaults come from the
+    function, as functions with the same code can have different
+    defaults.
+    """
+    code = func.__code__
+    try:
+        names = arginfo._cache[code]
+    except KeyError:
+        names = arginfo._cache[code] = code_arginfo(code)
+    posonlyargs, args, varargs, keywords, kwonlyargs = names
+    return ArgInfo(list(args), varargs, keywords, func.__defaults__,
+                   list(kwonlyargs), getattr(func, '__kwdefaults__', None),
+                   list(posonlyargs))
 
-    Returns a tuple of:
 
-    * actual function/method that can be inspected with inspect.getargspec.
+def code_arginfo(code):
+    """Get the names of the arguments of a code object.
 
-    * cache key to use to cache results.
+    Returns a tuple of the positional-only arguments, the positional
+    arguments, the name of the ``*`` argument or ``None``, the name of
+    the ``**`` argument or ``None``, and the keyword-only arguments.
+    """
+    names = code.co_varnames
+    argcount = code.co_argcount
+    kwonlyargcount = getattr(code, 'co_kwonlyargcount', 0)
+    args = names[:argcount]
+    posonlyargs = args[:getattr(code, 'co_posonlyargcount', 0)]
+    kwonlyargs = names[argcount:argcount + kwonlyargcount]
+    i = argcount + kwonlyargcount
+    varargs = keywords = None
+    if code.co_flags & inspect.CO_VARARGS:
+        varargs = names[i]
+        i += 1
+    if code.co_flags & inspect.CO_VARKEYWORDS:
+        keywords = names[i]
+    return posonlyargs, args, varargs, keywords, kwonlyargs
 
-    * whether to remove self or not.
 
-    Note that in Python 3, __init__ is not a method, but we still
-    want to remove self from it.
+def signature_arginfo(callable):
+    """Get information about the arguments of a callable without code.
 
-    If not inspectable (None, None, False) is returned.
+    This uses :func:`inspect.signature`. The results are not cached.
     """
-    if inspect.isfunction(callable):
-        return callable, callable, False
-    if inspect.ismethod(callable):
-        return callable, callable, True
-    if inspect.isclass(callable):
-        return get_class_init(callable), callable, True
+    if not hasattr(inspect, 'signature'):  # pragma: no cover
+        # Python 2 has no inspect.signature.
+        return ArgInfo(*(tuple(inspect.getargspec(callable)) +
+                         ([], None, [])))
     try:
-        callable = getattr(callable, '__call__')
-        return callable, callable, True
-    except AttributeError:
-        return None, None, False
+        signature = inspect.signature(callable)
+    except ValueError as e:
+        raise TypeError(str(e))
+    args = []
+    posonlyargs = []
+    defaults = []
+    kwonlyargs = []
+    kwonlydefaults = {}
+    varargs = keywords = None
+    for parameter in signature.parameters.values():
+        kind = parameter.kind
+        if kind == parameter.VAR_POSITIONAL:
+            varargs = parameter.name
+        elif kind == parameter.VAR_KEYWORD:
+            keywords = parameter.name
+        elif kind == parameter.KEYWORD_ONLY:
+            kwonlyargs.append(parameter.name)
+            if parameter.default is not parameter.empty:
+                kwonlydefaults[parameter.name] = parameter.default
+        else:
+            args.append(parameter.name)
+            if kind == parameter.POSITIONAL_ONLY:
+                posonlyargs.append(parameter.name)
+            if parameter.default is not parameter.empty:
+                defaults.append(parameter.default)
+    return ArgInfo(args, varargs, keywords, tuple(defaults) or None,
+                   kwonlyargs, kwonlydefaults or None, posonlyargs)
+
+
+def remove_first(info):
+    """Remove the first positional argument, such as self."""
+    return info._replace(args=info.args[1:],
+                         posonlyargs=info.posonlyargs[1:])
+
+
+def partial_arginfo(info, args, keywords):
+    """Get information about the arguments of a partial.
+
+    As for :func:`inspect.signature`, the positional arguments the
+    partial passes are removed, and a positional argument it passes by
+    keyword becomes keyword-only, together with those after it.
+
+    :param info: the :class:`ArgInfo` of the function of the partial.
+    :param args: the positional arguments of the partial.
+    :param keywords: the keyword arguments of the partial.
+    """
+    names = info.args[len(args):]
+    posonlyargs = info.posonlyargs[len(args):]
+    defaults = info.defaults or ()
+    defaults = dict(zip(info.args[len(info.args) - len(defaults):],
+                        defaults))
+    varargs = info.varargs
+    kwonlyargs = list(info.kwonlyargs)
+    kwonlydefaults = dict(info.kwonlydefaults or {})
+    for i in range(len(posonlyargs), len(names)):
+        if names[i] in keywords:
+            kwonlyargs[:0] = names[i:]
+            kwonlydefaults.update(
+                (name, defaults[name]) for name in names[i:]
+                if name in defaults)
+            names = names[:i]
+            varargs = None
+            break
+    kwonlydefaults.update(
+        (name, value) for name, value in keywords.items()
+        if name in kwonlyargs)
+    return ArgInfo(names, varargs, info.keywords,
+                   tuple(defaults[name] for name in names
+                         if name in defaults) or None,
+                   kwonlyargs, kwonlydefaults or None, posonlyargs)
 
 
 def fake_empty_init():
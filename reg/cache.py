@@ -1,16 +1,235 @@
-from repoze.lru import lru_cache
+from collections import namedtuple
+from itertools import count
+from weakref import ref
+from repoze.lru import lru_cache, LRUCache
+from .compat import timer
+from .eviction import SegmentedLRUCache
+
+
+class CacheInfo(
+        namedtuple('CacheInfo', 'hits misses size evictions miss_time')):
+    """Statistics of a cache.
+
+    :param hits: the number of lookups that found an entry, or ``None``
+      if the cache doesn't count them.
+    :param misses: the number of lookups that had to compute an entry.
+    :param size: the number of entries.
+    :param evictions: the number of entries dropped to make room for
+      others, or because a class in their key was garbage collected.
+      Entries dropped because registrations changed don't count.
+    :param miss_time: the time spent computing entries, in seconds.
+    """
+
+    __slots__ = ()
 
 
 class Cache(dict):
-    """A dict to cache a function."""
+    """A dict to cache a function.
+
+    It counts the misses and the time spent in the function. Lookups
+    are only counted by the functions returned by :func:`counting`,
+    so as to keep hits as cheap as a dictionary lookup.
+    """
+
+    lookups = None
+    evictions = 0
 
     def __init__(self, func):
         self.func = func
+        self.misses = 0
+        self.miss_time = 0.0
 
     def __missing__(self, key):
+        start = timer()
         self[key] = result = self.func(key)
+        self.misses += 1
+        self.miss_time += timer() - start
         return result
 
+    def info(self):
+        """The statistics of the cache, as a :class:`reg.CacheInfo`."""
+        return CacheInfo(
+            None if self.lookups is None else self.lookups - self.misses,
+            self.misses, len(self), self.evictions, self.miss_time)
+
+    def prune(self, condition):
+        """Remove the entries for the keys that satisfy a condition."""
+        for key in [key for key in self if condition(key)]:
+            del self[key]
+
+
+class WeakKey(ref):
+    """A weak reference to a class in the key of a :class:`WeakCache`.
+
+    It compares equal to the class it refers to, so that the cache can
+    be looked up with keys that contain the classes themselves.
+    """
+
+    __slots__ = ()
+
+    __hash__ = ref.__hash__
+
+    def __eq__(self, other):
+        return self() is other
+
+    def __ne__(self, other):
+        return self() is not other
+
+
+class WeakCache(Cache):
+    """A dict to cache a function of keys that contain classes.
+
+    The entries don't keep the classes in their key alive: an entry is
+    removed as soon as any of them is garbage collected.
+    """
+
+    def __init__(self, func):
+        super(WeakCache, self).__init__(func)
+        # map the ids of the weak references to the keys they are in
+        self.weak_keys = {}
+        self_ref = ref(self)
+
+        def remove(weak_ref):
+            self = self_ref()
+            if self is not None and id(weak_ref) in self.weak_keys:
+                self.discard(self.weak_keys[id(weak_ref)])
+                self.evictions += 1
+
+        self.remove = remove
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            key = tuple([WeakKey(item, self.remove)
+                         if isinstance(item, type) else item
+                         for item in key])
+            for item in key:
+                if isinstance(item, WeakKey):
+                    self.weak_keys[id(item)] = key
+        super(WeakCache, self).__setitem__(key, value)
+
+    def discard(self, weak_key):
+        """Remove an entry, given its key as stored in the cache."""
+        for item in weak_key:
+            if isinstance(item, WeakKey):
+                self.weak_keys.pop(id(item), None)
+        self.pop(weak_key, None)
+
+    def prune(self, condition):
+        """Remove the entries for the keys that satisfy a condition."""
+        # garbage collection can remove entries while we go
+        for weak_key in list(self):
+            key = tuple([item() if isinstance(item, WeakKey) else item
+                         for item in weak_key])
+            dead = any(isinstance(item, WeakKey) and item() is None
+                       for item in weak_key)
+            if not dead and condition(key):
+                self.discard(weak_key)
+
+
+_marker = object()
+
+
+class FrozenCache(dict):
+    """A dict of entries computed in advance, which is never written to.
+
+    The entries for other keys are computed by a function, which can
+    cache them elsewhere.
+
+    :param entries: the entries, as for :class:`dict`.
+    :param func: the function to compute the entries for other keys.
+    """
+
+    def __init__(self, entries, func):
+        super(FrozenCache, self).__init__(entries)
+        self.func = func
+
+    def __missing__(self, key):
+        return self.func(key)
+
+
+class HotCache(Cache):
+    """An unbounded cache in front of a bounded cache.
+
+    Entries that are found in the bounded cache are moved here, as long
+    as there are fewer than ``size`` of them. Entries are never evicted
+    from here, so looking up a hot key is as fast as with
+    :class:`Cache`.
+
+    :param func: the function to cache.
+    :param cache: the bounded cache, such as a
+      :class:`repoze.lru.LRUCache`. It is filled with keys that are
+      tuples of the arguments of ``func``, like
+      :class:`repoze.lru.lru_cache` does.
+    :param size: the maximum number of hot entries.
+    """
+
+    def __init__(self, func, cache, size):
+        super(HotCache, self).__init__(func)
+        self.cache = cache
+        self.size = size
+
+    def __missing__(self, key):
+        args = (key,)
+        result = self.cache.get(args, _marker)
+        if result is _marker:
+            result = self.func(key)
+            self.cache.put(args, result)
+        elif len(self) < self.size:
+            # this is the second time the key is used
+            self[key] = result
+            self.cache.invalidate(args)
+        return result
+
+
+def counting(cache):
+    """Construct a function that looks up a cache, counting lookups.
+
+    :param cache: a :class:`Cache`.
+    :returns: a function that takes a key and returns its entry.
+    """
+    cache.lookups = 0
+    getitem = cache.__getitem__
+
+    def lookup(key):
+        cache.lookups += 1
+        return getitem(key)
+
+    return lookup
+
+
+def timed(cache, func):
+    """Wrap a function to add the time it takes to ``cache.miss_time``.
+
+    :param cache: the cache that ``func`` computes the entries of.
+    :param func: the function to wrap.
+    :returns: the wrapped function.
+    """
+    cache.miss_time = 0.0
+
+    def timed_func(key):
+        start = timer()
+        try:
+            return func(key)
+        finally:
+            cache.miss_time += timer() - start
+
+    return timed_func
+
+
+def lru_cache_info(cache, hot=None):
+    """The statistics of a :class:`repoze.lru.LRUCache`.
+
+    :param cache: the cache, with its function wrapped by :func:`timed`.
+    :param hot: the :class:`HotCache` in front of it, if any. Its hits
+      aren't counted.
+    :returns: a :class:`reg.CacheInfo`.
+    """
+    if hot is None:
+        return CacheInfo(cache.hits, cache.misses, len(cache.data),
+                         cache.evictions, cache.miss_time)
+    return CacheInfo(None, cache.misses, len(cache.data) + len(hot),
+                     cache.evictions, cache.miss_time)
+
 
 class DictCachingKeyLookup(object):
     """A key lookup that caches.
@@ -24,14 +243,107 @@ class DictCachingKeyLookup(object):
     predicate keys. If so, you can use
     :class:`reg.LruCachingKeyLookup` instead.
 
+    The cache subscribes to changes of registrations in the
+    :class:`PredicateRegistry`, and drops the entries they affect.
+
     :param: key_lookup - the :class:`PredicateRegistry` to cache.
+    :param count_hits: if true, count the cache hits, so that they are
+      reported by :meth:`cache_info`. This makes them slower.
 
     """
-    def __init__(self, key_lookup):
+    cache_class = Cache
+    """The class of the caches, which is given the function to cache."""
+
+    def __init__(self, key_lookup, count_hits=False):
         self.key_lookup = key_lookup
-        self.component = Cache(key_lookup.component).__getitem__
-        self.fallback = Cache(key_lookup.fallback).__getitem__
-        self.all = Cache(lambda key: list(key_lookup.all(key))).__getitem__
+        self.count_hits = count_hits
+        cache_class = self.cache_class
+        # a miss in either the component or fallback cache fills both
+        components = cache_class(lambda key: resolve(key)[0])
+        fallbacks = cache_class(lambda key: resolve(key)[1])
+
+        def resolve(key):
+            component, fallback = key_lookup.resolve(key)
+            components[key] = component
+            fallbacks[key] = fallback
+            return component, fallback
+
+        all_matches = cache_class(lambda key: list(key_lookup.all(key)))
+        self.component_cache = components
+        self.fallback_cache = fallbacks
+        self.all_cache = all_matches
+        self.target_cache = None
+        self.caches = [components, fallbacks, all_matches]
+        self.component = self._lookup(components)
+        self.fallback = self._lookup(fallbacks)
+        self.all = self._lookup(all_matches)
+        key_lookup.subscribe(self.invalidate)
+
+    def _lookup(self, cache):
+        return counting(cache) if self.count_hits else cache.__getitem__
+
+    def target_lookup(self, default):
+        """Construct a function to look up targets of dispatch calls.
+
+        The targets are stored in a single cache, independent from the
+        ones of :meth:`component` and :meth:`fallback`, so that a
+        dispatch call only costs one dictionary lookup.
+
+        :param default: the default callable, see
+          :meth:`reg.predicate.PredicateRegistry.target`.
+        :returns: a function that takes a key and returns the callable
+          to dispatch to.
+        """
+        key_lookup = self.key_lookup
+        targets = self.cache_class(
+            lambda key: key_lookup.target(key, default))
+        self.target_cache = targets
+        self.caches.append(targets)
+        return self._lookup(targets)
+
+    def cache_info(self, cache='target'):
+        """Statistics of a cache.
+
+        :param cache: ``'target'`` for the cache used by dispatch
+          calls, or ``'component'``, ``'fallback'`` or ``'all'`` for
+          the cache of the method with that name.
+        :returns: a :class:`reg.CacheInfo`.
+        """
+        return getattr(self, cache + '_cache').info()
+
+    def invalidate(self, changed):
+        """Drop the cache entries a change of registration can affect.
+
+        :param changed: the key that was registered or unregistered.
+        """
+        is_affected = self.key_lookup.is_affected
+        for cache in self.caches:
+            cache.prune(lambda key: is_affected(key, changed))
+
+
+class WeakCachingKeyLookup(DictCachingKeyLookup):
+    """A key lookup that caches without keeping classes alive.
+
+    Like :class:`reg.DictCachingKeyLookup`, but the cache entries are
+    removed as soon as a class in their key is garbage collected,
+    instead of keeping the class alive. Use this if the dispatch
+    function is called with classes created on the fly, so that the
+    cache doesn't grow without bounds while still keeping all entries
+    that are in use.
+
+    Cache hits are a bit slower than with
+    :class:`reg.DictCachingKeyLookup`, as the classes in the key are
+    compared with weak references to them.
+
+    :param: key_lookup - the :class:`PredicateRegistry` to cache.
+    :param count_hits: if true, count the cache hits, so that they are
+      reported by :meth:`cache_info`. This makes them slower.
+    """
+    cache_class = WeakCache
+
+    def __len__(self):
+        """The number of live cache entries."""
+        return sum(len(cache) for cache in self.caches)
 
 
 class LruCachingKeyLookup(object):
@@ -44,19 +356,292 @@ class LruCachingKeyLookup(object):
     memory. This is only useful if you except the access pattern to
     your function to involve a huge range of different predicate keys.
 
+    If bursts of keys that are used only once would evict the keys
+    that are used all the time, you can use one of the caches in
+    :mod:`reg.eviction` instead. You can also keep the keys that are
+    used more than once in a small unbounded cache in front of the
+    bounded one, which makes hits on them as fast as with
+    :class:`reg.DictCachingKeyLookup`.
+
+    Like :class:`reg.DictCachingKeyLookup`, the cache drops the
+    entries that changes of registrations affect.
+
     :param: key_lookup - the :class:`PredicateRegistry` to cache.
     :param component_cache_size: how many cache entries to store for
-      the :meth:`component` method. This is also used by dispatch
-      calls.
+      the :meth:`component` method. Dispatch calls use a separate cache
+      of the same size.
     :param all_cache_size: how many cache entries to store for the
       the :meth:`all` method.
     :param fallback_cache_size: how many cache entries to store for
       the :meth:`fallback` method.
+    :param cache_class: the class of the bounded caches, which is given
+      their size. By default this is :class:`repoze.lru.LRUCache`.
+    :param hot_size: if given, how many entries to store for each
+      cache in an unbounded cache in front of the bounded one.
     """
     def __init__(self, key_lookup, component_cache_size, all_cache_size,
-                 fallback_cache_size):
+                 fallback_cache_size, cache_class=LRUCache, hot_size=None):
         self.key_lookup = key_lookup
-        self.component = lru_cache(component_cache_size)(key_lookup.component)
-        self.fallback = lru_cache(fallback_cache_size)(key_lookup.fallback)
-        self.all = lru_cache(all_cache_size)(
-            lambda key: list(key_lookup.all(key)))
+        self.cache_class = cache_class
+        self.hot_size = hot_size
+        self.hot_caches = {}
+        # a miss in either the component or fallback cache fills both
+        components = cache_class(component_cache_size)
+        fallbacks = cache_class(fallback_cache_size)
+
+        def resolve(key):
+            component, fallback = key_lookup.resolve(key)
+            # lru_cache uses the tuple of arguments as the key
+            components.put((key,), component)
+            fallbacks.put((key,), fallback)
+            return component, fallback
+
+        all_matches = cache_class(all_cache_size)
+        self.component_cache = components
+        self.fallback_cache = fallbacks
+        self.all_cache = all_matches
+        self.target_cache = None
+        self.caches = [components, fallbacks, all_matches]
+        self.component = self._lookup(
+            components, lambda key: resolve(key)[0])
+        self.fallback = self._lookup(
+            fallbacks, lambda key: resolve(key)[1])
+        self.all = self._lookup(
+            all_matches, lambda key: list(key_lookup.all(key)))
+        self.component_cache_size = component_cache_size
+        key_lookup.subscribe(self.invalidate)
+
+    def _lookup(self, cache, func):
+        func = timed(cache, func)
+        if self.hot_size is None:
+            return lru_cache(None, cache)(func)
+        hot = self.hot_caches[cache] = HotCache(
+            func, cache, self.hot_size)
+        return hot.__getitem__
+
+    def target_lookup(self, default):
+        """Construct a function to look up targets of dispatch calls.
+
+        The targets are stored in a single cache, independent from the
+        ones of :meth:`component` and :meth:`fallback`, so that a
+        dispatch call only costs one cache lookup. Its size is
+        ``component_cache_size``.
+
+        :param default: the default callable, see
+          :meth:`reg.predicate.PredicateRegistry.target`.
+        :returns: a function that takes a key and returns the callable
+          to dispatch to.
+        """
+        key_lookup = self.key_lookup
+        targets = self.cache_class(self.component_cache_size)
+        self.target_cache = targets
+        self.caches.append(targets)
+        return self._lookup(
+            targets, lambda key: key_lookup.target(key, default))
+
+    def cache_info(self, cache='target'):
+        """Statistics of a cache.
+
+        :param cache: ``'target'`` for the cache used by dispatch
+          calls, or ``'component'``, ``'fallback'`` or ``'all'`` for
+          the cache of the method with that name.
+        :returns: a :class:`reg.CacheInfo`.
+        """
+        cache = getattr(self, cache + '_cache')
+        return lru_cache_info(cache, self.hot_caches.get(cache))
+
+    def invalidate(self, changed):
+        """Drop the cache entries a change of registration can affect.
+
+        :param changed: the key that was registered or unregistered.
+        """
+        is_affected = self.key_lookup.is_affected
+        for cache in self.caches:
+            # lru_cache uses the tuple of arguments as the key
+            for args in [args for args in cache.data
+                         if is_affected(args[0], changed)]:
+                cache.invalidate(args)
+        for hot in self.hot_caches.values():
+            hot.prune(lambda key: is_affected(key, changed))
+
+
+class Partition(object):
+    """The part of a shared cache that one cache of a key lookup uses.
+
+    It has the interface of :class:`repoze.lru.LRUCache`, and stores
+    its entries in the shared cache under keys that start with a
+    prefix.
+
+    :param cache: the shared cache.
+    :param prefix: the prefix of the keys of this partition.
+    """
+
+    def __init__(self, cache, prefix):
+        self.cache = cache
+        self.prefix = prefix
+        # the keys this partition put in the shared cache; the shared
+        # cache evicts without telling us, so some may be gone.
+        self.keys = set()
+        self.hits = 0
+        self.misses = 0
+        self.added = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        value = self.cache.get((self.prefix, key), _marker)
+        if value is _marker:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, val):
+        cache_key = (self.prefix, key)
+        new = cache_key not in self.cache.data
+        self.cache.put(cache_key, val)
+        if cache_key in self.cache.data:
+            self.keys.add(key)
+            if new:
+                self.added += 1
+        if len(self.keys) > 2 * self.cache.size:
+            self.prune()
+
+    def invalidate(self, key):
+        cache_key = (self.prefix, key)
+        self.keys.discard(key)
+        if cache_key in self.cache.data:
+            self.cache.invalidate(cache_key)
+            self.invalidations += 1
+
+    def prune(self):
+        """Forget the keys the shared cache evicted."""
+        prefix = self.prefix
+        data = self.cache.data
+        self.keys = set(key for key in list(self.keys)
+                        if (prefix, key) in data)
+
+    @property
+    def data(self):
+        """The entries of this partition."""
+        prefix = self.prefix
+        data = self.cache.data
+        result = {}
+        for key in list(self.keys):
+            value = data.get((prefix, key), _marker)
+            if value is _marker:
+                self.keys.discard(key)
+            else:
+                result[key] = value
+        return result
+
+    @property
+    def evictions(self):
+        """The number of entries the shared cache evicted."""
+        return self.added - self.invalidations - len(self.data)
+
+
+class SharedCache(object):
+    """A cache shared by the key lookups of many dispatch functions.
+
+    All the caches of these key lookups take their entries from a
+    single bounded cache, so the number of entries of all dispatch
+    functions together is bounded, and the dispatch functions that
+    are used the most get the most entries. Pass :meth:`key_lookup`
+    as ``get_key_lookup`` to :func:`reg.dispatch` or
+    :func:`reg.dispatch_method` to use it::
+
+      shared_cache = SharedCache(10000)
+
+      @reg.dispatch('obj', get_key_lookup=shared_cache.key_lookup)
+      def view(obj):
+          ...
+
+    :param size: the maximum number of entries.
+    :param cache_class: the class of the bounded cache, which is given
+      its size. By default this is
+      :class:`reg.eviction.SegmentedLRUCache`, which evicts based on
+      both the recency and the frequency of use.
+    """
+
+    def __init__(self, size, cache_class=SegmentedLRUCache):
+        self.size = size
+        self.cache = cache_class(size)
+        self.namespaces = count()
+        # the key lookups by namespace, weakly so that we can drop the
+        # entries of those that are no longer in use.
+        self.key_lookups = {}
+
+    def key_lookup(self, registry):
+        """Construct a key lookup that uses this cache.
+
+        :param registry: the :class:`reg.predicate.PredicateRegistry`
+          to cache.
+        :returns: a :class:`SharedCachingKeyLookup`.
+        """
+        namespace = next(self.namespaces)
+        key_lookup = SharedCachingKeyLookup(registry, self, namespace)
+        self_ref = ref(self)
+
+        def remove(key_lookup_ref):
+            self = self_ref()
+            if self is not None:
+                del self.key_lookups[namespace]
+                self.remove(namespace)
+
+        self.key_lookups[namespace] = ref(key_lookup, remove)
+        return key_lookup
+
+    def remove(self, namespace):
+        """Remove the entries of a key lookup.
+
+        :param namespace: the namespace of the key lookup.
+        """
+        cache = self.cache
+        for cache_key in list(cache.data):
+            if cache_key[0][0] == namespace:
+                cache.invalidate(cache_key)
+
+    def occupancy(self):
+        """The number of entries of each key lookup.
+
+        The key lookup of a dispatch function is available as its
+        ``key_lookup`` attribute.
+
+        :returns: a dict that maps the key lookups that use this cache to
+          their number of entries.
+        """
+        counts = dict.fromkeys(self.key_lookups, 0)
+        for cache_key in list(self.cache.data):
+            namespace = cache_key[0][0]
+            if namespace in counts:
+                counts[namespace] += 1
+        result = {}
+        for namespace, entries in counts.items():
+            key_lookup = self.key_lookups[namespace]()
+            if key_lookup is not None:
+                result[key_lookup] = entries
+        return result
+
+
+class SharedCachingKeyLookup(LruCachingKeyLookup):
+    """A key lookup that caches in a :class:`reg.SharedCache`.
+
+    Use :meth:`reg.SharedCache.key_lookup` to construct it.
+
+    :param key_lookup: the :class:`PredicateRegistry` to cache.
+    :param shared_cache: the :class:`reg.SharedCache`.
+    :param namespace: a number that identifies the key lookup among
+      those of the shared cache.
+    """
+    def __init__(self, key_lookup, shared_cache, namespace):
+        partitions = count()
+        super(SharedCachingKeyLookup, self).__init__(
+            key_lookup, shared_cache.size, shared_cache.size,
+            shared_cache.size,
+            cache_class=lambda size: Partition(
+                shared_cache.cache, (namespace, next(partitions))))
+        self.namespace = namespace
+
+    def __len__(self):
+        """The number of entries of this key lookup."""
+        return sum(len(cache.data) for cache in self.caches)
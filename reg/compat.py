@@ -4,3 +4,14 @@ try:
     string_types = (basestring,)
 except NameError:
     string_types = (str,)
+
+try:
+    from types import MappingProxyType
+except ImportError:  # pragma: no cover
+    # Python 2 has no read-only view of a dict.
+    MappingProxyType = dict
+
+try:
+    from time import perf_counter as timer
+except ImportError:  # pragma: no cover
+    from time import time as timer  # noqa
@@ -1,8 +1,11 @@
 from __future__ import unicode_literals
 import inspect
 from types import MethodType
-from .dispatch import dispatch, Dispatch, format_signature, execute
+from weakref import ref
+from .dispatch import (dispatch, Dispatch, format_signature,
+                       format_parameters, make_function)
 from .arginfo import arginfo
+from .error import RegistrationError
 
 
 class dispatch_method(dispatch):
@@ -23,16 +26,34 @@ class dispatch_method(dispatch):
       you can return a caching key lookup (such as
       :class:`reg.DictCachingKeyLookup` or
       :class:`reg.LruCachingKeyLookup`) to make it more efficient.
+    :param specialize_threshold: optional number of calls with the
+      same dispatch key after which the dispatch method is specialized
+      for that key. See :class:`reg.Dispatch`.
     :param first_invocation_hook: a callable that accepts an instance of the
       class in which this decorator is used. It is invoked the first
       time the method is invoked.
+    :param inherit: if true, the dispatch method of a subclass starts
+      out with the implementations registered for its base class,
+      sharing them until the subclass registers its own. See
+      :class:`reg.DispatchMethod`.
+    :param per_class: if true, the class and each of its subclasses
+      get their dispatch method as a plain function attribute, which
+      Python binds to instances like any other method, instead of
+      this decorator storing a bound dispatch method on each instance
+      it is used with. This works for classes with ``__slots__`` too,
+      although they need a ``__weakref__`` slot to use
+      ``first_invocation_hook``. This needs Python 3.6 or later, as it
+      uses ``__set_name__`` and ``__init_subclass__``.
 
     """
     def __init__(self, *predicates, **kw):
-        self.first_invocation_hook = kw.pop(
-            'first_invocation_hook', lambda x: None)
+        self.first_invocation_hook = kw.pop('first_invocation_hook', None)
+        self.inherit = kw.pop('inherit', False)
+        self.per_class = kw.pop('per_class', False)
         super(dispatch_method, self).__init__(*predicates, **kw)
         self._cache = {}
+        self._dispatch_methods = {}
+        self.owner = None
 
     def __call__(self, callable):
         self.callable = callable
@@ -48,10 +69,18 @@ class dispatch_method(dispatch):
         if dispatch is None:
             # if this is the first time we access the dispatch method,
             # we create it and store it in the cache
-            dispatch = DispatchMethod(self.predicates,
-                                      self.callable,
-                                      self.get_key_lookup).call
-            self._cache[type] = dispatch
+            base = None
+            if self.inherit and type is not None:
+                base = self._base(type)
+                if base is not None:
+                    self.__get__(None, base)
+                    base = self._dispatch_methods[base]
+            dispatch_method = DispatchMethod(
+                self.predicates, self.callable, self.get_key_lookup,
+                self.specialize_threshold, base,
+                self.first_invocation_hook if self.per_class else None)
+            self._dispatch_methods[type] = dispatch_method
+            dispatch = self._cache[type] = dispatch_method.call
 
         # we cannot attach the dispatch method to the class
         # directly (skipping the descriptor during next access) here,
@@ -61,7 +90,9 @@ class dispatch_method(dispatch):
             # we access it through the class directly, so unbound
             return dispatch
 
-        self.first_invocation_hook(obj)
+        # with per_class, the dispatch method calls the hook itself
+        if self.first_invocation_hook is not None and not self.per_class:
+            self.first_invocation_hook(obj)
 
         # if we access the instance, we simulate binding it
         bound = MethodType(dispatch, obj)
@@ -71,8 +102,232 @@ class dispatch_method(dispatch):
         setattr(obj, self.callable.__name__, bound)
         return bound
 
+    def _base(self, type):
+        """The nearest base class of a class that has this method.
+
+        :returns: the base class, or ``None`` if the method is defined
+          on the class itself.
+        """
+        mro = inspect.getmro(type)
+        owner = self.owner
+        if owner is None:
+            # we don't know our name without __set_name__, which may
+            # differ from that of the function
+            for owner in mro:
+                if any(value is self for value in vars(owner).values()):
+                    break
+            else:
+                return None
+        for base in mro[1:]:
+            if issubclass(base, owner):
+                return base
+        return None
+
+    def __set_name__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        if not self.per_class:
+            return
+        setattr(owner, name, self.__get__(None, owner))
+        # give each subclass its own dispatch method when it is created
+        previous = vars(owner).get('__init_subclass__')
+        descriptor = self
+
+        def __init_subclass__(cls, **kw):
+            if previous is None:
+                super(owner, cls).__init_subclass__(**kw)
+            else:
+                previous.__get__(None, cls)(**kw)
+            descriptor._bind(cls)
+
+        owner.__init_subclass__ = classmethod(__init_subclass__)
+
+    def _bind(self, cls):
+        """Set the dispatch method of a subclass as its attribute.
+
+        This is skipped if the method is replaced by something else.
+        """
+        name = self.name
+        for base in inspect.getmro(cls):
+            if name in vars(base):
+                if vars(base)[name] is self._cache.get(base):
+                    setattr(cls, name, self.__get__(None, cls))
+                return
+
 
 class DispatchMethod(Dispatch):
+    """Dispatch function for a method, see :class:`reg.dispatch_method`.
+
+    A dispatch method that inherits from the one of a base class
+    shares the registry, the key lookup and its caches with it, so
+    that it costs hardly any memory. Once its own registrations change,
+    it copies the registrations of the base class into a registry of
+    its own first, which costs as much as registering them all again.
+    Its own registrations replace those it inherited for the same
+    keys. From then on, changes of registrations for the base class
+    no longer affect it, until :meth:`clean` makes it share the
+    registry of the base class again.
+
+    :param base: the dispatch method of the base class to inherit the
+      registrations from, or ``None``.
+    :param first_invocation_hook: optional callable, which the dispatch
+      method calls with its first argument the first time it is called
+      with it. It keeps track of these arguments by their identity,
+      which needs them to support weak references.
+    """
+
+    def __init__(self, predicates, callable, get_key_lookup,
+                 specialize_threshold=None, base=None,
+                 first_invocation_hook=None):
+        self.base = base
+        self.first_invocation_hook = first_invocation_hook
+        # the ids of the arguments we have called the hook with
+        self._invoked = {}
+        self.shared = False
+        self.frozen = False
+        # the keys of the registrations copied from the base class
+        self.inherited = set()
+        # the dispatch methods that share our registry
+        self.inheriting = []
+        super(DispatchMethod, self).__init__(
+            predicates, callable, get_key_lookup, specialize_threshold)
+
+    def clean(self):
+        """Clean up implementations and added predicates.
+
+        This restores the dispatch method to its original state,
+        removing registered implementations and predicates added
+        using :meth:`reg.Dispatch.add_predicates`. A dispatch method
+        that inherits registrations shares those of its base class
+        again. This also undoes :meth:`reg.Dispatch.freeze`.
+        """
+        self.frozen = False
+        self.inherited = set()
+        if self.base is None:
+            super(DispatchMethod, self).clean()
+            return
+        if not self.shared:
+            self.base.inheriting.append(self)
+            self.shared = True
+        self._share()
+
+    def check_restore(self, registrations):
+        if self.frozen:
+            raise RegistrationError(
+                "Cannot restore registrations of frozen dispatch %r" %
+                self.wrapped_func)
+        if self.shared:
+            # we only have the registrations of the base class, which
+            # restored registrations override
+            registrations = []
+        else:
+            registrations = [(key, value) for key, value in registrations
+                             if key not in self.inherited]
+        super(DispatchMethod, self).check_restore(registrations)
+
+    def _target_call(self, name, target, args, namespace):
+        # a specialization calls the function made into a method by
+        # methodify directly, which saves a call. Calls that look up
+        # their target go through the wrapper, as checking for it
+        # would cost more than the call it saves.
+        func = getattr(target, '_methodified', None)
+        if func is None or not args.args:
+            return super(DispatchMethod, self)._target_call(
+                name, target, args, namespace)
+        namespace[name] = func
+        return '{0}({1})'.format(
+            name, format_signature(args._replace(args=args.args[1:])))
+
+    def _prologue(self, args, namespace):
+        if self.first_invocation_hook is None or not args.args:
+            return []
+        namespace.update(
+            _id=id,
+            _invoked=self._invoked,
+            _first_invocation=self._first_invocation)
+        return ['    if _id({0}) not in _invoked:'.format(args.args[0]),
+                '        _first_invocation({0})'.format(args.args[0])]
+
+    def _first_invocation(self, obj):
+        key = id(obj)
+        invoked = self._invoked
+        try:
+            invoked[key] = ref(obj, lambda r: invoked.pop(key, None))
+        except TypeError:
+            raise TypeError(
+                "first_invocation_hook of %r needs weak references to %r "
+                "objects; add '__weakref__' to their __slots__" % (
+                    self.wrapped_func, type(obj).__name__))
+        self.first_invocation_hook(obj)
+
+    def _share(self):
+        base = self.base
+        if base._targets is not None:
+            target_lookup = base._targets.func
+        else:
+            target_lookup = base._target_lookup
+        self._use_registry(base.predicates, base.registry,
+                           base.key_lookup, target_lookup)
+
+    def _use_registry(self, predicates, registry, key_lookup,
+                      target_lookup):
+        super(DispatchMethod, self)._use_registry(
+            predicates, registry, key_lookup, target_lookup)
+        for dispatch_method in self.inheriting:
+            dispatch_method._share()
+
+    def _modify(self, keys=()):
+        if self.shared:
+            self._copy()
+        overridden = self.inherited.intersection(keys)
+        for key in overridden:
+            if key in self.registry.known_keys:
+                self.registry.unregister(key)
+        self.inherited -= overridden
+
+    def _copy(self):
+        """Stop sharing the registry of the base class."""
+        if self.frozen:
+            raise RegistrationError(
+                "Cannot change registrations of frozen dispatch %r" %
+                self.wrapped_func)
+        base = self.base
+        if base.registry.frozen:
+            raise RegistrationError(
+                "Cannot copy registrations of frozen dispatch %r" %
+                base.wrapped_func)
+        base.inheriting.remove(self)
+        self.shared = False
+        registrations = list(base.registry.known_keys.items())
+        self._register_predicates(base.predicates, registrations)
+        self.inherited = set(key for key, value in registrations)
+
+    def add_predicates(self, predicates, keep_registrations=False):
+        """Add new predicates.
+
+        See :meth:`reg.Dispatch.add_predicates`. A dispatch method that
+        shares the registrations of its base class copies them first.
+        """
+        super(DispatchMethod, self).add_predicates(
+            predicates, keep_registrations)
+        if keep_registrations:
+            defaults = tuple(p.default for p in predicates)
+            self.inherited = set(key + defaults for key in self.inherited)
+        else:
+            self.inherited = set()
+
+    def freeze(self):
+        """Freeze the registered implementations.
+
+        See :meth:`reg.Dispatch.freeze`. A dispatch method that shares
+        the registrations of its base class keeps sharing them, so
+        that it still sees changes of registrations for the base
+        class.
+        """
+        if self.shared:
+            self.frozen = True
+        else:
+            super(DispatchMethod, self).freeze()
 
     def by_args(self, *args, **kw):
         """Lookup an implementation by invocation arguments.
@@ -116,18 +371,24 @@ def methodify(func, selfname=None):
     if args.args[:1] != [selfname]:
         # Add missing self to the signature:
         code_template = (
-            "def wrapper({selfname}, {signature}): return _func({signature})")
+            "def wrapper({selfname}, {parameters}): "
+            "return _func({signature})")
     elif inspect.ismethod(func):
         # Bound method: must be wrapped despite same signature:
         code_template = (
-            "def wrapper({signature}): return _func({signature})")
+            "def wrapper({parameters}): return _func({signature})")
     else:
         # No wrapping needed:
         return func
     code_source = code_template.format(
+        parameters=format_parameters(args),
         signature=format_signature(args),
         selfname=selfname or '_')
-    return execute(code_source, _func=func)['wrapper']
+    wrapper = make_function(code_source, _func=func)
+    if args.args[:1] != [selfname]:
+        # dispatch methods can call func directly, without the context
+        wrapper._methodified = func
+    return wrapper
 
 
 def clean_dispatch_methods(cls):
@@ -142,3 +403,17 @@ def clean_dispatch_methods(cls):
         attr = getattr(cls, name)
         if inspect.isfunction(attr) and hasattr(attr, 'clean'):
             attr.clean()
+
+
+def freeze_dispatch_methods(cls):
+    """For a given class freeze all dispatch methods.
+
+    This makes their registries immutable using
+    :meth:`reg.DispatchMethod.freeze`.
+
+    :param cls: a class that has :class:`reg.DispatchMethod` methods on it.
+    """
+    for name in dir(cls):
+        attr = getattr(cls, name)
+        if inspect.isfunction(attr) and hasattr(attr, 'freeze'):
+            attr.freeze()
@@ -1,11 +1,27 @@
 from __future__ import unicode_literals
+import gc
+import inspect
+import linecache
 from functools import partial, wraps
 from collections import namedtuple
-from .predicate import match_instance
+from itertools import product
+from types import CodeType, FunctionType
+from weakref import WeakSet
+from .predicate import match_instance, ClassIndex
 from .compat import string_types
 from .predicate import PredicateRegistry
 from .arginfo import arginfo
 from .error import RegistrationError
+from .cache import FrozenCache
+
+
+MAX_SPECIALIZATIONS = 4
+"""The maximum number of keys a dispatch function is specialized for."""
+
+MAX_COUNTED_KEYS = 1000
+"""The maximum number of keys a dispatch function counts calls for."""
+
+_dispatches = WeakSet()
 
 
 class dispatch(object):
@@ -26,6 +42,9 @@ class dispatch(object):
       you can return a caching key lookup (such as
       :class:`reg.DictCachingKeyLookup` or
       :class:`reg.LruCachingKeyLookup`) to make it more efficient.
+    :param specialize_threshold: optional number of calls with the
+      same dispatch key after which the dispatch function is
+      specialized for that key. See :class:`reg.Dispatch`.
     :returns: a function that you can use as if it were a
       :class:`reg.Dispatch` instance.
 
@@ -34,6 +53,7 @@ class dispatch(object):
         self.predicates = [self._make_predicate(predicate)
                            for predicate in predicates]
         self.get_key_lookup = kw.pop('get_key_lookup', identity)
+        self.specialize_threshold = kw.pop('specialize_threshold', None)
 
     def _make_predicate(self, predicate):
         if isinstance(predicate, string_types):
@@ -41,7 +61,8 @@ class dispatch(object):
         return predicate
 
     def __call__(self, callable):
-        return Dispatch(self.predicates, callable, self.get_key_lookup).call
+        return Dispatch(self.predicates, callable, self.get_key_lookup,
+                        self.specialize_threshold, lazy=True).call
 
 
 def identity(registry):
@@ -75,6 +96,41 @@ class LookupEntry(
         return list(self.matches)
 
 
+def get_target_lookup(key_lookup, default):
+    """Construct the function a dispatch function looks up targets with.
+
+    This uses the ``target_lookup`` method of the key lookup. A key
+    lookup that only has ``component``, ``fallback`` and ``all``
+    looks up the component and then the fallback instead.
+
+    :param key_lookup: the key lookup.
+    :param default: the callable to dispatch to if there is neither a
+      component nor a fallback.
+    :returns: a function that takes a key and returns the callable to
+      dispatch to.
+    """
+    target_lookup = getattr(key_lookup, 'target_lookup', None)
+    if target_lookup is not None:
+        return target_lookup(default)
+    component = key_lookup.component
+    fallback = key_lookup.fallback
+    return lambda key: component(key) or fallback(key) or default
+
+
+class LazyKeyLookup(object):
+    """Stands in for the key lookup of a lazy dispatch function.
+
+    Using it sets up the dispatch function, and hands over to its
+    actual key lookup.
+    """
+
+    def __init__(self, dispatch):
+        self.dispatch = dispatch
+
+    def __getattr__(self, name):
+        return getattr(self.dispatch.key_lookup, name)
+
+
 class Dispatch(object):
     """Dispatch function.
 
@@ -93,59 +149,172 @@ class Dispatch(object):
       you can return a caching key lookup (such as
       :class:`reg.DictCachingKeyLookup` or
       :class:`reg.LruCachingKeyLookup`) to make it more efficient.
+    :param specialize_threshold: if given, the dispatch function
+      counts how often it is called with each dispatch key. Once a key
+      has been seen this many times, the dispatch function is
+      recompiled to check for that key first and call its target
+      directly. At most :data:`MAX_SPECIALIZATIONS` keys are
+      specialized. Once it counts :data:`MAX_COUNTED_KEYS` keys, the
+      counts start over, so that keys seen rarely don't pile up.
+      Changing the predicates throws the specializations
+      away, and so does registering or unregistering implementations
+      for those it affects.
+    :param lazy: if true, the registry and the code of the dispatch
+      function are only made once it is first called, or one of its
+      methods or attributes is used. :func:`reg.dispatch` makes lazy
+      dispatch functions.
     """
-    def __init__(self, predicates, callable, get_key_lookup):
+    def __init__(self, predicates, callable, get_key_lookup,
+                 specialize_threshold=None, lazy=False):
         self.wrapped_func = callable
         self.get_key_lookup = get_key_lookup
+        self.specialize_threshold = specialize_threshold
         self._original_predicates = predicates
+        self.call = None
+        if lazy:
+            # the registry and the code are made on first use, by
+            # _materialize or __getattr__. Until then, calls go through
+            # a function with the signature of the wrapped function, so
+            # that it can be inspected like the dispatch function.
+            args = arginfo(callable)
+            self._set_call(make_function(
+                'def call({0}):\n'
+                '    return _materialize()({1})\n'.format(
+                    format_parameters(args), format_signature(args)),
+                _materialize=self._materialize))
+            self.call.__defaults__ = args.defaults
+            self.call.__kwdefaults__ = args.kwonlydefaults
+            self.call.key_lookup = LazyKeyLookup(self)
+        else:
+            self.clean()
+        _dispatches.add(self)
+
+    def _register_predicates(self, predicates, registrations=()):
+        registry = PredicateRegistry(*predicates)
+        registry.register_many(registrations)
+        key_lookup = self.get_key_lookup(registry)
+        self._use_registry(predicates, registry, key_lookup,
+                           get_target_lookup(key_lookup, self.wrapped_func))
+
+    def _use_registry(self, predicates, registry, key_lookup, target_lookup):
+        """Dispatch with a registry and its key lookup.
+
+        :param target_lookup: the function to look up targets with, as
+          returned by :func:`get_target_lookup`.
+        """
+        previous = vars(self).get('registry')
+        if previous is not None:
+            previous.unsubscribe(self._despecialize)
+        self.registry = registry
+        self.predicates = predicates
+        self.key_lookup = key_lookup
+        self._target_lookup = target_lookup
+        self._targets = None
+        self._counts = {}
+        self._specializations = []
+        self.preforked = False
+        registry.subscribe(self._despecialize)
         self._define_call()
-        self._register_predicates(predicates)
+        self.call.key_lookup = key_lookup
 
-    def _register_predicates(self, predicates):
-        self.registry = PredicateRegistry(*predicates)
-        self.predicates = predicates
-        self.call.key_lookup = self.key_lookup = \
-            self.get_key_lookup(self.registry)
-        self.call.__globals__.update(
-            _registry_key=self.registry.key,
-            _component_lookup=self.key_lookup.component,
-            _fallback_lookup=self.key_lookup.fallback,
-        )
-        self._predicate_key.__globals__.update(
-            _registry_key=self.registry.key,
-            _return_type=partial(LookupEntry, self.key_lookup),
-        )
+    def _modify(self, keys=()):
+        """Called before the registrations change.
+
+        :param keys: the keys about to be registered.
+        """
 
     def _define_call(self):
         # We build the generic function on the fly. Its definition
-        # requires the signature of the wrapped function and the
-        # arguments needed by the registered predicates
-        # (predicate_args):
-        code_template = """\
-def call({signature}):
-    _key = _registry_key({predicate_args})
-    return (_component_lookup(_key) or
-            _fallback_lookup(_key) or
-            _fallback)({signature})
-"""
-
+        # requires the signature of the wrapped function, the
+        # expressions that compute the dispatch key (key_sources) and
+        # the keys we have specialized the dispatch function for.
         args = arginfo(self.wrapped_func)
-        signature = format_signature(args)
-        predicate_args = ', '.join('{0}={0}'.format(x) for x in args.args)
-        code_source = code_template.format(
-            signature=signature,
-            predicate_args=predicate_args)
+        signature = format_parameters(args)
+        key_sources = self._key_sources(args)
+        namespace = dict(
+            _registry_key=self.registry.key,
+            _target_lookup=self._target_lookup)
+
+        lines = ['def call({0}):'.format(signature)]
+        lines.extend(self._prologue(args, namespace))
+        if key_sources is None:
+            # we cannot inline the key, so we compute it only once
+            lines.append('    _key = {0}'.format(
+                format_registry_key(args)))
+            key_source = '_key'
+        else:
+            key_source = format_key(key_sources)
+
+        for i, (key, target) in enumerate(self._specializations):
+            if key_sources is None:
+                namespace['_key_{0}'.format(i)] = key
+                conditions = ['_key == _key_{0}'.format(i)]
+            else:
+                conditions = []
+                for j, (source, value) in enumerate(zip(key_sources, key)):
+                    name = '_key_{0}_{1}'.format(i, j)
+                    namespace[name] = value
+                    # classes compare by identity, which is cheaper
+                    operator = 'is' if isinstance(value, type) else '=='
+                    conditions.append('{0} {1} {2}'.format(
+                        source, operator, name))
+            lines.append('    if {0}:'.format(
+                ' and '.join(conditions) or 'True'))
+            lines.append('        return {0}'.format(self._target_call(
+                '_target_{0}'.format(i), target, args, namespace)))
+
+        if (self.specialize_threshold is not None and
+                len(self._specializations) < MAX_SPECIALIZATIONS and
+                not self.preforked):
+            namespace.update(
+                _counts=self._counts,
+                _threshold=self.specialize_threshold,
+                _max_counted_keys=MAX_COUNTED_KEYS,
+                _specialize=self._specialize)
+            if key_source != '_key':
+                lines.append('    _key = {0}'.format(key_source))
+                key_source = '_key'
+            lines.extend([
+                '    _count = _counts.get(_key, 0) + 1',
+                '    if _count == 1 and len(_counts) >= _max_counted_keys:',
+                '        _counts.clear()',
+                '    _counts[_key] = _count',
+                '    if _count == _threshold:',
+                '        _specialize(_key)'])
+
+        lines.append('    return _target_lookup({0})({1})'.format(
+            key_source, format_signature(args)))
 
         # We now compile call to byte-code:
-        self.call = call = wraps(self.wrapped_func)(execute(
-            code_source,
-            _registry_key=None,
-            _component_lookup=None,
-            _fallback_lookup=None,
-            _fallback=self.wrapped_func)['call'])
+        call = make_function('\n'.join(lines) + '\n', **namespace)
+
+        if self.call is None:
+            self._set_call(call)
+        else:
+            # The dispatch function is already in the hands of its
+            # users, so we keep the function object and only replace
+            # its code and the globals it refers to.
+            self.call.__code__ = call.__code__
+            self.call.__globals__.update(call.__globals__)
 
         # We copy over the defaults from the wrapped function.
-        call.__defaults__ = args.defaults
+        self.call.__defaults__ = args.defaults
+        self.call.__kwdefaults__ = args.kwonlydefaults
+
+        # We now build the implementation for the predicate_key method
+        self._predicate_key = make_function(
+            "def predicate_key({signature}):\n"
+            "    return _return_type({key_source})\n".format(
+                signature=signature,
+                key_source=(format_registry_key(args) if key_sources is None
+                            else format_key(key_sources))),
+            _registry_key=self.registry.key,
+            _return_type=partial(LookupEntry, self.key_lookup),
+        )
+
+    def _set_call(self, call):
+        """Make a function the dispatch function."""
+        self.call = call = wraps(self.wrapped_func)(call)
 
         # Make the methods available as attributes of call
         for k in dir(type(self)):
@@ -153,34 +322,127 @@ def call({signature}):
                 setattr(call, k, getattr(self, k))
         call.wrapped_func = self.wrapped_func
 
-        # We now build the implementation for the predicate_key method
-        self._predicate_key = execute(
-            "def predicate_key({signature}):\n"
-            "    return _return_type(_registry_key({predicate_args}))".format(
-                signature=format_signature(args),
-                predicate_args=predicate_args),
-            _registry_key=None, _return_type=None)['predicate_key']
+    def _materialize(self):
+        """Set up a lazy dispatch function if that didn't happen yet.
+
+        :returns: the dispatch function.
+        """
+        if 'registry' not in vars(self):
+            self.clean()
+        return self.call
+
+    def __getattr__(self, name):
+        # only called for missing attributes, which a lazy dispatch
+        # function lacks until it is set up
+        if 'registry' in vars(self):
+            raise AttributeError(name)
+        self.clean()
+        return getattr(self, name)
+
+    def _prologue(self, args, namespace):
+        """Lines of code to run at the start of each call.
+
+        :param args: the arguments of the dispatch function.
+        :param namespace: the namespace of the code, to which the names
+          the lines refer to can be added.
+        :returns: a list of lines.
+        """
+        return []
+
+    def _target_call(self, name, target, args, namespace):
+        """The expression calling the target of a specialization.
+
+        :param name: the name to give the target in the namespace.
+        :param target: the target.
+        :param args: the arguments of the dispatch function.
+        :param namespace: the namespace of the code.
+        """
+        namespace[name] = target
+        return '{0}({1})'.format(name, format_signature(args))
+
+    def _key_sources(self, args):
+        """Python expressions computing the dispatch key from arguments.
+
+        Predicates that know how to extract their key from an argument
+        of the same name are inlined, which avoids building a
+        dictionary of arguments and calling the key getters of the
+        predicates. If any predicate cannot be inlined this returns
+        ``None``, and we fall back on :meth:`PredicateRegistry.key`.
+        """
+        names = args.args + args.kwonlyargs
+        sources = [p.key_source() if p.name in names else None
+                   for p in self.predicates]
+        if None in sources:
+            return None
+        return sources
+
+    def _specialize(self, key):
+        """Specialize the dispatch function for a key."""
+        self._specializations.append((key, self._target_lookup(key)))
+        if len(self._specializations) == MAX_SPECIALIZATIONS:
+            # we don't count anymore, so let's not keep the counts
+            self._counts.clear()
+        self._define_call()
+
+    def _despecialize(self, changed):
+        """Throw away the specializations a change of registration affects.
+
+        This also throws away the targets restored from a snapshot.
+
+        :param changed: the key that was registered or unregistered.
+        """
+        self._counts.clear()
+        if not self._specializations and self._targets is None:
+            return
+        specializations = [
+            (key, target) for key, target in self._specializations
+            if not self.registry.is_affected(key, changed)]
+        if self._targets is not None:
+            self._target_lookup = self._targets.func
+            self._targets = None
+        elif len(specializations) == len(self._specializations):
+            return
+        self._specializations[:] = specializations
+        self._define_call()
 
     def clean(self):
         """Clean up implementations and added predicates.
 
         This restores the dispatch function to its original state,
         removing registered implementations and predicates added
-        using :meth:`reg.Dispatch.add_predicates`.
+        using :meth:`reg.Dispatch.add_predicates`. This also undoes
+        :meth:`reg.Dispatch.freeze`.
         """
         self._register_predicates(self._original_predicates)
 
-    def add_predicates(self, predicates):
+    def add_predicates(self, predicates, keep_registrations=False):
         """Add new predicates.
 
         Extend the predicates used by this predicates. This can be
         used to add predicates that are configured during startup time.
 
-        Note that this clears up any registered implementations.
+        Note that this clears up any registered implementations, unless
+        ``keep_registrations`` is true.
 
         :param predicates: a list of predicates to add.
+        :param keep_registrations: if true, keep the registered
+          implementations, as if they had been registered without
+          values for the new predicates. Their keys get the ``default``
+          of each new predicate.
         """
-        self._register_predicates(self.predicates + predicates)
+        self._modify()
+        if self.registry.frozen:
+            raise RegistrationError(
+                "Cannot add predicates to frozen dispatch %r" %
+                self.wrapped_func)
+        registrations = ()
+        if keep_registrations:
+            defaults = tuple(p.default for p in predicates)
+            registrations = [
+                (key + defaults, value)
+                for key, value in self.registry.known_keys.items()]
+        self._register_predicates(self.predicates + predicates,
+                                  registrations)
 
     def register(self, func=None, **key_dict):
         """Register an implementation.
@@ -202,9 +464,217 @@ def call({signature}):
             return partial(self.register, **key_dict)
         validate_signature(func, self.wrapped_func)
         predicate_key = self.registry.key_dict_to_predicate_key(key_dict)
+        self._modify([predicate_key])
         self.registry.register(predicate_key, func)
         return func
 
+    def register_many(self, registrations):
+        """Register many implementations at once.
+
+        This is faster than calling :meth:`register` for each of them.
+        The signature of each distinct implementation is checked only
+        once, and nothing is registered if any of the registrations
+        fails.
+
+        :param registrations: an iterable of registrations. Each is
+          either a tuple of an implementation and a dict of keyword
+          arguments describing the registration, or a dict of those
+          keyword arguments with the implementation as ``func``, as you
+          would pass them to :meth:`register`.
+        """
+        validated = {}
+        key_dict_to_predicate_key = self.registry.key_dict_to_predicate_key
+        items = []
+        for registration in registrations:
+            if isinstance(registration, dict):
+                key_dict = dict(registration)
+                func = key_dict.pop('func', None)
+            else:
+                func, key_dict = registration
+            if id(func) not in validated:
+                validate_signature(func, self.wrapped_func)
+                # keep func alive, so that its id isn't reused
+                validated[id(func)] = func
+            items.append((key_dict_to_predicate_key(key_dict), func))
+        self._modify([key for key, func in items])
+        self.registry.register_many(items)
+
+    def unregister(self, **key_dict):
+        """Remove a registered implementation.
+
+        Caching key lookups only drop the entries that are affected.
+
+        :param key_dict: keyword arguments describing the registration,
+          like those passed to :meth:`reg.Dispatch.register`.
+        :returns: the implementation that was registered.
+        """
+        self._modify()
+        predicate_key = self.registry.key_dict_to_predicate_key(key_dict)
+        return self.registry.unregister(predicate_key)
+
+    def freeze(self):
+        """Freeze the registered implementations.
+
+        Use this once configuration is done and the registrations no
+        longer change. Registering implementations or adding
+        predicates raises :exc:`reg.RegistrationError` afterwards, and
+        the registry drops the data it only needs for registration, so
+        it uses less memory. :meth:`reg.Dispatch.clean` makes the
+        dispatch function mutable again.
+        """
+        self.registry.freeze()
+
+    def warm(self, keys=(), classes=None):
+        """Look up the implementations for keys ahead of dispatch calls.
+
+        This fills the cache of a caching key lookup, so that the first
+        dispatch calls with these keys don't pay for the lookup.
+
+        :param keys: a sequence of dispatch keys, which are tuples with
+          a value for each predicate. For :func:`reg.match_instance`
+          predicates this value is the class of the argument.
+        :param classes: optional sequence of classes. If given, all
+          combinations of these classes for the predicates that
+          dispatch on classes are looked up too. For the other
+          predicates, these are combined with the values for which
+          implementations are registered.
+        :returns: the number of keys looked up.
+        """
+        keys = self._keys(keys, classes)
+        for key in keys:
+            self._target_lookup(key)
+        return len(keys)
+
+    def _keys(self, keys, classes):
+        """The keys to look up for :meth:`warm` and :meth:`prefork`."""
+        keys = list(keys)
+        if classes is not None:
+            classes = list(classes)
+            keys.extend(product(*[
+                classes if isinstance(index, ClassIndex) else list(index)
+                for index in self.registry.indexes]))
+        return keys
+
+    def prefork(self, keys=(), classes=None):
+        """Prepare the dispatch function to be shared by forked processes.
+
+        This freezes the dispatch function (see :meth:`freeze`), and
+        looks up the implementations for the keys like :meth:`warm`,
+        but stores them in a dictionary that is never written to.
+        Dispatch calls with other keys use the key lookup as usual. The
+        dispatch function keeps its specializations, but stops
+        counting calls to specialize for more keys.
+        Processes forked afterwards can then share the memory of the
+        dispatch function instead of each having their own copy. Use
+        :func:`reg.prefork` to do this for all dispatch functions.
+
+        :meth:`clean` undoes this.
+
+        :param keys: a sequence of dispatch keys, see :meth:`warm`.
+        :param classes: optional sequence of classes, see :meth:`warm`.
+        :returns: the number of keys looked up.
+        """
+        self.freeze()
+        keys = self._keys(keys, classes)
+        default = self.wrapped_func
+        self._use_targets(
+            (key, self.registry.target(key, default)) for key in keys)
+        self._counts.clear()
+        self.preforked = True
+        self._define_call()
+        return len(keys)
+
+    def _use_targets(self, targets):
+        """Dispatch to targets looked up in advance.
+
+        Dispatch calls with other keys use the key lookup.
+
+        :param targets: an iterable of dispatch keys and their targets.
+        """
+        if self._targets is not None:
+            lookup = self._targets.func
+        else:
+            lookup = self._target_lookup
+        self._targets = FrozenCache(targets, lookup)
+        self._target_lookup = self._targets.__getitem__
+
+    def snapshot(self, keys=(), classes=None):
+        """The state of the dispatch function to restore it from.
+
+        This is used by :func:`reg.write_snapshot`.
+
+        :param keys: a sequence of dispatch keys, see :meth:`warm`.
+        :param classes: optional sequence of classes, see :meth:`warm`.
+        :returns: a tuple of the registrations, as a list of keys and
+          implementations, and of the dispatch table for the keys, as
+          a list of keys and the callables to dispatch to.
+        """
+        if self.registry.frozen:
+            raise RegistrationError(
+                "Cannot take a snapshot of frozen dispatch %r" %
+                self.wrapped_func)
+        default = self.wrapped_func
+        return (list(self.registry.known_keys.items()),
+                [(key, self.registry.target(key, default))
+                 for key in self._keys(keys, classes)])
+
+    def restore(self, registrations, targets):
+        """Restore the state of the dispatch function.
+
+        This registers the implementations without checking their
+        signatures, and dispatches calls with the keys of the dispatch
+        table without looking them up, until registrations change.
+        This is used by :func:`reg.load_snapshot`.
+
+        :param registrations: a list of keys and implementations, as
+          returned by :meth:`snapshot`.
+        :param targets: a list of keys and the callables to dispatch
+          to, as returned by :meth:`snapshot`.
+        """
+        registrations = list(registrations)
+        self.check_restore(registrations)
+        self._modify([key for key, value in registrations])
+        self.registry.register_many(registrations)
+        self._use_targets(targets)
+        self._define_call()
+
+    def check_restore(self, registrations):
+        """Check that registrations can be restored.
+
+        :meth:`restore` does this before it changes anything, and
+        :func:`reg.load_snapshot` for all dispatch functions before it
+        restores any of them.
+
+        :param registrations: a list of keys and implementations, as
+          returned by :meth:`snapshot`.
+        :raises: :exc:`reg.RegistrationError` if the dispatch function
+          is frozen or already has a registration for any of the keys.
+        """
+        registry = self.registry
+        if registry.frozen:
+            raise RegistrationError(
+                "Cannot restore registrations of frozen dispatch %r" %
+                self.wrapped_func)
+        known_keys = registry.known_keys
+        duplicates = [key for key, value in registrations
+                      if key in known_keys]
+        if duplicates:
+            raise RegistrationError(
+                "Cannot restore, already have registrations for keys: "
+                "%s" % ', '.join('%s' % (key,) for key in duplicates))
+
+    def cache_info(self):
+        """Statistics of the cache used by dispatch calls.
+
+        :returns: a :class:`reg.CacheInfo`, or ``None`` if the key
+          lookup doesn't cache, such as a plain
+          :class:`reg.predicate.PredicateRegistry`.
+        """
+        cache_info = getattr(self.key_lookup, 'cache_info', None)
+        if cache_info is None:
+            return None
+        return cache_info()
+
     def by_args(self, *args, **kw):
         """Lookup an implementation by invocation arguments.
 
@@ -225,6 +695,53 @@ def call({signature}):
             self.registry.key_dict_to_predicate_key(predicate_values))
 
 
+def warm_dispatches(namespace, classes):
+    """Warm the caches of all dispatch functions in a namespace.
+
+    This calls :meth:`reg.Dispatch.warm` for each dispatch function of
+    a module, or for each dispatch method of a class.
+
+    :param namespace: a module, or a class with
+      :class:`reg.DispatchMethod` methods.
+    :param classes: the classes to warm the caches for.
+    :returns: the number of keys looked up.
+    """
+    result = 0
+    for name in dir(namespace):
+        attr = getattr(namespace, name)
+        if inspect.isfunction(attr) and hasattr(attr, 'warm'):
+            result += attr.warm(classes=classes)
+    return result
+
+
+def prefork(classes=None):
+    """Prepare all dispatch functions to be shared by forked processes.
+
+    This calls :meth:`reg.Dispatch.prefork` for all dispatch functions,
+    and for the dispatch methods of all classes on which they have been
+    used. Then it collects garbage and moves all objects to the
+    permanent generation of the garbage collector with
+    :func:`gc.freeze`, if available, so that the garbage collector
+    doesn't write to them in the forked processes either.
+
+    Call this after all implementations have been registered, just
+    before forking.
+
+    :param classes: optional sequence of classes to look up the
+      implementations for, see :meth:`reg.Dispatch.warm`.
+    :returns: the number of keys looked up.
+    """
+    if classes is not None:
+        classes = list(classes)
+    result = 0
+    for dispatch in list(_dispatches):
+        result += dispatch.prefork(classes=classes)
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    return result
+
+
 def validate_signature(f, dispatch):
     f_arginfo = arginfo(f)
     if f_arginfo is None:
@@ -238,13 +755,43 @@ def validate_signature(f, dispatch):
                 f, dispatch))
 
 
+def format_key(sources):
+    """Format the expression of a key tuple given its item expressions."""
+    if len(sources) == 1:
+        return '({0},)'.format(*sources)
+    return '({0})'.format(', '.join(sources))
+
+
+def format_registry_key(args):
+    """Format the expression computing a key with the registry."""
+    return '_registry_key({0})'.format(
+        ', '.join('{0}={0}'.format(x) for x in args.args + args.kwonlyargs))
+
+
 def format_signature(args):
+    """Format the arguments to pass on a call with the same signature."""
     return ', '.join(
         args.args +
         (['*' + args.varargs] if args.varargs else []) +
+        ['{0}={0}'.format(x) for x in args.kwonlyargs] +
         (['**' + args.keywords] if args.keywords else []))
 
 
+def format_parameters(args):
+    """Format the parameters of a definition, without their defaults."""
+    parameters = list(args.args)
+    if args.posonlyargs:
+        parameters.insert(len(args.posonlyargs), '/')
+    if args.varargs:
+        parameters.append('*' + args.varargs)
+    elif args.kwonlyargs:
+        parameters.append('*')
+    parameters.extend(args.kwonlyargs)
+    if args.keywords:
+        parameters.append('**' + args.keywords)
+    return ', '.join(parameters)
+
+
 def same_signature(a, b):
     """Check whether a arginfo and b arginfo are the same signature.
 
@@ -255,12 +802,36 @@ def same_signature(a, b):
     b_args = set(b.args)
     return (len(a_args) == len(b_args) and
             a.varargs == b.varargs and
-            a.keywords == b.keywords)
+            a.keywords == b.keywords and
+            # keyword-only arguments are passed by name
+            set(a.kwonlyargs) == set(b.kwonlyargs))
+
 
+def make_function(code_source, **namespace):
+    """Make a function from the source code of its definition.
 
-def execute(code_source, **namespace):
-    """Execute code in a namespace, returning the namespace."""
-    code_object = compile(
-        code_source, '<generated code: {}>'.format(code_source), 'exec')
-    exec(code_object, namespace)
-    return namespace
+    The code is compiled only once for each distinct source, and the
+    functions made from it share the code object, each with its own
+    namespace as globals. As the source only depends on the signature
+    and on the predicates, this is cheap for most dispatch functions.
+    The source is made available to :mod:`linecache`, so that
+    tracebacks show it.
+
+    :param code_source: the source code of a single function definition.
+    :param namespace: the globals of the function.
+    :returns: the function.
+    """
+    code = _code_objects.get(code_source)
+    if code is None:
+        filename = '<generated code {0}>'.format(len(_code_objects))
+        linecache.cache[filename] = (
+            len(code_source), None, code_source.splitlines(True), filename)
+        code, = [const for const in compile(
+            code_source, filename, 'exec').co_consts
+            if isinstance(const, CodeType)]
+        _code_objects[code_source] = code
+    namespace['__builtins__'] = __builtins__
+    return FunctionType(code, namespace)
+
+
+_code_objects = {}
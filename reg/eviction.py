@@ -0,0 +1,287 @@
+"""Caches with scan-resistant eviction policies.
+
+These have the same interface as :class:`repoze.lru.LRUCache`, so that
+you can pass them as ``cache_class`` to
+:class:`reg.LruCachingKeyLookup`. Unlike with a plain LRU cache, a
+burst of keys that are looked up only once doesn't evict the keys that
+are looked up all the time.
+"""
+from collections import OrderedDict
+import sys
+import threading
+
+
+class BoundedCache(object):
+    """Base class of caches with an eviction policy.
+
+    Subclasses keep track of the keys in ``data``, which maps the keys
+    of all entries to their values, by overriding the hooks that are
+    called when it changes.
+
+    :param size: the maximum number of entries.
+    """
+
+    def __init__(self, size):
+        size = int(size)
+        if size < 1:
+            raise ValueError("Cache size must be at least 1: %s" % size)
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        with self.lock:
+            self.data = {}
+            self._clear()
+            self.evictions = 0
+            self.hits = 0
+            self.misses = 0
+            self.lookups = 0
+
+    def get(self, key, default=None):
+        """Return value for key. If not in cache, return default."""
+        with self.lock:
+            self.lookups += 1
+            if key not in self.data:
+                self.misses += 1
+                self._missed(key)
+                return default
+            self.hits += 1
+            self._used(key)
+            return self.data[key]
+
+    def put(self, key, val):
+        """Add key to the cache with value val.
+
+        The eviction policy may decide not to add it.
+        """
+        with self.lock:
+            if key in self.data:
+                self.data[key] = val
+            elif self._admit(key):
+                self.data[key] = val
+                self._added(key)
+
+    def invalidate(self, key):
+        """Remove key from the cache."""
+        with self.lock:
+            if key in self.data:
+                del self.data[key]
+                self._removed(key)
+
+    def _evict(self, queue):
+        """Evict the least recently used key of a queue.
+
+        :param queue: an ordered dict with keys in ``data``, in order
+          of use.
+        :returns: the evicted key.
+        """
+        key, _ = queue.popitem(last=False)
+        del self.data[key]
+        self.evictions += 1
+        return key
+
+    def _clear(self):
+        """Reset the data structures of the eviction policy."""
+
+    def _missed(self, key):
+        """Called when a lookup of key finds nothing."""
+
+    def _used(self, key):
+        """Called when a lookup of key finds its entry."""
+
+    def _admit(self, key):
+        """Whether a new key may be added."""
+        return True
+
+    def _added(self, key):
+        """Called when a new key is added to ``data``."""
+
+    def _removed(self, key):
+        """Called when key is invalidated."""
+
+
+def move_to_end(queue, key):
+    """Make a key the most recently used of an ordered dict."""
+    queue[key] = queue.pop(key)
+
+
+class SegmentedLRUCache(BoundedCache):
+    """Segmented LRU cache.
+
+    New entries go to a probationary segment. Entries that are looked
+    up again move to a protected segment, which holds up to
+    ``protected_ratio`` of the entries. Entries are only evicted from
+    the probationary segment, to which the protected segment demotes
+    its least recently used entries when it is full.
+
+    :param size: the maximum number of entries.
+    :param protected_ratio: the part of the entries that can be
+      protected.
+    """
+
+    def __init__(self, size, protected_ratio=0.8):
+        self.protected_size = min(int(size * protected_ratio), size - 1)
+        super(SegmentedLRUCache, self).__init__(size)
+
+    def _clear(self):
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+
+    def _used(self, key):
+        if key in self.protected:
+            move_to_end(self.protected, key)
+            return
+        del self.probation[key]
+        self.protected[key] = None
+        if len(self.protected) > self.protected_size:
+            demoted, _ = self.protected.popitem(last=False)
+            self.probation[demoted] = None
+
+    def _added(self, key):
+        self.probation[key] = None
+        if len(self.data) > self.size:
+            self._evict(self.probation)
+
+    def _removed(self, key):
+        self.probation.pop(key, None)
+        self.protected.pop(key, None)
+
+
+class TwoQueueCache(BoundedCache):
+    """2Q cache.
+
+    New entries go to a FIFO queue that holds up to ``in_ratio`` of the
+    entries. The keys it evicts are remembered, without their values,
+    in a queue of up to ``out_ratio`` times the size of the cache. Keys
+    that are added again while remembered go to the main LRU queue, so
+    only keys that are used repeatedly get there.
+
+    :param size: the maximum number of entries.
+    :param in_ratio: the part of the entries in the FIFO queue.
+    :param out_ratio: how many evicted keys to remember, relative to
+      the size.
+    """
+
+    def __init__(self, size, in_ratio=0.25, out_ratio=0.5):
+        self.in_size = max(1, int(size * in_ratio))
+        self.out_size = max(1, int(size * out_ratio))
+        super(TwoQueueCache, self).__init__(size)
+
+    def _clear(self):
+        self.recent = OrderedDict()
+        self.ghosts = OrderedDict()
+        self.frequent = OrderedDict()
+
+    def _used(self, key):
+        if key in self.frequent:
+            move_to_end(self.frequent, key)
+
+    def _added(self, key):
+        if key in self.ghosts:
+            del self.ghosts[key]
+            self.frequent[key] = None
+        else:
+            self.recent[key] = None
+        if len(self.data) <= self.size:
+            return
+        if len(self.recent) > self.in_size or not self.frequent:
+            self.ghosts[self._evict(self.recent)] = None
+            if len(self.ghosts) > self.out_size:
+                self.ghosts.popitem(last=False)
+        else:
+            self._evict(self.frequent)
+
+    def _removed(self, key):
+        self.recent.pop(key, None)
+        self.frequent.pop(key, None)
+
+
+_hash_bits = sys.maxsize.bit_length() + 1
+
+_halve = bytearray(count >> 1 for count in range(256))
+
+
+class TinyLFUCache(BoundedCache):
+    """LRU cache with a TinyLFU admission filter.
+
+    The cache estimates how often keys are looked up with a count-min
+    sketch, which halves all counts every ``10 * size`` lookups so that
+    it forgets about the past. Once the cache is full, a new key is
+    only added if it was looked up more often than the least recently
+    used key, which it then evicts.
+
+    The sketch has 4 rows of counters of a byte each. The number of
+    counters in a row is the smallest power of two that is at least 8
+    times the size.
+
+    :param size: the maximum number of entries.
+    """
+
+    multiplier = 0x9E3779B97F4A7C15
+    """Odd number to spread the hash of keys over more bits with, if it
+    doesn't have enough bits for the 4 rows of the sketch."""
+
+    max_count = 15
+
+    def __init__(self, size):
+        bits = 0
+        while 1 << bits < 8 * size:
+            bits += 1
+        self.bits = bits
+        # each row uses different bits of the hash
+        self.mix = 4 * bits > _hash_bits
+        super(TinyLFUCache, self).__init__(size)
+
+    def _clear(self):
+        self.queue = OrderedDict()
+        self.counts = bytearray(4 << self.bits)
+        self.samples = 0
+
+    def _indexes(self, key):
+        bits = self.bits
+        mask = (1 << bits) - 1
+        h = hash(key)
+        if self.mix:
+            h = h * self.multiplier >> 16
+        return (h & mask,
+                1 << bits | h >> bits & mask,
+                2 << bits | h >> 2 * bits & mask,
+                3 << bits | h >> 3 * bits & mask)
+
+    def _frequency(self, key):
+        counts = self.counts
+        return min(counts[i] for i in self._indexes(key))
+
+    def _record(self, key):
+        counts = self.counts
+        for i in self._indexes(key):
+            if counts[i] < self.max_count:
+                counts[i] += 1
+        self.samples += 1
+        if self.samples >= 10 * self.size:
+            self.counts = counts.translate(_halve)
+            self.samples >>= 1
+
+    def _missed(self, key):
+        self._record(key)
+
+    def _used(self, key):
+        self._record(key)
+        move_to_end(self.queue, key)
+
+    def _admit(self, key):
+        if len(self.data) < self.size:
+            return True
+        victim = next(iter(self.queue))
+        if self._frequency(key) <= self._frequency(victim):
+            return False
+        self._evict(self.queue)
+        return True
+
+    def _added(self, key):
+        self.queue[key] = None
+
+    def _removed(self, key):
+        del self.queue[key]
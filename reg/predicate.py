@@ -1,8 +1,11 @@
 import inspect
+from functools import partial
 from operator import itemgetter
 from itertools import product
+from weakref import WeakKeyDictionary
 
 from .error import RegistrationError
+from .compat import MappingProxyType
 
 
 class Predicate(object):
@@ -22,16 +25,22 @@ class Predicate(object):
     :param default: default expected value of the predicate, to be
       used by :meth:`reg.Dispatch.register` whenever the expected
       value for the predicate is not given explicitly.
+    :param key_template: optional Python expression equivalent to
+      ``get_key``, in which ``{name}`` stands for the argument of the
+      generic function with the same name as the predicate. If given,
+      the dispatch function computes the key inline instead of calling
+      ``get_key``.
 
     """
 
     def __init__(self, name, index, get_key=None, fallback=None,
-                 default=None):
+                 default=None, key_template=None):
         self.name = name
         self.index = index
         self.fallback = fallback
         self.get_key = get_key
         self.default = default
+        self.key_template = key_template
 
     def create_index(self):
         return self.index(self.fallback)
@@ -39,6 +48,16 @@ class Predicate(object):
     def key_by_predicate_name(self, d):
         return d.get(self.name, self.default)
 
+    def key_source(self):
+        """Python expression that computes the key inline.
+
+        :returns: the source of the expression, or ``None`` if the key
+          can only be computed by calling ``get_key``.
+        """
+        if self.key_template is None:
+            return None
+        return self.key_template.format(name=self.name)
+
 
 def match_key(name, func=None, fallback=None, default=None):
     """Predicate that returns a value used for dispatching.
@@ -57,9 +76,12 @@ def match_key(name, func=None, fallback=None, default=None):
     """
     if func is None:
         get_key = itemgetter(name)
+        key_template = '{name}'
     else:
         get_key = lambda d: func(**d)
-    return Predicate(name, KeyIndex, get_key, fallback, default)
+        key_template = None
+    return Predicate(name, KeyIndex, get_key, fallback, default,
+                     key_template)
 
 
 def match_instance(name, func=None, fallback=None, default=None):
@@ -78,9 +100,12 @@ def match_instance(name, func=None, fallback=None, default=None):
     """
     if func is None:
         get_key = lambda d: d[name].__class__
+        key_template = '{name}.__class__'
     else:
         get_key = lambda d: func(**d).__class__
-    return Predicate(name, ClassIndex, get_key, fallback, default)
+        key_template = None
+    return Predicate(name, ClassIndex, get_key, fallback, default,
+                     key_template)
 
 
 def match_class(name, func=None, fallback=None, default=None):
@@ -99,20 +124,59 @@ def match_class(name, func=None, fallback=None, default=None):
     """
     if func is None:
         get_key = itemgetter(name)
+        key_template = '{name}'
     else:
         get_key = lambda d: func(**d)
-    return Predicate(name, ClassIndex, get_key, fallback, default)
+        key_template = None
+    return Predicate(name, ClassIndex, get_key, fallback, default,
+                     key_template)
 
 
 _emptyset = frozenset()
 
 
 class KeyIndex(dict):
+    """Index of values by key.
+
+    Maps each key to the values registered for it. These are stored
+    as a bitmask, see :class:`reg.predicate.PredicateRegistry`.
+    """
+    empty = 0
+
     def __init__(self, fallback=None):
         self.fallback = fallback
 
     def __missing__(self, key):
-        return _emptyset
+        return self.empty
+
+    def add(self, key, match):
+        """Add values to the entry of a key.
+
+        :param key: the key to add values for.
+        :param match: the values to add, as a bitmask or a set.
+        """
+        entry = self.get(key)
+        if entry is None:
+            self[key] = match
+        else:
+            entry |= match
+            self[key] = entry
+
+    def remove(self, key, match):
+        """Remove values from the entry of a key.
+
+        The key is removed from the index once no values are left.
+
+        :param key: the key to remove values for.
+        :param match: the values to remove, as a bitmask or a set.
+        """
+        entry = self[key]
+        # this works for both bitmasks and sets
+        entry = entry ^ (entry & match)
+        if entry:
+            self[key] = entry
+        else:
+            del self[key]
 
     def permutations(self, key):
         """Permutations for a simple immutable key.
@@ -121,8 +185,50 @@ class KeyIndex(dict):
         """
         yield key
 
+    def registered_permutations(self, key):
+        """Permutations for key that are in the index.
+
+        :returns: a sequence of permutations of the key, in the same
+          order as :meth:`permutations`.
+        """
+        return (key,) if key in self else ()
+
+    def is_permutation(self, key, permutation):
+        """Whether a key is among the permutations of another one.
+
+        :param key: the key to compute the permutations of.
+        :param permutation: the key to look for.
+        """
+        return permutation in self.permutations(key)
+
 
 class ClassIndex(KeyIndex):
+    def __init__(self, fallback=None):
+        super(ClassIndex, self).__init__(fallback)
+        # weakly keyed, so that we don't keep classes created on the
+        # fly alive.
+        self._registered_mro = WeakKeyDictionary()
+
+    def add(self, key, match):
+        """Add values to the entry of a key.
+
+        :param key: the class to add values for.
+        :param match: the values to add, as a bitmask or a set.
+        """
+        if key not in self:
+            self._registered_mro.clear()
+        super(ClassIndex, self).add(key, match)
+
+    def remove(self, key, match):
+        """Remove values from the entry of a key.
+
+        :param key: the class to remove values for.
+        :param match: the values to remove, as a bitmask or a set.
+        """
+        super(ClassIndex, self).remove(key, match)
+        if key not in self:
+            self._registered_mro.clear()
+
     def permutations(self, key):
         """Permutations for class key.
 
@@ -135,12 +241,54 @@ class ClassIndex(KeyIndex):
         if class_ is not object:
             yield object  # pragma: no cover
 
+    def registered_permutations(self, key):
+        """Permutations for class key that are in the index.
+
+        These are the class and its base classes in mro order, except
+        for those that are not in the index. They are cached per class.
+        """
+        try:
+            return self._registered_mro[key]
+        except KeyError:
+            result = self._registered_mro[key] = tuple(
+                class_ for class_ in self.permutations(key)
+                if class_ in self)
+            return result
+
 
 class PredicateRegistry(object):
+    """Registry of values by predicate keys.
+
+    Each distinct value gets its own bit, and the indexes map keys to
+    bitmasks of values. Finding the values registered for a
+    combination of keys is then a matter of and-ing integers, and the
+    lowest bit set gives the value registered first.
+
+    The bitmasks of an index take memory in proportion to the number
+    of its keys times the number of values, so once more than
+    :attr:`max_bitmask_values` distinct values are registered the
+    indexes switch to sets of values instead. The bits of values that
+    are unregistered are reused before that happens.
+
+    Key lookups that cache the results of the registry can
+    :meth:`subscribe` to be told about changes of registrations.
+    """
+
+    max_bitmask_values = 4096
 
     def __init__(self, *predicates):
-        self.known_keys = set()
-        self.known_values = set()
+        # map the registered keys to their values, so that an exact
+        # match can be found without searching through permutations
+        self.known_keys = {}
+        # the values by bit number and the bits by value, or None if
+        # we use sets of values instead of bitmasks. We don't need the
+        # bits by value anymore once frozen. Values that are no longer
+        # registered leave None behind until the bits are renumbered.
+        self.values = []
+        self.value_bits = {}
+        self.known_values = 0
+        self.frozen = False
+        self.subscribers = []
         self.predicates = predicates
         self.indexes = [predicate.create_index() for predicate in predicates]
         key_getters = [p.get_key for p in predicates]
@@ -159,22 +307,245 @@ class PredicateRegistry(object):
             self.key = lambda **kw: tuple([p(kw) for p in key_getters])
 
     def register(self, key, value):
-        if key in self.known_keys:
+        self.register_many([(key, value)])
+
+    def register_many(self, items):
+        """Register values for many keys at once.
+
+        This has the same effect as calling :meth:`register` for each
+        key, but adds to the entries of the indexes only once per key
+        item. Nothing is registered if any of the keys is registered
+        already, or occurs more than once.
+
+        :param items: an iterable of keys and values.
+        """
+        items = list(items)
+        if self.frozen:
+            raise RegistrationError(
+                "Cannot register for key %s: registry is frozen" % ', '.join(
+                    '%s' % (key,) for key, value in items))
+        known_keys = self.known_keys
+        keys = set()
+        duplicates = []
+        for key, value in items:
+            if key in known_keys or key in keys:
+                duplicates.append(key)
+            keys.add(key)
+        if len(duplicates) == 1:
+            raise RegistrationError(
+                "Already have registration for key: %s" % (duplicates[0],))
+        if duplicates:
+            raise RegistrationError(
+                "Already have registrations for keys: %s" % ', '.join(
+                    '%s' % (key,) for key in duplicates))
+
+        value_bits = self.value_bits
+        if value_bits is not None:
+            # a list for the order of the bits, a set to find them fast
+            new_values = []
+            seen = set()
+            for key, value in items:
+                if value not in value_bits and value not in seen:
+                    seen.add(value)
+                    new_values.append(value)
+            limit = self.max_bitmask_values - len(new_values)
+            if new_values and len(self.values) > limit:
+                self._renumber()
+            if len(self.values) <= limit:
+                for value in new_values:
+                    value_bits[value] = 1 << len(self.values)
+                    self.values.append(value)
+            else:
+                self._use_sets()
+                value_bits = None
+
+        # combine the values per key item, so that we add to each
+        # entry of the indexes once
+        entries = [{} for index in self.indexes]
+        if value_bits is None:
+            for key, value in items:
+                for entry, key_item in zip(entries, key):
+                    match = entry.get(key_item)
+                    if match is None:
+                        entry[key_item] = set([value])
+                    else:
+                        match.add(value)
+                self.known_values.add(value)
+        else:
+            known_values = self.known_values
+            for key, value in items:
+                bit = value_bits[value]
+                for entry, key_item in zip(entries, key):
+                    entry[key_item] = entry.get(key_item, 0) | bit
+                known_values |= bit
+            self.known_values = known_values
+        for index, entry in zip(self.indexes, entries):
+            for key_item, match in entry.items():
+                index.add(key_item, match)
+        for key, value in items:
+            known_keys[key] = value
+            self._changed(key)
+
+    def unregister(self, key):
+        """Remove the registration for a key.
+
+        :param key: the key that was passed to :meth:`register`.
+        :returns: the value that was registered for the key.
+        """
+        if self.frozen:
             raise RegistrationError(
-                "Already have registration for key: %s" % (key,))
-        for index, key_item in zip(self.indexes, key):
-            index.setdefault(key_item, set()).add(value)
-        self.known_keys.add(key)
-        self.known_values.add(value)
+                "Cannot unregister key %s: registry is frozen" % (key,))
+        try:
+            value = self.known_keys.pop(key)
+        except KeyError:
+            raise RegistrationError(
+                "No registration for key: %s" % (key,))
+        # the value may also be registered for other keys, which share
+        # its entries in the indexes.
+        others = [k for k, v in self.known_keys.items() if v == value]
+        if self.value_bits is None:
+            match = set([value])
+        else:
+            match = self.value_bits[value]
+        for i, (index, key_item) in enumerate(zip(self.indexes, key)):
+            if key_item not in [k[i] for k in others]:
+                index.remove(key_item, match)
+        if not others:
+            # this works for both bitmasks and sets
+            self.known_values -= match
+            if self.value_bits is not None:
+                del self.value_bits[value]
+                self.values[match.bit_length() - 1] = None
+        self._changed(key)
+        return value
+
+    def _renumber(self):
+        """Renumber the bits of values, dropping unregistered values."""
+        renumbered = {}
+        values = []
+        for i, value in enumerate(self.values):
+            if value is not None:
+                renumbered[1 << i] = self.value_bits[value] = 1 << len(values)
+                values.append(value)
+        if len(values) == len(self.values):
+            return
+        self.values = values
+
+        def renumber(bits):
+            result = 0
+            while bits:
+                lowest = bits & -bits
+                result |= renumbered[lowest]
+                bits ^= lowest
+            return result
+
+        for index in self.indexes:
+            for key, bits in index.items():
+                index[key] = renumber(bits)
+        self.known_values = renumber(self.known_values)
+
+    def _use_sets(self):
+        """Switch the indexes from bitmasks to sets of values."""
+        for index in self.indexes:
+            for key, bits in index.items():
+                index[key] = set(self.values_of(bits))
+            index.empty = _emptyset
+        self.known_values = set(self.values_of(self.known_values))
+        self.values = self.value_bits = None
+
+    def subscribe(self, callback):
+        """Get notified of changes of registrations.
+
+        :param callback: a function that gets called with the key
+          after each :meth:`register` and :meth:`unregister`.
+        """
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        """Stop getting notified of changes of registrations.
+
+        :param callback: a function passed to :meth:`subscribe`.
+        """
+        self.subscribers.remove(callback)
+
+    def _changed(self, key):
+        for callback in self.subscribers:
+            callback(key)
+
+    def is_affected(self, keys, changed):
+        """Whether a change of registration can affect a lookup.
+
+        Lookups only depend on the entries of the indexes for the
+        permutations of their keys. As the fallback depends on the
+        entries of each index separately, a lookup is affected as soon
+        as any of the keys of the change is among those permutations.
+
+        :param keys: the key of the lookup.
+        :param changed: the key that was registered or unregistered.
+        :returns: ``True`` if the results of :meth:`component`,
+          :meth:`fallback`, :meth:`all` and :meth:`target` for ``keys``
+          may have changed.
+        """
+        if not self.indexes:
+            return True
+        for index, key, changed_key in zip(self.indexes, keys, changed):
+            if index.is_permutation(key, changed_key):
+                return True
+        return False
+
+    def freeze(self):
+        """Make the registry immutable.
+
+        Registering raises :exc:`reg.RegistrationError` afterwards. This
+        lets the registry drop the data it only needs for registration,
+        and replace the sets of values, if in use, by frozen sets.
+        The registered keys become a read-only mapping, so that lookups
+        with a key that was registered exactly still skip the indexes.
+        """
+        if self.values is None:
+            for index in self.indexes:
+                for key, values in index.items():
+                    index[key] = frozenset(values)
+            self.known_values = frozenset(self.known_values)
+        else:
+            self.values = tuple(self.values)
+        self.value_bits = None
+        self.known_keys = MappingProxyType(self.known_keys)
+        self.frozen = True
 
     def get(self, keys):
-        # do an intersection of all sets that result from index lookup
-        # this code is a bit convoluted for performance reasons.
-        sets = (
-            index[key] for index, key in zip(self.indexes, keys))
-        # besides doing the intersection,
-        # this returns the known values if there are no indexes at all
-        return next(sets, self.known_values).intersection(*sets)
+        if self.values is None:
+            # do an intersection of all sets that result from index
+            # lookup; this code is a bit convoluted for performance
+            # reasons.
+            sets = (
+                index[key] for index, key in zip(self.indexes, keys))
+            # besides doing the intersection,
+            # this returns the known values if there are no indexes at all
+            return next(sets, self.known_values).intersection(*sets)
+        result = self.known_values
+        for index, key in zip(self.indexes, keys):
+            result &= index[key]
+        return result
+
+    def values_of(self, match):
+        """Iterate over the values in a match.
+
+        :param match: a bitmask or set of values, as returned by
+          :meth:`get`.
+        :returns: an iterator over the values, in order of registration
+          if bitmasks are in use.
+        """
+        if self.values is None:
+            return iter(match)
+        return self._bit_values(match)
+
+    def _bit_values(self, bits):
+        values = self.values
+        while bits:
+            lowest = bits & -bits
+            yield values[lowest.bit_length() - 1]
+            bits ^= lowest
 
     def permutations(self, keys):
         return product(*(
@@ -205,12 +576,15 @@ class PredicateRegistry(object):
         return tuple([p.key_by_predicate_name(d) for p in self.predicates])
 
     def component(self, keys):
+        value = self.known_keys.get(keys)
+        if value is not None:
+            return value
         return next(self.all(keys), None)
 
     def fallback(self, keys):
         result = None
         for index, key in zip(self.indexes, keys):
-            for k in index.permutations(key):
+            for k in index.registered_permutations(key):
                 match = index[k]
                 if match:
                     break
@@ -220,13 +594,123 @@ class PredicateRegistry(object):
             if result is None:
                 result = match
             else:
-                result = result.intersection(match)
+                result = result & match
             # as soon as the intersection becomes empty, we have a failed
             # match
             if not result:
                 return index.fallback
 
     def all(self, key):
-        for p in self.permutations(key):
-            for value in self.get(p):
+        # We go through the permutations that are in the indexes in
+        # the order of product(), one index at a time, keeping the
+        # intersection of the matches so far. As soon as that is empty
+        # we skip all permutations that start with the same keys.
+        indexes = self.indexes
+        permutations = [index.registered_permutations(k)
+                        for index, k in zip(indexes, key)]
+        depth = len(indexes)
+        if not depth:
+            for value in self.values_of(self.known_values):
                 yield value
+            return
+        matches = [None]
+        iterators = [iter(permutations[0])]
+        while iterators:
+            i = len(iterators) - 1
+            index = indexes[i]
+            match = matches[i]
+            for k in iterators[i]:
+                result = index[k] if match is None else match & index[k]
+                if result:
+                    break
+            else:
+                # this index has no more permutations, so backtrack
+                iterators.pop()
+                matches.pop()
+                continue
+            if i + 1 == depth:
+                for value in self.values_of(result):
+                    yield value
+            else:
+                matches.append(result)
+                iterators.append(iter(permutations[i + 1]))
+
+    def resolve(self, keys):
+        """Find both the component and the fallback for keys.
+
+        This gives the same results as :meth:`component` and
+        :meth:`fallback`, but in a single search through the
+        permutations of the keys.
+
+        :param keys: a tuple, as returned by :meth:`key`.
+        :returns: a ``(component, fallback)`` tuple.
+        """
+        component = self.known_keys.get(keys)
+        if component is not None:
+            # if a key is registered, it is also what fallback finds
+            # first for each of the indexes, so there is no fallback.
+            return component, None
+        # We do the same search as all, but we also follow the path of
+        # fallback: for each index the first permutation that has any
+        # match at all. We are on that path as long as greedy is true,
+        # and the fallback is found where we leave it.
+        indexes = self.indexes
+        depth = len(indexes)
+        if not depth:
+            return next(self.values_of(self.known_values), None), None
+        permutations = [index.registered_permutations(k)
+                        for index, k in zip(indexes, keys)]
+        fallback = None
+        greedy = True
+        matches = [None]
+        iterators = [iter(permutations[0])]
+        while iterators:
+            i = len(iterators) - 1
+            index = indexes[i]
+            match = matches[i]
+            for k in iterators[i]:
+                entry = index[k]
+                result = entry if match is None else match & entry
+                if result:
+                    break
+                if greedy and entry:
+                    # fallback picks this permutation, but the
+                    # intersection is empty.
+                    greedy = False
+                    fallback = index.fallback
+            else:
+                if greedy:
+                    # fallback finds no matching permutation
+                    greedy = False
+                    fallback = index.fallback
+                iterators.pop()
+                matches.pop()
+                continue
+            if i + 1 == depth:
+                return next(self.values_of(result)), fallback
+            matches.append(result)
+            iterators.append(iter(permutations[i + 1]))
+        return None, fallback
+
+    def target(self, keys, default=None):
+        """The callable a dispatch function calls for a key.
+
+        This is the component if there is one, otherwise the fallback
+        of the predicates, otherwise ``default``.
+
+        :param keys: a tuple, as returned by :meth:`key`.
+        :param default: the callable to use if neither a component nor
+          a fallback can be found.
+        :returns: the callable to dispatch to.
+        """
+        component, fallback = self.resolve(keys)
+        return component or fallback or default
+
+    def target_lookup(self, default):
+        """Construct a function to look up targets of dispatch calls.
+
+        :param default: the default callable, see :meth:`target`.
+        :returns: a function that takes a key and returns the callable
+          to dispatch to.
+        """
+        return partial(self.target, default=default)
@@ -0,0 +1,245 @@
+"""Snapshots of dispatch tables, for fast startup.
+
+An application that registers many implementations at startup, and
+then resolves the dispatch keys it is called with, can write the
+result to a Python module with :func:`write_snapshot`. At the next
+startup, :func:`load_snapshot` restores the dispatch functions from
+that module instead, unless the modules it refers to have changed
+since it was written.
+
+The registrations themselves cannot tell whether a snapshot is
+stale, as loading the snapshot is what replaces making them. A
+snapshot only knows the modules of the dispatch functions, classes
+and implementations it refers to, and the modules you pass to
+:func:`write_snapshot`. This list must be complete: a change to a
+module that is not on it, such as one that registers an existing
+implementation for another class, goes unnoticed.
+
+A snapshot refers to the dispatch functions, to the classes and to
+the implementations by dotted name, so it can only contain objects
+that can be imported by name. The dispatch functions must not have
+registrations when the snapshot is loaded, so this works for
+applications that register implementations in a configuration step,
+and not when their modules are imported.
+"""
+from __future__ import unicode_literals
+import ast
+import hashlib
+import importlib
+import io
+import os
+from types import ModuleType
+
+VERSION = 1
+"""The version of the format of snapshots."""
+
+
+def write_snapshot(filename, names, classes=None, modules=()):
+    """Write a snapshot of dispatch functions to a Python module.
+
+    The snapshot contains the registrations of the dispatch functions
+    and their dispatch tables for combinations of classes, as
+    :meth:`reg.Dispatch.warm` would look them up.
+
+    :param filename: the file to write the module to.
+    :param names: the dotted names of the dispatch functions. Refer to
+      dispatch methods through the class on which they are used, such
+      as ``'myapp.App.view'``.
+    :param classes: optional sequence of classes to include the
+      dispatch table for. See :meth:`reg.Dispatch.warm`.
+    :param modules: optional names of other modules that affect the
+      registrations, such as the modules that register
+      implementations. The snapshot is stale once any of the modules
+      it refers to has changed. Pass all modules that register
+      implementations or decide what is registered, as changes to
+      other modules are not noticed.
+    """
+    writer = _Writer()
+    writer.modules.update(modules)
+    if classes is not None:
+        classes = list(classes)
+    entries = []
+    for name in names:
+        module, path = _split(name)
+        func = _resolve(module, path)
+        if not hasattr(func, 'snapshot'):
+            raise ValueError("%s is not a dispatch function" % name)
+        func_source = writer.reference(module, path)
+        registrations, targets = func.snapshot(classes=classes)
+        lines = ['    ({0}, ['.format(func_source)]
+        for key, value in registrations:
+            lines.append('        ({0}, {1}),'.format(
+                writer.key(key), writer.value(value, func, func_source)))
+        lines.append('    ], [')
+        for key, target in targets:
+            lines.append('        ({0}, {1}),'.format(
+                writer.key(key), writer.value(target, func, func_source)))
+        lines.append('    ]),')
+        entries.extend(lines)
+    modules = sorted(writer.modules)
+    source = [
+        '# -*- coding: utf-8 -*-',
+        '# Snapshot of dispatch tables written by reg.write_snapshot.',
+        '# Do not edit.',
+        '',
+        'VERSION = {0!r}'.format(VERSION),
+        '',
+        'FINGERPRINT = {0!r}'.format(fingerprint(modules)),
+        '',
+        'MODULES = [',
+    ]
+    source.extend('    {0!r},'.format(module) for module in modules)
+    source.extend([']', '', '', 'def dispatches():'])
+    source.extend(writer.imports)
+    source.append('    return [')
+    source.extend('    ' + line for line in entries)
+    source.append('    ]')
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(source) + '\n')
+
+
+def load_snapshot(name):
+    """Restore dispatch functions from a snapshot.
+
+    See :meth:`reg.Dispatch.restore`.
+
+    :param name: the dotted name of the module the snapshot was
+      written to with :func:`write_snapshot`.
+    :returns: ``True`` if the snapshot was loaded, or ``False`` if it
+      doesn't exist or is stale, in which case you should register
+      the implementations as usual.
+    :raises: :exc:`reg.RegistrationError` if a dispatch function
+      already has registrations for the keys of the snapshot, or is
+      frozen. No dispatch function is restored then.
+    """
+    try:
+        snapshot = importlib.import_module(name)
+    except ImportError:
+        return False
+    if getattr(snapshot, 'VERSION', None) != VERSION:
+        return False
+    try:
+        dispatches = snapshot.dispatches()
+    except (ImportError, AttributeError):
+        # a module, class or implementation was renamed
+        return False
+    if fingerprint(snapshot.MODULES) != snapshot.FINGERPRINT:
+        return False
+    # check all dispatch functions first, so that we either restore
+    # all of them or none
+    for func, registrations, targets in dispatches:
+        func.check_restore(registrations)
+    for func, registrations, targets in dispatches:
+        func.restore(registrations, targets)
+    return True
+
+
+def fingerprint(modules):
+    """Fingerprint of the source files of modules.
+
+    This uses the modification time and the size of the files, like
+    the byte code cache of Python does. Only the files of the given
+    modules are considered, so the list must include every module
+    that affects the registrations.
+
+    :param modules: the names of modules, which are imported.
+    :returns: a hexadecimal string.
+    """
+    result = hashlib.sha1()
+    for name in modules:
+        filename = getattr(importlib.import_module(name), '__file__', None)
+        if filename is None:
+            stat = '-'
+        else:
+            s = os.stat(filename)
+            stat = '{0!r} {1}'.format(s.st_mtime, s.st_size)
+        result.update('{0} {1}\n'.format(name, stat).encode('utf-8'))
+    return result.hexdigest()
+
+
+def _split(name):
+    """Split a dotted name into the name of a module and a path in it.
+
+    :returns: the name of the module and a list of attribute names.
+    """
+    parts = name.split('.')
+    module = parts[0]
+    obj = importlib.import_module(module)
+    path = []
+    for part in parts[1:]:
+        if not path:
+            attr = getattr(obj, part, None)
+            if attr is None or isinstance(attr, ModuleType):
+                module = module + '.' + part
+                obj = importlib.import_module(module)
+                continue
+        obj = getattr(obj, part)
+        path.append(part)
+    return module, path
+
+
+def _resolve(module, path):
+    obj = importlib.import_module(module)
+    for part in path:
+        obj = getattr(obj, part)
+    return obj
+
+
+class _Writer(object):
+    """Writes the source of the objects in a snapshot.
+
+    Objects that are referred to by name are imported with aliases in
+    the ``dispatches`` function of the snapshot.
+    """
+
+    def __init__(self):
+        self.modules = set()
+        self.aliases = {}
+        self.imports = []
+
+    def reference(self, module, path):
+        """The source referring to an object in a module."""
+        self.modules.add(module)
+        alias = self.aliases.get((module, path[0]))
+        if alias is None:
+            alias = '_{0}'.format(len(self.aliases))
+            self.aliases[module, path[0]] = alias
+            self.imports.append('    from {0} import {1} as {2}'.format(
+                module, path[0], alias))
+        return '.'.join([alias] + path[1:])
+
+    def key(self, key):
+        """The source of a dispatch key."""
+        items = [self.value(item) for item in key]
+        if len(items) == 1:
+            return '({0},)'.format(items[0])
+        return '({0})'.format(', '.join(items))
+
+    def value(self, value, func=None, func_source=None):
+        """The source of a key item, implementation or target.
+
+        :param func: the dispatch function, whose wrapped function is
+          the default target.
+        :param func_source: the source of the dispatch function.
+        """
+        if func is not None and value is func.wrapped_func:
+            return func_source + '.wrapped_func'
+        if not hasattr(value, '__name__'):
+            source = repr(value)
+            try:
+                if ast.literal_eval(source) == value:
+                    return source
+            except (ValueError, SyntaxError):
+                pass
+            raise ValueError(
+                "Cannot write %r to a snapshot" % (value,))
+        module = getattr(value, '__module__', None)
+        path = getattr(value, '__qualname__', value.__name__).split('.')
+        try:
+            found = _resolve(module, path)
+        except (ImportError, AttributeError, TypeError, ValueError):
+            found = None
+        if found is not value:
+            raise ValueError(
+                "Cannot refer to %r by its name in a snapshot" % (value,))
+        return self.reference(module, path)
@@ -0,0 +1,49 @@
+"Sample application for testing snapshots."
+
+from reg import dispatch, dispatch_method, match_key
+
+
+class Model(object):
+    pass
+
+
+class Document(Model):
+    pass
+
+
+class Image(Model):
+    pass
+
+
+@dispatch('obj', match_key('format'))
+def render(obj, format):
+    return "default"
+
+
+def render_document(obj, format):
+    return "document"
+
+
+def render_json(obj, format):
+    return "json"
+
+
+class App(object):
+    @dispatch_method('obj')
+    def view(self, obj):
+        return "default"
+
+
+def document_view(app, obj):
+    return "document view"
+
+
+def register():
+    render.register(render_document, obj=Document, format='html')
+    render.register(render_json, obj=Model, format='json')
+    App.view.register(document_view, obj=Document)
+
+
+def clean():
+    render.clean()
+    App.view.clean()
@@ -1,3 +1,6 @@
+import inspect
+import sys
+from functools import partial
 import pytest
 from ..arginfo import arginfo
 
@@ -329,3 +332,114 @@ def test_arginfo_cache_callable():
     assert not arginfo.is_cached(foo)
     arginfo(foo)
     assert arginfo.is_cached(foo)
+
+
+def define(source):
+    """Define a function with syntax Python 2 cannot parse."""
+    namespace = {}
+    exec(source, namespace)
+    return namespace['f']
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="needs Python 3")
+def test_arginfo_kwonlyargs():
+    info = arginfo(define("def f(a, *args, b, c=2, **kw): pass"))
+    assert info.args == ['a']
+    assert info.varargs == 'args'
+    assert info.keywords == 'kw'
+    assert info.defaults is None
+    assert info.kwonlyargs == ['b', 'c']
+    assert info.kwonlydefaults == {'c': 2}
+    assert info.posonlyargs == []
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="needs Python 3.8")
+def test_arginfo_posonlyargs():
+    info = arginfo(define("def f(a, b=1, /, c=2): pass"))
+    assert info.args == ['a', 'b', 'c']
+    assert info.defaults == (1, 2)
+    assert info.posonlyargs == ['a', 'b']
+
+
+def test_arginfo_builtin_function():
+    info = arginfo(divmod)
+    assert info.args == ['x', 'y']
+    assert info.varargs is None
+    assert info.keywords is None
+
+
+def test_arginfo_partial():
+    def foo(a, b, c=1, d=2):
+        pass
+
+    assert arginfo(partial(foo, 1)) == (
+        ['b', 'c', 'd'], None, None, (1, 2), [], None, [])
+    assert arginfo(partial(foo, 1, c=3)) == (
+        ['b'], None, None, None, ['c', 'd'], {'c': 3, 'd': 2}, [])
+
+
+def test_arginfo_cache_code():
+    class Foo(object):
+        def method(self, a):
+            pass
+
+    assert not arginfo.is_cached(Foo().method)
+    arginfo(Foo().method)
+    assert arginfo.is_cached(Foo.method)
+    assert arginfo.is_cached(partial(Foo().method, 1))
+    assert not arginfo.is_cached(divmod)
+
+
+def test_arginfo_same_code_defaults():
+    def make(default):
+        def foo(a=default):
+            pass
+        return foo
+
+    assert arginfo(make(1)).defaults == (1,)
+    assert arginfo(make(2)).defaults == (2,)
+
+
+def test_arginfo_builtin_init():
+    class Foo(dict):
+        pass
+
+    info = arginfo(Foo)
+    assert info.args == []
+    assert info.varargs == 'args'
+    assert info.keywords == 'kwargs'
+    assert info.posonlyargs == []
+
+
+def test_arginfo_builtin_no_signature():
+    with pytest.raises(TypeError):
+        arginfo(getattr)
+
+
+def test_arginfo_builtin_signature():
+    info = arginfo(sorted)
+    assert info.args == ['iterable']
+    assert info.posonlyargs == ['iterable']
+    assert info.kwonlyargs == ['key', 'reverse']
+    assert info.kwonlydefaults == {'key': None, 'reverse': False}
+    assert arginfo(round).defaults == (None,)
+
+
+def test_arginfo_signature_error(monkeypatch):
+    def signature(callable):
+        raise AttributeError("broken")
+
+    monkeypatch.setattr(inspect, 'signature', signature)
+    # an error of inspect.signature is not mistaken for Python 2
+    with pytest.raises(AttributeError):
+        arginfo(sorted)
+
+
+def test_arginfo_cache_class():
+    class Foo(object):
+        def __init__(self, a):
+            pass
+
+    assert not arginfo.is_cached(Foo)
+    arginfo(Foo)
+    assert arginfo.is_cached(Foo)
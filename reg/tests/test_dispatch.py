@@ -1,9 +1,17 @@
 from __future__ import unicode_literals
+from types import ModuleType
+from weakref import WeakSet
+import gc
+import sys
+import traceback
 import pytest
 
 from ..predicate import match_instance, match_key, match_class
-from ..dispatch import dispatch
+from ..dispatch import (dispatch, warm_dispatches, prefork,
+                        MAX_SPECIALIZATIONS, MAX_COUNTED_KEYS)
+from ..cache import DictCachingKeyLookup, FrozenCache
 from ..error import RegistrationError
+from ..arginfo import arginfo
 
 
 class IAlpha(object):
@@ -955,6 +963,102 @@ def test_dispatch_clean():
     assert foo(Qux()) == "default"
 
 
+def test_dispatch_freeze():
+    @dispatch('obj')
+    def foo(obj):
+        return "default"
+
+    class Bar(object):
+        pass
+
+    class Qux(object):
+        pass
+
+    foo.register(lambda obj: "bar", obj=Bar)
+    foo.freeze()
+
+    assert foo(Bar()) == "bar"
+    assert foo(Qux()) == "default"
+
+    with pytest.raises(RegistrationError):
+        foo.register(lambda obj: "qux", obj=Qux)
+    with pytest.raises(RegistrationError):
+        foo.add_predicates([match_key('name')])
+    assert foo(Qux()) == "default"
+
+    foo.clean()
+    foo.register(lambda obj: "qux", obj=Qux)
+
+    assert foo(Bar()) == "default"
+    assert foo(Qux()) == "qux"
+
+
+def test_dispatch_register_many():
+    @dispatch(match_instance('obj'), match_key('name'))
+    def foo(obj, name):
+        return "default"
+
+    def alpha(obj, name):
+        return "alpha"
+
+    def beta(obj, name):
+        return "beta"
+
+    foo.register_many([
+        (alpha, dict(obj=Alpha, name='x')),
+        (alpha, dict(obj=Alpha, name='y')),
+        dict(func=beta, obj=Beta, name='x'),
+    ])
+    assert foo(Alpha(), 'x') == "alpha"
+    assert foo(Alpha(), 'y') == "alpha"
+    assert foo(Beta(), 'x') == "beta"
+    assert foo(Beta(), 'y') == "default"
+
+
+def test_dispatch_register_many_fails():
+    @dispatch(match_instance('obj'), match_key('name'))
+    def foo(obj, name):
+        return "default"
+
+    def alpha(obj, name):
+        return "alpha"
+
+    def wrong(obj):
+        return "wrong"
+
+    with pytest.raises(RegistrationError):
+        foo.register_many([
+            (alpha, dict(obj=Alpha, name='x')),
+            (wrong, dict(obj=Beta, name='x'))])
+    with pytest.raises(RegistrationError):
+        foo.register_many([dict(obj=Alpha, name='x')])
+    with pytest.raises(RegistrationError):
+        foo.register_many([
+            (alpha, dict(obj=Alpha, name='x')),
+            (alpha, dict(obj=Alpha, name='x'))])
+    assert foo(Alpha(), 'x') == "default"
+
+
+def test_dispatch_unregister():
+    @dispatch('obj')
+    def foo(obj):
+        return "default"
+
+    class Bar(object):
+        pass
+
+    def for_bar(obj):
+        return "bar"
+
+    foo.register(for_bar, obj=Bar)
+    assert foo(Bar()) == "bar"
+    assert foo.unregister(obj=Bar) is for_bar
+    assert foo(Bar()) == "default"
+
+    with pytest.raises(RegistrationError):
+        foo.unregister(obj=Bar)
+
+
 def test_dispatch_clean_add_predicates():
     @dispatch()
     def foo(obj):
@@ -1083,3 +1187,501 @@ def test_predicate_key_wrong_keyword_argument_gives_typeerror():
 
     with pytest.raises(TypeError):
         assert foo.by_args(wrong=1)
+
+
+def test_dispatch_inline_key():
+    @dispatch('obj', match_key('name'), match_class('cls'))
+    def foo(obj, name, cls):
+        return "default"
+
+    foo.register(lambda obj, name, cls: "Alpha", obj=Alpha, name='x',
+                 cls=IBeta)
+
+    assert '_registry_key' not in foo.__code__.co_names
+    assert foo(Alpha(), 'x', Beta) == "Alpha"
+    assert foo(Alpha(), 'y', Beta) == "default"
+    assert foo.by_args(Alpha(), 'x', Beta).key == (Alpha, 'x', Beta)
+
+
+def test_dispatch_inline_key_mixed_with_custom_predicate():
+    @dispatch('obj', match_key('name', lambda obj, extra: extra))
+    def foo(obj, extra):
+        return "default"
+
+    foo.register(lambda obj, extra: "Alpha", obj=Alpha, name='x')
+
+    assert '_registry_key' in foo.__code__.co_names
+    assert foo(Alpha(), 'x') == "Alpha"
+    assert foo(Alpha(), 'y') == "default"
+
+
+def test_dispatch_add_predicates_keep_registrations():
+    @dispatch(match_instance('obj'))
+    def foo(obj, name, request_method):
+        return "default"
+
+    code = foo.__code__
+    foo.register(lambda obj, name, request_method: "Alpha", obj=Alpha)
+    foo.register(lambda obj, name, request_method: "Beta", obj=Beta)
+    foo.add_predicates([match_key('name', default=''),
+                        match_key('request_method', default='GET')],
+                       keep_registrations=True)
+    assert foo.__code__ is not code
+
+    foo.register(lambda obj, name, request_method: "Alpha edit",
+                 obj=Alpha, name='edit')
+    assert foo(Alpha(), '', 'GET') == "Alpha"
+    assert foo(Beta(), '', 'GET') == "Beta"
+    assert foo(Alpha(), 'edit', 'GET') == "Alpha edit"
+    assert foo(Alpha(), 'edit', 'POST') == "default"
+    assert foo(Beta(), 'edit', 'GET') == "default"
+    with pytest.raises(RegistrationError):
+        foo.register(lambda obj, name, request_method: "Alpha again",
+                     obj=Alpha)
+
+
+def test_dispatch_add_predicates_keeps_function():
+    @dispatch()
+    def foo(obj):
+        return "default"
+
+    code = foo.__code__
+    foo.add_predicates([match_instance('obj')])
+    assert foo.__code__ is not code
+
+    foo.register(lambda obj: "Alpha", obj=Alpha)
+    assert foo(Alpha()) == "Alpha"
+    assert foo(Beta()) == "default"
+
+
+def test_dispatch_specialize():
+    @dispatch('obj', specialize_threshold=3)
+    def foo(obj):
+        return "default"
+
+    foo.register(lambda obj: "Alpha", obj=Alpha)
+
+    code = foo.__code__
+    assert foo(Alpha()) == "Alpha"
+    assert foo(Alpha()) == "Alpha"
+    assert foo.__code__ is code
+    assert foo(Alpha()) == "Alpha"
+    assert foo.__code__ is not code
+    assert '_target_0' in foo.__code__.co_names
+    assert foo(Alpha()) == "Alpha"
+    assert foo(Beta()) == "default"
+    assert foo(None) == "default"
+
+
+def test_dispatch_specialize_register_despecializes():
+    @dispatch('obj', specialize_threshold=1)
+    def foo(obj):
+        return "default"
+
+    assert foo(Alpha()) == "default"
+    assert '_target_0' in foo.__code__.co_names
+
+    foo.register(lambda obj: "Alpha", obj=Alpha)
+    assert '_target_0' not in foo.__code__.co_names
+    assert foo(Alpha()) == "Alpha"
+    assert foo(Beta()) == "default"
+
+
+def test_dispatch_specialize_register_keeps_unaffected():
+    @dispatch('obj', specialize_threshold=1)
+    def foo(obj):
+        return "default"
+
+    foo.register(lambda obj: "Alpha", obj=Alpha)
+    assert foo(Alpha()) == "Alpha"
+    code = foo.__code__
+
+    foo.register(lambda obj: "Beta", obj=Beta)
+    assert foo.__code__ is code
+    assert foo(Beta()) == "Beta"
+
+    assert '_target_1' in foo.__code__.co_names
+
+    foo.unregister(obj=Alpha)
+    assert '_target_1' not in foo.__code__.co_names
+    assert foo(Alpha()) == "default"
+    assert foo(Beta()) == "Beta"
+
+
+def test_dispatch_specialize_clean_despecializes():
+    @dispatch('obj', specialize_threshold=1)
+    def foo(obj):
+        return "default"
+
+    foo.register(lambda obj: "Alpha", obj=Alpha)
+    assert foo(Alpha()) == "Alpha"
+    assert '_target_0' in foo.__code__.co_names
+
+    foo.clean()
+    assert '_target_0' not in foo.__code__.co_names
+    assert foo(Alpha()) == "default"
+
+
+def test_dispatch_specialize_key_values():
+    @dispatch('obj', match_key('name'), specialize_threshold=1)
+    def foo(obj, name):
+        return "default"
+
+    foo.register(lambda obj, name: "Alpha x", obj=Alpha, name='x')
+
+    assert foo(Alpha(), 'x') == "Alpha x"
+    assert foo(Alpha(), 'x') == "Alpha x"
+    assert foo(Alpha(), 'y') == "default"
+    assert foo(Beta(), 'x') == "default"
+
+
+def test_dispatch_specialize_custom_predicate():
+    @dispatch(match_key('name', lambda obj: obj.name),
+              specialize_threshold=2)
+    def foo(obj):
+        return "default"
+
+    class Named(object):
+        def __init__(self, name):
+            self.name = name
+
+    foo.register(lambda obj: "x", name='x')
+
+    assert foo(Named('x')) == "x"
+    assert foo(Named('x')) == "x"
+    assert '_target_0' in foo.__code__.co_names
+    assert foo(Named('x')) == "x"
+    assert foo(Named('y')) == "default"
+
+
+def test_dispatch_specialize_no_predicates():
+    @dispatch(specialize_threshold=1)
+    def foo():
+        return "default"
+
+    assert foo() == "default"
+    assert '_target_0' in foo.__code__.co_names
+    assert foo() == "default"
+
+
+def test_dispatch_specialize_max_specializations():
+    @dispatch(match_key('value'), specialize_threshold=1)
+    def foo(value):
+        return value
+
+    for i in range(MAX_SPECIALIZATIONS + 2):
+        assert foo(i) == i
+    names = foo.__code__.co_names
+    assert '_target_{0}'.format(MAX_SPECIALIZATIONS - 1) in names
+    assert '_target_{0}'.format(MAX_SPECIALIZATIONS) not in names
+    assert '_specialize' not in names
+    for i in range(MAX_SPECIALIZATIONS + 2):
+        assert foo(i) == i
+
+
+def test_dispatch_warm():
+    @dispatch(match_instance('obj'), match_key('name'),
+              get_key_lookup=DictCachingKeyLookup)
+    def foo(obj, name):
+        return "default"
+
+    foo.register(lambda obj, name: "Alpha x", obj=Alpha, name='x')
+    foo.register(lambda obj, name: "Beta y", obj=Beta, name='y')
+
+    assert foo.warm(classes=[Alpha, Beta]) == 4
+    targets = foo.key_lookup.target_cache
+    assert set(targets) == set([
+        (Alpha, 'x'), (Alpha, 'y'), (Beta, 'x'), (Beta, 'y')])
+    assert targets.misses == 4
+
+    assert foo.warm([(Alpha, 'z')]) == 1
+    assert (Alpha, 'z') in targets
+
+    assert foo(Alpha(), 'x') == "Alpha x"
+    assert foo(Alpha(), 'z') == "default"
+    assert targets.misses == 5
+
+
+def test_dispatch_warm_no_predicates():
+    @dispatch(get_key_lookup=DictCachingKeyLookup)
+    def foo():
+        return "default"
+
+    assert foo.warm(classes=[Alpha]) == 1
+    assert list(foo.key_lookup.target_cache) == [()]
+
+
+def test_dispatch_prefork():
+    @dispatch(match_instance('obj'), match_key('name'),
+              get_key_lookup=DictCachingKeyLookup, specialize_threshold=1)
+    def foo(obj, name):
+        return "default"
+
+    foo.register(lambda obj, name: "Alpha x", obj=Alpha, name='x')
+    foo.register(lambda obj, name: "Beta y", obj=Beta, name='y')
+    assert foo(Beta(), 'y') == "Beta y"
+    target_cache = foo.key_lookup.target_cache
+
+    assert foo.prefork(classes=[Alpha, Beta]) == 4
+    targets = foo.__globals__['_target_lookup'].__self__
+    assert isinstance(targets, FrozenCache)
+    assert set(targets) == set([
+        (Alpha, 'x'), (Alpha, 'y'), (Beta, 'x'), (Beta, 'y')])
+    names = foo.__code__.co_names
+    assert '_counts' not in names
+    # the specialization from before is kept
+    assert '_target_0' in names
+
+    assert foo(Alpha(), 'x') == "Alpha x"
+    assert foo(Beta(), 'y') == "Beta y"
+    assert foo(Beta(), 'z') == "default"
+    assert (Beta, 'z') not in targets
+    assert (Beta, 'z') in foo.key_lookup.target_cache
+    # misses go to the cache of the key lookup from before
+    assert foo.key_lookup.target_cache is target_cache
+    assert foo.__code__.co_names == names
+
+    with pytest.raises(RegistrationError):
+        foo.register(lambda obj, name: "Alpha y", obj=Alpha, name='y')
+
+    foo.clean()
+    assert foo(Alpha(), 'x') == "default"
+    assert '_counts' in foo.__code__.co_names
+
+
+def test_prefork(monkeypatch):
+    monkeypatch.setitem(prefork.__globals__, '_dispatches', WeakSet())
+
+    @dispatch('obj')
+    def foo(obj):
+        return "default"
+
+    @dispatch('obj')
+    def bar(obj):
+        return "default"
+
+    foo.register(lambda obj: "Alpha", obj=Alpha)
+
+    try:
+        assert prefork([Alpha, Beta]) == 4
+    finally:
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+    assert foo(Alpha()) == "Alpha"
+    assert bar(Alpha()) == "default"
+    with pytest.raises(RegistrationError):
+        bar.register(lambda obj: "Beta", obj=Beta)
+
+
+def test_warm_dispatches():
+    module = ModuleType(str('module'))
+
+    @dispatch('obj', get_key_lookup=DictCachingKeyLookup)
+    def foo(obj):
+        return "default"
+
+    @dispatch('obj', get_key_lookup=DictCachingKeyLookup)
+    def bar(obj):
+        return "default"
+
+    def qux(obj):
+        return "default"
+
+    module.foo = foo
+    module.bar = bar
+    module.qux = qux
+
+    assert warm_dispatches(module, [Alpha, Beta]) == 4
+    assert set(foo.key_lookup.target_cache) == set([(Alpha,), (Beta,)])
+    assert set(bar.key_lookup.target_cache) == set([(Alpha,), (Beta,)])
+
+
+def test_dispatch_shares_code():
+    @dispatch('obj')
+    def foo(obj):
+        return "default"
+
+    @dispatch('obj')
+    def bar(obj):
+        return "default"
+
+    foo.register(lambda obj: "Alpha", obj=Alpha)
+    bar.clean()
+    assert foo.__code__ is bar.__code__
+    assert foo.__globals__ is not bar.__globals__
+    assert foo(Alpha()) == "Alpha"
+    assert bar(Alpha()) == "default"
+
+
+def test_dispatch_traceback_shows_generated_code():
+    @dispatch('obj')
+    def foo(obj):
+        raise ValueError()
+
+    with pytest.raises(ValueError) as excinfo:
+        foo(Alpha())
+    assert '_target_lookup' in ''.join(traceback.format_tb(excinfo.tb))
+
+
+def test_dispatch_plain_key_lookup():
+    class KeyLookup(object):
+        # only the methods key lookups had before target_lookup
+        def __init__(self, registry):
+            self.registry = registry
+
+        def component(self, key):
+            return self.registry.component(key)
+
+        def fallback(self, key):
+            return self.registry.fallback(key)
+
+        def all(self, key):
+            return self.registry.all(key)
+
+    @dispatch('obj', get_key_lookup=KeyLookup, specialize_threshold=2)
+    def foo(obj):
+        return "default"
+
+    foo.register(lambda obj: "Alpha", obj=Alpha)
+    assert foo(Alpha()) == "Alpha"
+    assert foo(Alpha()) == "Alpha"
+    assert foo(Alpha()) == "Alpha"
+    assert foo(None) == "default"
+    assert foo.by_args(Alpha()).component(Alpha()) == "Alpha"
+    assert foo.cache_info() is None
+    foo.warm([(Alpha,)])
+    assert foo(Alpha()) == "Alpha"
+    foo.unregister(obj=Alpha)
+    assert foo(Alpha()) == "default"
+
+
+def test_dispatch_lazy():
+    registries = []
+
+    def get_key_lookup(registry):
+        registries.append(registry)
+        return registry
+
+    @dispatch('obj', get_key_lookup=get_key_lookup)
+    def foo(obj, name='x'):
+        return "default " + name
+
+    @dispatch('obj', get_key_lookup=get_key_lookup)
+    def bar(obj):
+        return "default"
+
+    @dispatch('obj', get_key_lookup=get_key_lookup)
+    def qux(obj):
+        return "default"
+
+    assert registries == []
+    assert foo(Alpha()) == "default x"
+    assert len(registries) == 1
+    assert foo.__defaults__ == ('x',)
+
+    bar.register(lambda obj: "Alpha", obj=Alpha)
+    assert len(registries) == 2
+    assert bar(Alpha()) == "Alpha"
+
+    assert qux.key_lookup.component((Alpha,)) is None
+    assert len(registries) == 3
+    assert qux.key_lookup is registries[-1]
+
+
+def test_dispatch_lazy_signature():
+    registries = []
+
+    def get_key_lookup(registry):
+        registries.append(registry)
+        return registry
+
+    @dispatch('obj', get_key_lookup=get_key_lookup)
+    def foo(obj, name='x'):
+        return "default " + name
+
+    @dispatch('obj')
+    def bar(obj, name='y'):
+        return "bar " + name
+
+    # a lazy dispatch function has the signature of the wrapped one
+    assert arginfo(foo) == arginfo(foo.wrapped_func)
+    assert registries == []
+
+    # so it can be registered as an implementation
+    bar.register(foo, obj=Alpha)
+    assert registries == []
+    assert bar(Alpha()) == "default y"
+    assert bar(Alpha(), name='z') == "default z"
+    assert len(registries) == 1
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="needs Python 3.8")
+def test_dispatch_full_signature():
+    namespace = {}
+    exec(
+        "def foo(obj, /, extra=0, *args, name, request_method='GET', **kw):\n"
+        "    return 'default', obj, extra, args, name, request_method, kw\n"
+        "def alpha(o, /, e=0, *args, name, request_method='GET', **kw):\n"
+        "    return 'Alpha', o, e, args, name, request_method, kw\n",
+        namespace)
+    foo = dispatch('obj', match_key('name'),
+                   match_key('request_method'))(namespace['foo'])
+    foo.register(namespace['alpha'], obj=Alpha, name='x',
+                 request_method='GET')
+
+    # the key is computed inline, also for keyword-only arguments
+    assert '_registry_key' not in foo.__code__.co_names
+    alpha = Alpha()
+    assert foo(alpha, name='x') == ('Alpha', alpha, 0, (), 'x', 'GET', {})
+    assert foo(alpha, 1, 2, name='x', z=3) == (
+        'Alpha', alpha, 1, (2,), 'x', 'GET', {'z': 3})
+    assert foo(alpha, name='x', request_method='POST')[0] == 'default'
+    with pytest.raises(TypeError):
+        foo(obj=alpha, name='x')
+    with pytest.raises(TypeError):
+        foo(alpha, 'x')
+    assert foo.by_args(alpha, 0, name='x', request_method='GET').component is (
+        namespace['alpha'])
+
+    # keyword-only arguments need to have the same name
+    with pytest.raises(RegistrationError):
+        foo.register(lambda o, e=0, *args, **kw: None, obj=Beta)
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="needs Python 3")
+def test_dispatch_kwonlyargs():
+    namespace = {}
+    exec("def foo(obj, *, name='x'):\n"
+         "    return 'default ' + name\n"
+         "def alpha(obj, *, name):\n"
+         "    return 'Alpha ' + name\n", namespace)
+    foo = dispatch('obj')(namespace['foo'])
+    with pytest.raises(AttributeError):
+        foo.register.__self__.unknown
+    foo.register(namespace['alpha'], obj=Alpha)
+    assert foo(Alpha(), name='y') == "Alpha y"
+    assert foo(Beta()) == "default x"
+    with pytest.raises(TypeError):
+        foo(Alpha(), 'y')
+
+
+def test_dispatch_specialize_counts_bounded():
+    @dispatch(match_key('name'), specialize_threshold=3)
+    def foo(name):
+        return "default"
+
+    assert foo(None) == "default"
+    counts = foo.__globals__['_counts']
+    for i in range(MAX_COUNTED_KEYS * 2):
+        assert foo(i) == "default"
+        assert len(counts) <= MAX_COUNTED_KEYS
+    # a hot key is still specialized among many cold ones
+    for i in range(3):
+        assert foo('hot') == "default"
+    assert '_target_0' in foo.__code__.co_names
+
+    # once no more keys can be specialized, nothing is counted
+    for name in ['a', 'b', 'c'] * 3:
+        foo(name)
+    assert '_counts' not in foo.__code__.co_names
+    assert counts == {}
@@ -1,9 +1,13 @@
+import sys
 from types import FunctionType
 import pytest
 from ..context import (
-    dispatch, dispatch_method, methodify, clean_dispatch_methods)
+    dispatch, dispatch_method, methodify, clean_dispatch_methods,
+    freeze_dispatch_methods)
 from ..predicate import match_instance
 from ..error import RegistrationError
+from ..cache import DictCachingKeyLookup
+from ..dispatch import warm_dispatches
 
 
 def test_dispatch_method_explicit_fallback():
@@ -644,6 +648,34 @@ def test_clean_dispatch_methods():
     assert qux.bar(Alpha()) == "Qux Alpha"
 
 
+def test_freeze_dispatch_methods():
+    class Foo(object):
+        @dispatch_method(match_instance('obj'))
+        def bar(self, obj):
+            return "default"
+
+        @dispatch_method(match_instance('obj'))
+        def baz(self, obj):
+            return "default"
+
+    class Alpha(object):
+        pass
+
+    foo = Foo()
+
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+
+    freeze_dispatch_methods(Foo)
+
+    assert foo.bar(Alpha()) == "Alpha"
+    assert foo.baz(Alpha()) == "default"
+
+    with pytest.raises(RegistrationError):
+        Foo.bar.register(lambda self, obj: "Alpha 2", obj=Alpha)
+    with pytest.raises(RegistrationError):
+        Foo.baz.register(lambda self, obj: "Alpha", obj=Alpha)
+
+
 def test_replacing_with_normal_method():
     class Foo(object):
         @dispatch_method('obj')
@@ -796,3 +828,578 @@ def unmethodify(func):
     """
     func = getattr(func, '__func__', func)
     return func.__globals__.get('_func', func)
+
+
+def test_dispatch_method_specialize():
+    class Foo(object):
+        @dispatch_method('obj', specialize_threshold=1)
+        def bar(self, obj):
+            return "default"
+
+    class Alpha(object):
+        pass
+
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+
+    foo = Foo()
+    assert foo.bar(Alpha()) == "Alpha"
+    assert '_target_0' in Foo.bar.__code__.co_names
+    assert foo.bar(Alpha()) == "Alpha"
+    assert foo.bar(None) == "default"
+
+
+def test_dispatch_method_cache_info():
+    class Foo(object):
+        @dispatch_method('obj', get_key_lookup=DictCachingKeyLookup)
+        def bar(self, obj):
+            return "default"
+
+    class Qux(Foo):
+        pass
+
+    Foo().bar(None)
+    Foo().bar(1)
+    Qux().bar(None)
+
+    assert Foo.bar.cache_info().misses == 2
+    assert Qux.bar.cache_info().misses == 1
+
+
+def test_warm_dispatch_methods():
+    class Foo(object):
+        @dispatch_method('obj', get_key_lookup=DictCachingKeyLookup)
+        def bar(self, obj):
+            return "default"
+
+    class Qux(Foo):
+        pass
+
+    class Alpha(object):
+        pass
+
+    assert warm_dispatches(Qux, [Alpha]) == 1
+    assert list(Qux.bar.key_lookup.target_cache) == [(Alpha,)]
+    assert Foo.bar.key_lookup.target_cache == {}
+
+
+def test_dispatch_method_inherit():
+    class Foo(object):
+        @dispatch_method('obj', inherit=True)
+        def bar(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    class SubSub(Sub):
+        pass
+
+    class Alpha(object):
+        pass
+
+    class Beta(object):
+        pass
+
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    assert Sub().bar(Alpha()) == "Alpha"
+    assert SubSub().bar(Alpha()) == "Alpha"
+    assert Sub.bar.key_lookup is Foo.bar.key_lookup
+    assert Sub.bar is not Foo.bar
+
+    # registrations for the base class are shared
+    Foo.bar.register(lambda self, obj: "Beta", obj=Beta)
+    assert Sub().bar(Beta()) == "Beta"
+
+    # until the subclass registers its own
+    Sub.bar.register(lambda self, obj: "Sub Beta", obj=Beta)
+    assert Sub.bar.key_lookup is not Foo.bar.key_lookup
+    assert Sub().bar(Alpha()) == "Alpha"
+    assert Sub().bar(Beta()) == "Sub Beta"
+    assert SubSub().bar(Beta()) == "Sub Beta"
+    assert Foo().bar(Beta()) == "Beta"
+    Foo.bar.unregister(obj=Alpha)
+    assert Foo().bar(Alpha()) == "default"
+    assert Sub().bar(Alpha()) == "Alpha"
+
+    Sub.bar.clean()
+    assert Sub.bar.key_lookup is Foo.bar.key_lookup
+    assert Sub().bar(Beta()) == "Beta"
+    assert SubSub().bar(Beta()) == "Beta"
+
+
+def test_dispatch_method_inherit_follows_base():
+    class Foo(object):
+        @dispatch_method(inherit=True)
+        def bar(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    class Alpha(object):
+        pass
+
+    assert Sub().bar(Alpha()) == "default"
+    Foo.bar.add_predicates([match_instance('obj')])
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    assert Sub().bar(Alpha()) == "Alpha"
+    Foo.bar.clean()
+    assert Sub().bar(Alpha()) == "default"
+
+
+def test_dispatch_method_inherit_specialized_base():
+    class Foo(object):
+        @dispatch_method('obj', inherit=True, specialize_threshold=1,
+                         get_key_lookup=DictCachingKeyLookup)
+        def bar(self, obj):
+            return "default"
+
+    class Alpha(object):
+        pass
+
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    Foo.bar.restore([], [((Alpha,), lambda self, obj: "restored")])
+    assert Foo().bar(Alpha()) == "restored"
+
+    class Sub(Foo):
+        pass
+
+    assert Sub().bar(Alpha()) == "Alpha"
+    assert Sub().bar(Alpha()) == "Alpha"
+
+
+def test_dispatch_method_inherit_frozen():
+    class Foo(object):
+        @dispatch_method('obj', inherit=True)
+        def bar(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    class Alpha(object):
+        pass
+
+    Sub.bar.freeze()
+    with pytest.raises(RegistrationError):
+        Sub.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    assert Sub().bar(Alpha()) == "Alpha"
+
+    Sub.bar.clean()
+    Foo.bar.freeze()
+    with pytest.raises(RegistrationError):
+        Sub.bar.register(lambda self, obj: "Sub", obj=Alpha)
+    assert Sub().bar(Alpha()) == "Alpha"
+
+    Sub.bar.clean()
+    with pytest.raises(RegistrationError):
+        Sub.bar.add_predicates([match_instance('other')])
+
+
+def test_dispatch_method_inherit_multiple_inheritance():
+    class Foo(object):
+        @dispatch_method('obj', inherit=True)
+        def bar(self, obj):
+            return "default"
+
+    class Mixin(object):
+        pass
+
+    class Left(Mixin, Foo):
+        pass
+
+    class Right(Foo):
+        pass
+
+    class Both(Left, Right):
+        pass
+
+    class Alpha(object):
+        pass
+
+    Right.bar.register(lambda self, obj: "Right", obj=Alpha)
+    assert Both().bar(Alpha()) == "default"
+    Left.bar.register(lambda self, obj: "Left", obj=Alpha)
+    assert Both().bar(Alpha()) == "Left"
+
+
+def test_dispatch_method_does_not_inherit():
+    class Foo(object):
+        @dispatch_method('obj')
+        def bar(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    class Alpha(object):
+        pass
+
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    assert Sub().bar(Alpha()) == "default"
+
+
+def test_dispatch_method_inherit_add_predicates():
+    class Foo(object):
+        @dispatch_method('obj', inherit=True)
+        def bar(self, obj, other, more):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    class Alpha(object):
+        pass
+
+    Foo.bar.register(lambda self, obj, other, more: "Alpha", obj=Alpha)
+    Sub.bar.add_predicates([match_instance('other', default=object)],
+                           keep_registrations=True)
+    assert Sub().bar(Alpha(), None, None) == "Alpha"
+    Sub.bar.register(lambda self, obj, other, more: "Sub", obj=Alpha)
+    assert Sub().bar(Alpha(), None, None) == "Sub"
+
+    Sub.bar.add_predicates([match_instance('more', default=object)])
+    Sub.bar.register(lambda self, obj, other, more: "Sub", obj=Alpha)
+
+
+def test_dispatch_method_inherit_other_name():
+    def bar(self, obj):
+        return "default"
+
+    class Foo(object):
+        qux = dispatch_method('obj', inherit=True)(bar)
+
+    class Sub(Foo):
+        pass
+
+    class Alpha(object):
+        pass
+
+    Foo.qux.register(lambda self, obj: "Alpha", obj=Alpha)
+    assert Sub().qux(Alpha()) == "Alpha"
+
+
+def test_dispatch_method_inherit_assigned_later():
+    def bar(self, obj):
+        return "default"
+
+    class Foo(object):
+        pass
+
+    # __set_name__ is not called
+    Foo.qux = dispatch_method('obj', inherit=True)(bar)
+
+    class Sub(Foo):
+        pass
+
+    class Alpha(object):
+        pass
+
+    Foo.qux.register(lambda self, obj: "Alpha", obj=Alpha)
+    assert Sub().qux(Alpha()) == "Alpha"
+
+
+def test_dispatch_method_inherit_unrelated_class():
+    def bar(self, obj):
+        return "default"
+
+    descriptor = dispatch_method('obj', inherit=True)(bar)
+
+    class Foo(object):
+        pass
+
+    class Alpha(object):
+        pass
+
+    # no class in the MRO of Foo has the descriptor
+    method = descriptor.__get__(None, Foo)
+    assert descriptor._dispatch_methods[Foo].base is None
+    method.register(lambda self, obj: "Alpha", obj=Alpha)
+    assert method(None, Alpha()) == "Alpha"
+
+
+def test_dispatch_method_per_class():
+    class Foo(object):
+        @dispatch_method('obj', per_class=True)
+        def bar(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    class SubSub(Sub):
+        pass
+
+    class Alpha(object):
+        pass
+
+    assert isinstance(vars(Foo)['bar'], FunctionType)
+    assert isinstance(vars(Sub)['bar'], FunctionType)
+    assert vars(Sub)['bar'] is not vars(Foo)['bar']
+
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    SubSub.bar.register(lambda self, obj: "SubSub Alpha", obj=Alpha)
+    foo = Foo()
+    assert foo.bar(Alpha()) == "Alpha"
+    assert 'bar' not in vars(foo)
+    assert Sub().bar(Alpha()) == "default"
+    assert SubSub().bar(Alpha()) == "SubSub Alpha"
+
+
+def test_dispatch_method_per_class_slots():
+    invoked = []
+
+    class Foo(object):
+        __slots__ = ()
+
+        @dispatch_method('obj', per_class=True)
+        def bar(self, obj):
+            return "default"
+
+    class Qux(object):
+        __slots__ = ('__weakref__',)
+
+        @dispatch_method('obj', per_class=True,
+                         first_invocation_hook=invoked.append)
+        def bar(self, obj):
+            return "default"
+
+    class Alpha(object):
+        pass
+
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    assert Foo().bar(Alpha()) == "Alpha"
+
+    Qux.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    qux = Qux()
+    assert qux.bar(Alpha()) == "Alpha"
+    assert qux.bar(None) == "default"
+    assert invoked == [qux]
+    other = Qux()
+    other.bar(None)
+    assert invoked == [qux, other]
+
+    # instances are forgotten once they are gone
+    key = id(other)
+    del invoked[:], other
+    assert key not in Qux.bar.__globals__['_invoked']
+
+
+def test_dispatch_method_per_class_slots_no_weakref():
+    invoked = []
+
+    class Foo(object):
+        __slots__ = ()
+
+        @dispatch_method('obj', per_class=True,
+                         first_invocation_hook=invoked.append)
+        def bar(self, obj):
+            return "default"
+
+    with pytest.raises(TypeError) as e:
+        Foo().bar(None)
+    assert '__weakref__' in str(e.value)
+    assert invoked == []
+
+
+def test_dispatch_method_per_class_assigned_later():
+    invoked = []
+
+    def bar(self, obj):
+        return "default"
+
+    class Foo(object):
+        pass
+
+    # __set_name__ is not called, so the descriptor stays
+    Foo.bar = dispatch_method('obj', per_class=True,
+                              first_invocation_hook=invoked.append)(bar)
+    foo = Foo()
+    assert foo.bar(None) == "default"
+    assert foo.bar(None) == "default"
+    assert invoked == [foo]
+
+
+def test_dispatch_method_per_class_override():
+    class Foo(object):
+        @dispatch_method('obj', per_class=True)
+        def bar(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        def bar(self, obj):
+            return "plain"
+
+    class SubSub(Sub):
+        pass
+
+    assert SubSub().bar(None) == "plain"
+    assert 'bar' not in vars(SubSub)
+
+
+def test_dispatch_method_per_class_init_subclass():
+    subclasses = []
+
+    class Base(object):
+        def __init_subclass__(cls, **kw):
+            super(Base, cls).__init_subclass__(**kw)
+            subclasses.append(cls)
+
+    class Foo(Base):
+        def __init_subclass__(cls, flag=None, **kw):
+            super(Foo, cls).__init_subclass__(**kw)
+            cls.flag = flag
+
+        @dispatch_method('obj', per_class=True)
+        def bar(self, obj):
+            return "bar"
+
+        @dispatch_method('obj', per_class=True)
+        def qux(self, obj):
+            return "qux"
+
+    class Sub(Foo, flag=True):
+        pass
+
+    assert subclasses == [Foo, Sub]
+    assert Sub.flag
+    assert isinstance(vars(Sub)['bar'], FunctionType)
+    assert isinstance(vars(Sub)['qux'], FunctionType)
+    assert Sub().bar(None) == "bar"
+    assert Sub().qux(None) == "qux"
+
+
+def test_dispatch_method_per_class_inherit():
+    class Foo(object):
+        @dispatch_method('obj', per_class=True, inherit=True)
+        def bar(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    class Alpha(object):
+        pass
+
+    Foo.bar.register(lambda self, obj: "Alpha", obj=Alpha)
+    assert Sub().bar(Alpha()) == "Alpha"
+
+
+def test_dispatch_method_first_invocation_hook():
+    invoked = []
+
+    class Foo(object):
+        @dispatch_method('obj', first_invocation_hook=invoked.append)
+        def bar(self, obj):
+            return "default"
+
+    foo = Foo()
+    assert foo.bar(None) == "default"
+    assert foo.bar(None) == "default"
+    assert invoked == [foo]
+
+
+def test_dispatch_method_methodified():
+    class Foo(object):
+        @dispatch_method('obj')
+        def bar(self, obj):
+            return "default"
+
+    class Alpha(object):
+        pass
+
+    class Beta(object):
+        pass
+
+    def alpha(obj):
+        return sys._getframe(1).f_code.co_name
+
+    def beta(self, obj):
+        return sys._getframe(1).f_code.co_name
+
+    foo = Foo()
+    code = Foo.bar.__code__
+    Foo.bar.register(methodify(alpha), obj=Alpha)
+    Foo.bar.register(methodify(beta, 'self'), obj=Beta)
+    # looked up targets are called as they are
+    assert Foo.bar.__code__ is code
+    assert foo.bar(Alpha()) == 'wrapper'
+    assert foo.bar(Beta()) == 'call'
+    assert foo.bar(None) == "default"
+    assert Foo.bar.by_args(Alpha()).component.__name__ == 'wrapper'
+
+
+def test_dispatch_method_methodified_lazy_dispatch():
+    class Foo(object):
+        @dispatch_method('obj')
+        def bar(self, obj):
+            return "default"
+
+    class Alpha(object):
+        pass
+
+    @dispatch('obj')
+    def alpha(obj):
+        return "Alpha"
+
+    @dispatch('app', 'obj')
+    def beta(app, obj):
+        return app
+
+    Foo.bar.register(methodify(alpha), obj=Alpha)
+    assert Foo().bar(Alpha()) == "Alpha"
+    assert methodify(beta, 'app') is beta
+    assert beta(1, None) == 1
+
+
+def test_dispatch_method_methodified_specialized():
+    class Foo(object):
+        @dispatch_method('obj', specialize_threshold=1)
+        def bar(self, obj, *args):
+            return "default"
+
+    class Alpha(object):
+        pass
+
+    def alpha(obj, *args):
+        return sys._getframe(1).f_code.co_name, args
+
+    Foo.bar.register_many([(methodify(alpha), {'obj': Alpha})])
+
+    foo = Foo()
+    assert foo.bar(Alpha(), 1) == ('wrapper', (1,))
+    assert '_target_0' in Foo.bar.__code__.co_names
+    # the specialization calls the function made into a method directly
+    assert foo.bar(Alpha(), 2) == ('call', (2,))
+    assert foo.bar(None) == "default"
+
+
+def test_dispatch_method_methodified_inherit():
+    class Foo(object):
+        @dispatch_method('obj', inherit=True, specialize_threshold=1)
+        def bar(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    class Alpha(object):
+        pass
+
+    class Beta(object):
+        pass
+
+    def alpha(obj):
+        return sys._getframe(1).f_code.co_name
+
+    assert Sub().bar(Alpha()) == "default"
+    Foo.bar.register(methodify(alpha), obj=Alpha)
+    assert Sub().bar(Alpha()) == 'wrapper'
+    assert Sub().bar(Alpha()) == 'call'
+
+    # copied registrations are still called without the wrapper
+    Sub.bar.register(lambda self, obj: "Beta", obj=Beta)
+    assert Sub().bar(Alpha()) == 'wrapper'
+    assert Sub().bar(Alpha()) == 'call'
+    assert Sub().bar(Beta()) == "Beta"
@@ -0,0 +1,150 @@
+import pytest
+from repoze.lru import LRUCache
+from ..eviction import SegmentedLRUCache, TwoQueueCache, TinyLFUCache
+
+
+def use(cache, key):
+    """Look up a key, adding it if it is missing."""
+    value = cache.get(key)
+    if value is None:
+        cache.put(key, key.upper())
+
+
+def scan(cache):
+    """Look up a few hot keys during a scan of keys used only once.
+
+    :returns: the number of hits for the hot keys during the scan.
+    """
+    hot = ['hot%s' % i for i in range(5)]
+    for i in range(3):
+        for key in hot:
+            use(cache, key)
+    hits = 0
+    for i in range(100):
+        use(cache, 'scan%s' % i)
+        if i % 10 == 9:
+            for key in hot:
+                hits += cache.get(key) is not None
+                use(cache, key)
+    return hits
+
+
+@pytest.mark.parametrize('cache_class', [
+    SegmentedLRUCache, TwoQueueCache, TinyLFUCache])
+def test_cache(cache_class):
+    cache = cache_class(2)
+    assert cache.get('a') is None
+    assert cache.get('a', 'default') == 'default'
+    cache.put('a', 'A')
+    assert cache.get('a') == 'A'
+    cache.put('a', 'AA')
+    assert cache.get('a') == 'AA'
+    cache.put('b', None)
+    assert cache.get('b', 'default') is None
+    assert (cache.hits, cache.misses, cache.lookups) == (3, 2, 5)
+
+    cache.invalidate('a')
+    cache.invalidate('c')
+    assert cache.get('a') is None
+    assert sorted(cache.data) == ['b']
+
+    cache.clear()
+    assert cache.data == {}
+    assert (cache.hits, cache.misses, cache.lookups) == (0, 0, 0)
+
+
+@pytest.mark.parametrize('cache_class', [
+    SegmentedLRUCache, TwoQueueCache, TinyLFUCache])
+def test_cache_size(cache_class):
+    with pytest.raises(ValueError):
+        cache_class(0)
+    cache = cache_class(1)
+    for key in 'abcabc':
+        use(cache, key)
+    assert len(cache.data) == 1
+
+
+@pytest.mark.parametrize('cache_class', [
+    SegmentedLRUCache, TwoQueueCache, TinyLFUCache])
+def test_cache_scan_resistance(cache_class):
+    cache = cache_class(10)
+    assert scan(cache) > 40
+    assert len(cache.data) <= 10
+    assert cache.evictions > 0
+
+
+def test_lru_cache_is_not_scan_resistant():
+    assert scan(LRUCache(10)) == 0
+
+
+def test_segmented_lru_cache_demotes():
+    cache = SegmentedLRUCache(4, protected_ratio=0.5)
+    for key in 'abcaba':
+        use(cache, key)
+    assert list(cache.protected) == ['b', 'a']
+    assert list(cache.probation) == ['c']
+    use(cache, 'c')
+    assert list(cache.protected) == ['a', 'c']
+    assert list(cache.probation) == ['b']
+    cache.invalidate('a')
+    assert list(cache.protected) == ['c']
+
+
+def test_two_queue_cache_ghosts():
+    cache = TwoQueueCache(4, in_ratio=0.5, out_ratio=0.5)
+    for key in 'abcde':
+        use(cache, key)
+    assert list(cache.ghosts) == ['a']
+    use(cache, 'f')
+    assert list(cache.ghosts) == ['a', 'b']
+    use(cache, 'g')
+    assert list(cache.ghosts) == ['b', 'c']
+    use(cache, 'b')
+    assert list(cache.frequent) == ['b']
+    assert 'b' not in cache.ghosts
+    use(cache, 'b')
+    assert sorted(cache.data) == ['b', 'e', 'f', 'g']
+
+
+def test_two_queue_cache_evicts_frequent():
+    cache = TwoQueueCache(2, in_ratio=0.5, out_ratio=1)
+    for key in 'abca':
+        use(cache, key)
+    assert list(cache.frequent) == ['a']
+    assert list(cache.recent) == ['c']
+    use(cache, 'b')
+    assert list(cache.frequent) == ['b']
+    assert list(cache.recent) == ['c']
+    assert cache.ghosts == {}
+
+
+def test_tiny_lfu_cache_admission():
+    cache = TinyLFUCache(2)
+    for key in 'aab':
+        use(cache, key)
+    # c has not been looked up as often as a, the least recently used
+    use(cache, 'c')
+    use(cache, 'c')
+    assert sorted(cache.data) == ['a', 'b']
+    use(cache, 'c')
+    assert sorted(cache.data) == ['b', 'c']
+    assert cache.evictions == 1
+
+
+def test_tiny_lfu_cache_ages():
+    cache = TinyLFUCache(1)
+    for i in range(9):
+        cache.get('a')
+    assert cache._frequency('a') == 9
+    cache.get('b')
+    assert cache._frequency('a') == 4
+    assert cache.samples == 5
+
+
+def test_tiny_lfu_cache_mixes_hash():
+    cache = TinyLFUCache(2 ** 14 + 1)
+    assert cache.mix
+    for i in range(3):
+        cache.get('a')
+    assert cache._frequency('a') == 3
+    assert len(set(cache._indexes('a'))) == 4
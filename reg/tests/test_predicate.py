@@ -1,5 +1,6 @@
+import gc
 from ..predicate import (KeyIndex, ClassIndex, PredicateRegistry,
-                         match_instance, match_key)
+                         match_instance, match_key, match_class)
 from ..error import RegistrationError
 import pytest
 
@@ -383,3 +384,395 @@ def test_nameless_predicate_key():
     p = match_key('a')
 
     assert p.key_by_predicate_name({}) is None
+
+
+def test_predicate_key_source():
+    assert match_instance('obj').key_source() == 'obj.__class__'
+    assert match_key('name').key_source() == 'name'
+    assert match_class('cls').key_source() == 'cls'
+
+
+def test_predicate_key_source_custom_func():
+    assert match_instance('obj', lambda obj: obj).key_source() is None
+    assert match_key('name', lambda obj: obj).key_source() is None
+    assert match_class('cls', lambda obj: obj).key_source() is None
+
+
+def test_registry_all_in_registration_order():
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    m = PredicateRegistry(match_instance('a'), match_key('b'))
+    m.register((Foo, 'x'), 'foo x')
+    m.register((FooSub, 'x'), 'foosub x')
+    m.register((object, 'x'), 'object x')
+
+    assert list(m.all((FooSub, 'x'))) == ['foosub x', 'foo x', 'object x']
+    assert m.get((FooSub, 'x')) == 2
+    assert list(m.values_of(m.get((Foo, 'x')))) == ['foo x']
+
+
+def test_registry_switches_to_sets():
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    m = PredicateRegistry(match_instance('a', fallback='a fallback'),
+                          match_key('b', fallback='b fallback'))
+    m.max_bitmask_values = 2
+    m.register((Foo, 'x'), 'foo x')
+    m.register((Foo, 'y'), 'foo y')
+    m.register((object, 'y'), 'foo y')
+    assert m.values == ['foo x', 'foo y']
+    m.register((FooSub, 'x'), 'foosub x')
+    assert m.values is None
+    m.register((object, 'z'), 'object z')
+
+    assert m.get((Foo, 'x')) == set(['foo x'])
+    assert m.component((FooSub, 'x')) == 'foosub x'
+    assert m.component((FooSub, 'y')) == 'foo y'
+    assert list(m.all((FooSub, 'x'))) == ['foosub x', 'foo x']
+    assert m.fallback((FooSub, 'q')) == 'b fallback'
+    assert m.fallback((Foo, 'z')) == 'b fallback'
+    assert m.fallback((Foo, 'y')) is None
+
+
+def test_key_index_registered_permutations():
+    i = KeyIndex()
+    assert i.registered_permutations('GET') == ()
+    i.add('GET', 1)
+    assert i.registered_permutations('GET') == ('GET',)
+    assert i['POST'] == 0
+
+
+def test_class_index_registered_permutations():
+    class Foo(object):
+        pass
+
+    class Bar(Foo):
+        pass
+
+    class Qux(Bar):
+        pass
+
+    i = ClassIndex()
+    assert i.registered_permutations(Qux) == ()
+    i.add(Foo, 1)
+    assert i.registered_permutations(Qux) == (Foo,)
+    # cached
+    assert i.registered_permutations(Qux) is i.registered_permutations(Qux)
+    i.add(Foo, 2)
+    assert i[Foo] == 3
+    assert i.registered_permutations(Qux) == (Foo,)
+    # adding a new class invalidates the cache
+    i.add(Bar, 4)
+    assert i.registered_permutations(Qux) == (Bar, Foo)
+    i.add(object, 8)
+    assert i.registered_permutations(Qux) == (Bar, Foo, object)
+    assert list(i.permutations(Qux)) == [Qux, Bar, Foo, object]
+
+
+def test_class_index_registered_permutations_do_not_keep_classes():
+    i = ClassIndex()
+    i.add(object, 1)
+
+    class Foo(object):
+        pass
+
+    assert i.registered_permutations(Foo) == (object,)
+    assert len(i._registered_mro) == 1
+    del Foo
+    gc.collect()
+    assert len(i._registered_mro) == 0
+
+
+def test_registry_all_prunes_in_product_order():
+    class A(object):
+        pass
+
+    class B(A):
+        pass
+
+    class C(B):
+        pass
+
+    m = PredicateRegistry(match_instance('a'), match_instance('b'),
+                          match_key('c'))
+    keys = [(A, object, 'x'), (B, A, 'x'), (object, C, 'x'),
+            (C, object, 'y'), (B, B, 'y'), (object, object, 'x'),
+            (A, C, 'y')]
+    for i, key in enumerate(keys):
+        m.register(key, i)
+
+    def brute_force(key):
+        return [value for p in m.permutations(key)
+                for value in m.values_of(m.get(p))]
+
+    for key in [(C, C, 'x'), (C, C, 'y'), (B, A, 'x'), (A, A, 'z')]:
+        assert list(m.all(key)) == brute_force(key)
+    assert list(m.all((C, C, 'x'))) == [1, 0, 2, 5]
+
+
+def test_registry_all_no_predicates():
+    m = PredicateRegistry()
+    m.register((), 'value')
+    assert list(m.all(())) == ['value']
+
+
+def test_registry_freeze():
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    m = PredicateRegistry(match_instance('a'), match_key('b', fallback='b'))
+    m.register((Foo, 'x'), 'foo x')
+    m.register((FooSub, 'x'), 'foosub x')
+    m.freeze()
+
+    assert m.known_keys == {(Foo, 'x'): 'foo x', (FooSub, 'x'): 'foosub x'}
+    with pytest.raises(TypeError):
+        m.known_keys[(object, 'x')] = 'object x'
+    assert m.values == ('foo x', 'foosub x')
+    assert m.component((FooSub, 'x')) == 'foosub x'
+    assert list(m.all((FooSub, 'x'))) == ['foosub x', 'foo x']
+    assert m.fallback((FooSub, 'y')) == 'b'
+
+    with pytest.raises(RegistrationError):
+        m.register((object, 'x'), 'object x')
+    assert m.component((object, 'x')) is None
+
+
+def test_registry_freeze_exact_key():
+    class Foo(object):
+        pass
+
+    m = PredicateRegistry(match_instance('a'), match_key('b'))
+    m.register((Foo, 'x'), 'foo x')
+    m.freeze()
+
+    # an exact key is found without going through the indexes
+    m.indexes = None
+    assert m.component((Foo, 'x')) == 'foo x'
+    assert m.resolve((Foo, 'x')) == ('foo x', None)
+    assert m.target((Foo, 'x')) == 'foo x'
+
+
+def test_registry_freeze_sets():
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    m = PredicateRegistry(match_instance('a'), match_key('b'))
+    m.max_bitmask_values = 1
+    m.register((Foo, 'x'), 'foo x')
+    m.register((FooSub, 'x'), 'foosub x')
+    m.freeze()
+
+    assert m.get((Foo, 'x')) == frozenset(['foo x'])
+    assert isinstance(m.indexes[0][FooSub], frozenset)
+    assert m.component((FooSub, 'x')) == 'foosub x'
+    assert list(m.all((FooSub, 'x'))) == ['foosub x', 'foo x']
+
+    with pytest.raises(RegistrationError):
+        m.register((object, 'x'), 'object x')
+
+
+def test_key_index_remove():
+    i = KeyIndex()
+    i.add('GET', 3)
+    i.remove('GET', 1)
+    assert i['GET'] == 2
+    i.remove('GET', 2)
+    assert 'GET' not in i
+    i.add('GET', set(['a', 'b']))
+    i.remove('GET', set(['a']))
+    assert i['GET'] == set(['b'])
+
+
+def test_class_index_remove():
+    class Foo(object):
+        pass
+
+    class Bar(Foo):
+        pass
+
+    i = ClassIndex()
+    i.add(Foo, 1)
+    i.add(Bar, 1)
+    assert i.registered_permutations(Bar) == (Bar, Foo)
+    i.remove(Bar, 1)
+    assert i.registered_permutations(Bar) == (Foo,)
+
+
+def test_registry_unregister():
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    m = PredicateRegistry(match_instance('a'), match_key('b'))
+    m.register((Foo, 'x'), 'foo')
+    m.register((FooSub, 'y'), 'foo')
+    m.register((FooSub, 'x'), 'foosub x')
+
+    assert m.unregister((FooSub, 'x')) == 'foosub x'
+    assert m.component((FooSub, 'x')) == 'foo'
+    assert FooSub in m.indexes[0]
+    assert m.values == ['foo', None]
+
+    assert m.unregister((Foo, 'x')) == 'foo'
+    assert m.component((FooSub, 'x')) is None
+    assert m.component((FooSub, 'y')) == 'foo'
+    assert Foo not in m.indexes[0]
+    assert 'x' not in m.indexes[1]
+
+    with pytest.raises(RegistrationError):
+        m.unregister((Foo, 'x'))
+    m.freeze()
+    with pytest.raises(RegistrationError):
+        m.unregister((FooSub, 'y'))
+
+
+def test_registry_unregister_sets():
+    m = PredicateRegistry(match_key('a'))
+    m.max_bitmask_values = 1
+    m.register(('x',), 'x')
+    m.register(('y',), 'y')
+    assert m.values is None
+
+    m.unregister(('x',))
+    assert list(m.all(('x',))) == []
+    assert m.known_values == set(['y'])
+
+
+def test_registry_renumbers_unregistered_values():
+    m = PredicateRegistry(match_key('a'))
+    m.max_bitmask_values = 2
+    m.register(('x',), 'x')
+    m.register(('y',), 'y')
+    m.unregister(('x',))
+    m.register(('z',), 'z')
+
+    assert m.values == ['y', 'z']
+    assert m.get(('y',)) == 1
+    assert m.known_values == 3
+    assert m.component(('z',)) == 'z'
+
+    m.register(('x',), 'x')
+    assert m.values is None
+    assert m.known_values == set(['x', 'y', 'z'])
+
+
+def test_registry_subscribe():
+    changes = []
+    m = PredicateRegistry(match_key('a'))
+    m.subscribe(changes.append)
+    m.register(('x',), 'x')
+    m.unregister(('x',))
+    assert changes == [('x',), ('x',)]
+
+
+def test_registry_register_many():
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    items = [
+        ((Foo, 'x'), 'foo x'),
+        ((FooSub, 'x'), 'foosub x'),
+        ((object, 'x'), 'foo x'),
+        ((FooSub, 'y'), 'foo y'),
+    ]
+    one_by_one = PredicateRegistry(match_instance('a'), match_key('b'))
+    one_by_one.register((Foo, 'y'), 'foo y')
+    for key, value in items:
+        one_by_one.register(key, value)
+
+    changes = []
+    m = PredicateRegistry(match_instance('a'), match_key('b'))
+    m.subscribe(changes.append)
+    m.register((Foo, 'y'), 'foo y')
+    m.register_many(items)
+
+    assert m.values == one_by_one.values == ['foo y', 'foo x', 'foosub x']
+    assert m.known_values == 7
+    for index, other in zip(m.indexes, one_by_one.indexes):
+        assert index == other
+    assert list(m.all((FooSub, 'x'))) == ['foosub x', 'foo x', 'foo x']
+    assert m.component((object, 'x')) == 'foo x'
+    assert changes == [(Foo, 'y'), (Foo, 'x'), (FooSub, 'x'),
+                       (object, 'x'), (FooSub, 'y')]
+
+
+def test_registry_register_many_duplicates():
+    m = PredicateRegistry(match_key('a'))
+    m.register(('x',), 'x')
+    with pytest.raises(RegistrationError) as e:
+        m.register_many([(('y',), 'y'), (('x',), 'x'), (('y',), 'z')])
+    assert str(e.value) == (
+        "Already have registrations for keys: ('x',), ('y',)")
+    with pytest.raises(RegistrationError):
+        m.register_many([(('z',), 'z'), (('x',), 'x')])
+    assert list(m.known_keys) == [('x',)]
+    assert m.values == ['x']
+
+    m.freeze()
+    with pytest.raises(RegistrationError):
+        m.register_many([(('y',), 'y')])
+
+
+def test_registry_register_many_scales():
+    comparisons = []
+
+    class Value(object):
+        def __eq__(self, other):
+            comparisons.append(other)
+            return self is other
+
+        def __ne__(self, other):
+            return not self == other
+
+        __hash__ = object.__hash__
+
+    values = [Value() for i in range(1000)]
+    m = PredicateRegistry(match_key('a'))
+    m.max_bitmask_values = len(values)
+    m.register_many(((i,), value) for i, value in enumerate(values))
+    assert m.values == values
+    # finding the new values doesn't compare each to all the others
+    assert len(comparisons) < len(values)
+
+
+def test_registry_register_many_switches_to_sets():
+    m = PredicateRegistry(match_key('a'), match_key('b'))
+    m.max_bitmask_values = 2
+    m.register(('x', 'x'), 'x')
+    m.register_many([(('y', 'x'), 'y'), (('z', 'x'), 'z')])
+    assert m.values is None
+    assert m.get((None, 'x')) == set()
+    assert m.known_values == set(['x', 'y', 'z'])
+    assert set(m.all(('y', 'x'))) == set(['y'])
+    m.register_many([(('y', 'y'), 'y'), (('z', 'y'), 'y')])
+    assert list(m.all(('z', 'y'))) == ['y']
+
+
+def test_registry_register_many_renumbers():
+    m = PredicateRegistry(match_key('a'))
+    m.max_bitmask_values = 3
+    m.register_many([(('x',), 'x'), (('y',), 'y'), (('z',), 'z')])
+    m.unregister(('x',))
+    m.register_many([(('w',), 'w')])
+    assert m.values == ['y', 'z', 'w']
+    assert m.component(('w',)) == 'w'
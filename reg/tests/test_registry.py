@@ -1,6 +1,11 @@
 from __future__ import unicode_literals
+import gc
 from ..predicate import PredicateRegistry, match_instance, match_key
-from ..cache import DictCachingKeyLookup, LruCachingKeyLookup
+from ..cache import (
+    DictCachingKeyLookup, LruCachingKeyLookup, WeakCachingKeyLookup,
+    WeakCache, WeakKey, CacheInfo, SharedCache)
+from ..eviction import SegmentedLRUCache, TwoQueueCache, TinyLFUCache
+from repoze.lru import LRUCache
 from ..error import RegistrationError
 from ..dispatch import dispatch
 import pytest
@@ -13,6 +18,14 @@ def register_value(generic, key, value):
     generic.register.__self__.registry.register(key, value)
 
 
+def cached_keys(cache):
+    """The keys in a cache of a caching key lookup."""
+    if isinstance(cache, dict):
+        return set(tuple(item() if isinstance(item, WeakKey) else item
+                         for item in key) for key in cache)
+    return set(args[0] for args in cache.data)
+
+
 def test_registry():
     class Foo(object):
         pass
@@ -245,14 +258,14 @@ def test_dict_caching_registry():
         model=Foo, name='', request_method='GET').key == (Foo, '', 'GET')
 
     # use a bit of inside knowledge to check the cache is filled
-    assert view.key_lookup.component.__self__.get(
-        (Foo, '', 'GET')) is not None
-    assert view.key_lookup.component.__self__.get(
-        (FooSub, '', 'GET')) is not None
-    assert view.key_lookup.component.__self__.get(
-        (FooSub, 'edit', 'POST')) is not None
-
-    # now let's do this again. this time things come from the component cache
+    target_cache = view.__globals__['_target_lookup'].__self__
+    assert target_cache.get((Foo, '', 'GET')) is foo_default
+    assert target_cache.get((FooSub, '', 'GET')) is foo_default
+    assert target_cache.get((FooSub, 'edit', 'POST')) is foo_edit
+    # the component cache is only filled by introspection
+    assert view.key_lookup.component.__self__.get((Foo, '', 'GET')) is None
+
+    # now let's do this again. this time things come from the target cache
     assert view(Foo(), Request('', 'GET')) == 'foo default'
     assert view(FooSub(), Request('', 'GET')) == 'foo default'
     assert view(FooSub(), Request('edit', 'POST')) == 'foo edit'
@@ -272,9 +285,12 @@ def test_dict_caching_registry():
     assert view(FooSub(), Request('dummy', 'GET')) == 'Name fallback'
 
     # fallbacks get cached too
+    assert target_cache.get((Bar, '', 'GET')) is model_fallback
+    assert key_lookup.fallback.__self__.get((Bar, '', 'GET')) is None
+    assert view.by_args(Bar(), Request('', 'GET')).fallback is model_fallback
     assert key_lookup.fallback.__self__.get((Bar, '', 'GET')) is model_fallback
 
-    # these come from the fallback cache now
+    # these come from the target cache now
     assert view(Bar(), Request('', 'GET')) == 'Model fallback'
     assert view(Foo(), Request('dummy', 'GET')) == 'Name fallback'
     assert view(Foo(), Request('', 'PUT')) == 'Request method fallback'
@@ -345,12 +361,16 @@ def test_lru_caching_registry():
         model=Foo, name='', request_method='GET').key == (Foo, '', 'GET')
 
     # use a bit of inside knowledge to check the cache is filled
+    target_cache = view.__globals__['_target_lookup'].__closure__[
+        0].cell_contents
+    assert target_cache.get(((Foo, '', 'GET'),)) is foo_default
+    assert target_cache.get(((FooSub, '', 'GET'),)) is foo_default
+    assert target_cache.get(((FooSub, 'edit', 'POST'),)) is foo_edit
+    # the component cache is only filled by introspection
     component_cache = view.key_lookup.component.__closure__[0].cell_contents
-    assert component_cache.get(((Foo, '', 'GET'),)) is not None
-    assert component_cache.get(((FooSub, '', 'GET'),)) is not None
-    assert component_cache.get(((FooSub, 'edit', 'POST'),)) is not None
+    assert component_cache.get(((Foo, '', 'GET'),)) is None
 
-    # now let's do this again. this time things come from the component cache
+    # now let's do this again. this time things come from the target cache
     assert view(Foo(), Request('', 'GET')) == 'foo default'
     assert view(FooSub(), Request('', 'GET')) == 'foo default'
     assert view(FooSub(), Request('edit', 'POST')) == 'foo edit'
@@ -370,11 +390,454 @@ def test_lru_caching_registry():
     assert view(FooSub(), Request('dummy', 'GET')) == 'Name fallback'
 
     # fallbacks get cached too
+    assert target_cache.get(((Bar, '', 'GET'),)) is model_fallback
     fallback_cache = view.key_lookup.fallback.__closure__[0].cell_contents
+    assert fallback_cache.get(((Bar, '', 'GET'),)) is None
+    assert view.by_args(Bar(), Request('', 'GET')).fallback is model_fallback
     assert fallback_cache.get(((Bar, '', 'GET'),)) is model_fallback
 
-    # these come from the fallback cache now
+    # these come from the target cache now
     assert view(Bar(), Request('', 'GET')) == 'Model fallback'
     assert view(Foo(), Request('dummy', 'GET')) == 'Name fallback'
     assert view(Foo(), Request('', 'PUT')) == 'Request method fallback'
     assert view(FooSub(), Request('dummy', 'GET')) == 'Name fallback'
+
+
+def test_predicate_registry_target():
+    reg = PredicateRegistry(match_instance('obj', fallback='fallback'))
+
+    class Document(object):
+        pass
+
+    reg.register((Document,), 'document')
+
+    assert reg.target((Document,), 'default') == 'document'
+    assert reg.target((object,), 'default') == 'fallback'
+    assert reg.target_lookup('default')((Document,)) == 'document'
+
+
+def test_predicate_registry_target_default():
+    reg = PredicateRegistry(match_instance('obj'))
+
+    assert reg.target((object,), 'default') == 'default'
+    assert reg.target((object,)) is None
+
+
+def test_predicate_registry_exact_match_skips_permutations():
+    reg = PredicateRegistry(match_instance('obj'), match_key('name'))
+
+    class Document(object):
+        pass
+
+    class SpecialDocument(Document):
+        pass
+
+    reg.register((Document, 'x'), 'document x')
+
+    def all(keys):
+        raise AssertionError("Should not search permutations")
+
+    reg.all = all
+    assert reg.component((Document, 'x')) == 'document x'
+
+    with pytest.raises(AssertionError):
+        reg.component((SpecialDocument, 'x'))
+
+
+def test_predicate_registry_resolve():
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    reg = PredicateRegistry(match_instance('a', fallback='a fallback'),
+                            match_key('b', fallback='b fallback'))
+    reg.register((FooSub, 'x'), 'foosub x')
+    reg.register((Foo, 'y'), 'foo y')
+    reg.register((Foo, 'z'), 'foo z')
+
+    keys = [(FooSub, 'x'), (FooSub, 'y'), (Foo, 'x'), (object, 'x'),
+            (FooSub, 'q'), (Foo, 'z')]
+    for key in keys:
+        assert reg.resolve(key) == (reg.component(key), reg.fallback(key))
+    # found through Foo, but fallback stops at FooSub
+    assert reg.resolve((FooSub, 'y')) == ('foo y', 'b fallback')
+
+
+def test_predicate_registry_resolve_no_predicates():
+    reg = PredicateRegistry()
+    assert reg.resolve(()) == (None, None)
+    reg.register((), 'value')
+    assert reg.resolve(()) == ('value', None)
+
+
+@pytest.mark.parametrize('get_caching_key_lookup', [
+    DictCachingKeyLookup,
+    WeakCachingKeyLookup,
+    lambda r: LruCachingKeyLookup(r, 100, 100, 100),
+])
+def test_caching_registry_fills_component_and_fallback(
+        get_caching_key_lookup):
+    class Foo(object):
+        pass
+
+    key_lookup = get_caching_key_lookup(
+        PredicateRegistry(match_instance('a', fallback='a fallback')))
+    key_lookup.key_lookup.register((Foo,), 'foo')
+
+    calls = []
+    resolve = key_lookup.key_lookup.resolve
+
+    def counting_resolve(key):
+        calls.append(key)
+        return resolve(key)
+
+    key_lookup.key_lookup.resolve = counting_resolve
+
+    assert key_lookup.component((Foo,)) == 'foo'
+    assert key_lookup.fallback((Foo,)) is None
+    assert key_lookup.fallback((object,)) == 'a fallback'
+    assert key_lookup.component((object,)) is None
+    assert calls == [(Foo,), (object,)]
+
+
+def test_predicate_registry_is_affected():
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    reg = PredicateRegistry(match_instance('a'), match_key('b'))
+    assert reg.is_affected((FooSub, 'x'), (FooSub, 'x'))
+    assert reg.is_affected((FooSub, 'x'), (Foo, 'x'))
+    # the fallback for (FooSub, 'y') depends on Foo being registered
+    assert reg.is_affected((FooSub, 'y'), (Foo, 'x'))
+    assert reg.is_affected((int, 'x'), (Foo, 'x'))
+    assert not reg.is_affected((Foo, 'x'), (FooSub, 'y'))
+    assert not reg.is_affected((int, 'y'), (Foo, 'x'))
+    assert PredicateRegistry().is_affected((), ())
+
+
+@pytest.mark.parametrize('get_caching_key_lookup', [
+    DictCachingKeyLookup,
+    WeakCachingKeyLookup,
+    lambda r: LruCachingKeyLookup(r, 100, 100, 100),
+    lambda r: LruCachingKeyLookup(r, 100, 100, 100,
+                                  cache_class=SegmentedLRUCache),
+    lambda r: LruCachingKeyLookup(r, 100, 100, 100,
+                                  cache_class=TwoQueueCache),
+    lambda r: LruCachingKeyLookup(r, 100, 100, 100,
+                                  cache_class=TinyLFUCache),
+    lambda r: SharedCache(100).key_lookup(r),
+])
+def test_caching_registry_invalidation(get_caching_key_lookup):
+    class Foo(object):
+        pass
+
+    class FooSub(Foo):
+        pass
+
+    class Bar(object):
+        pass
+
+    @dispatch(match_instance('obj', fallback=lambda obj: 'fallback'),
+              get_key_lookup=get_caching_key_lookup)
+    def view(obj):
+        return 'default'
+
+    key_lookup = view.key_lookup
+    view.register(lambda obj: 'foo', obj=Foo)
+    view.register(lambda obj: 'bar', obj=Bar)
+
+    assert view(FooSub()) == 'foo'
+    assert view(Bar()) == 'bar'
+    assert view(1) == 'fallback'
+    assert view.by_predicates(obj=FooSub).all_matches == [
+        view.by_predicates(obj=Foo).component]
+
+    targets = key_lookup.caches[-1]
+    assert cached_keys(targets) == set([(FooSub,), (Bar,), (int,)])
+
+    view.register(lambda obj: 'foosub', obj=FooSub)
+
+    assert view(FooSub()) == 'foosub'
+    assert view(Foo()) == 'foo'
+    assert view.by_predicates(obj=FooSub).component(FooSub()) == 'foosub'
+    assert len(view.by_predicates(obj=FooSub).all_matches) == 2
+    assert cached_keys(targets) == set([(FooSub,), (Foo,), (Bar,), (int,)])
+
+    assert view.unregister(obj=FooSub)(None) == 'foosub'
+    assert view(FooSub()) == 'foo'
+    assert len(view.by_predicates(obj=FooSub).all_matches) == 1
+
+    view.register(lambda obj: 'object', obj=object)
+
+    assert view(FooSub()) == 'foo'
+    assert view(1) == 'object'
+
+
+def test_weak_caching_registry():
+    class Foo(object):
+        pass
+
+    @dispatch(match_instance('obj'), match_key('name'),
+              get_key_lookup=WeakCachingKeyLookup)
+    def view(obj, name):
+        return 'default'
+
+    view.register(lambda obj, name: 'foo', obj=Foo, name='x')
+    key_lookup = view.key_lookup
+
+    assert view(Foo(), 'x') == 'foo'
+    assert view(Foo(), None) == 'default'
+    assert len(key_lookup) == 2
+
+    # keep the classes alive until we collect them
+    classes = []
+    for i in range(10):
+        FooSub = type(str('FooSub'), (Foo,), {})
+        classes.append(FooSub)
+        assert view(FooSub(), 'x') == 'foo'
+        assert view.by_predicates(obj=FooSub, name='x').component == (
+            view.by_predicates(obj=Foo, name='x').component)
+        assert len(view.by_predicates(obj=FooSub, name='x').all_matches) == 1
+    # the component and fallback caches are filled for Foo too
+    assert len(key_lookup) == 4 + 10 * 4
+
+    del FooSub, classes
+    gc.collect()
+    assert len(key_lookup) == 4
+    assert all(len(cache) == len(cache.weak_keys) for cache in
+               key_lookup.caches)
+
+    view.register(lambda obj, name: 'no name', obj=Foo, name=None)
+    assert view(Foo(), 'x') == 'foo'
+    assert view(Foo(), None) == 'no name'
+
+
+def test_weak_cache_collect_during_prune():
+    class Foo(object):
+        pass
+
+    cache = WeakCache(lambda key: key[0].__name__)
+    assert cache[(Foo, 'x')] == 'Foo'
+    assert cache[(Foo, 'x')] == 'Foo'
+    assert (Foo, 'x') in cache
+    assert (Foo, 'y') not in cache
+    assert len(cache) == 1
+    weak_key, = cache
+    assert weak_key[0] == Foo
+    assert not weak_key[0] != Foo
+
+    def condition(key):
+        # the class dies while we prune
+        del locals_['Foo']
+        gc.collect()
+        return True
+
+    locals_ = {'Foo': Foo}
+    del Foo
+    cache.prune(condition)
+    assert len(cache) == 0
+    assert cache.weak_keys == {}
+
+
+@pytest.mark.parametrize('get_caching_key_lookup', [
+    lambda r: DictCachingKeyLookup(r, count_hits=True),
+    lambda r: WeakCachingKeyLookup(r, count_hits=True),
+    lambda r: LruCachingKeyLookup(r, 100, 100, 100),
+    lambda r: SharedCache(100).key_lookup(r),
+])
+def test_caching_registry_cache_info(get_caching_key_lookup):
+    class Foo(object):
+        pass
+
+    @dispatch(match_instance('obj'), get_key_lookup=get_caching_key_lookup)
+    def view(obj):
+        return 'default'
+
+    view.register(lambda obj: 'foo', obj=Foo)
+    assert view.cache_info() == CacheInfo(0, 0, 0, 0, 0.0)
+
+    view(Foo())
+    view(Foo())
+    view(Foo())
+    view(None)
+
+    info = view.cache_info()
+    assert info.hits == 2
+    assert info.misses == 2
+    assert info.size == 2
+    assert info.evictions == 0
+    assert info.miss_time > 0.0
+
+    view.by_predicates(obj=Foo).component
+    view.by_predicates(obj=Foo).fallback
+    view.by_predicates(obj=Foo).all_matches
+    assert view.key_lookup.cache_info('component')[:4] == (0, 1, 1, 0)
+    assert view.key_lookup.cache_info('fallback')[:4] == (1, 0, 1, 0)
+    assert view.key_lookup.cache_info('all')[:4] == (0, 1, 1, 0)
+
+
+def test_dict_caching_registry_cache_info_no_hits():
+    @dispatch('obj', get_key_lookup=DictCachingKeyLookup)
+    def view(obj):
+        return 'default'
+
+    view(None)
+    view(None)
+    assert view.cache_info()[:4] == (None, 1, 1, 0)
+
+
+def test_lru_caching_registry_cache_info_evictions():
+    @dispatch('obj',
+              get_key_lookup=lambda r: LruCachingKeyLookup(r, 1, 1, 1))
+    def view(obj):
+        return 'default'
+
+    view(None)
+    view(1)
+    assert view.cache_info()[:4] == (0, 2, 1, 1)
+
+
+def test_weak_caching_registry_cache_info_evictions():
+    @dispatch('obj', get_key_lookup=WeakCachingKeyLookup)
+    def view(obj):
+        return 'default'
+
+    view(type(str('Foo'), (object,), {})())
+    gc.collect()
+    assert view.cache_info()[:4] == (None, 1, 0, 1)
+
+
+def test_registry_cache_info_no_cache():
+    @dispatch('obj')
+    def view(obj):
+        return 'default'
+
+    assert view.cache_info() is None
+
+
+def test_lru_caching_registry_hot_cache():
+    class Foo(object):
+        pass
+
+    @dispatch(match_instance('obj'),
+              get_key_lookup=lambda r: LruCachingKeyLookup(
+                  r, 2, 2, 2, hot_size=1))
+    def view(obj):
+        return 'default'
+
+    key_lookup = view.key_lookup
+    hot = key_lookup.hot_caches[key_lookup.target_cache]
+    view.register(lambda obj: 'foo', obj=Foo)
+
+    assert view(Foo()) == 'foo'
+    assert view.cache_info()[:4] == (None, 1, 1, 0)
+    assert view(Foo()) == 'foo'
+    # moved to the hot cache
+    assert list(hot) == [(Foo,)]
+    assert view.cache_info()[:4] == (None, 1, 1, 0)
+    assert view(Foo()) == 'foo'
+    assert view(None) == 'default'
+    assert view(None) == 'default'
+    # the hot cache is full
+    assert list(hot) == [(Foo,)]
+    assert view.cache_info()[:4] == (None, 2, 2, 0)
+
+    view.register(lambda obj: 'object', obj=object)
+    assert hot == {}
+    assert view(Foo()) == 'foo'
+    assert view(None) == 'object'
+    assert view.by_predicates(obj=Foo).component(None) == 'foo'
+    assert view.by_predicates(obj=Foo).component(None) == 'foo'
+    assert view.key_lookup.cache_info('component')[:4] == (None, 1, 1, 0)
+
+
+def test_shared_cache():
+    shared_cache = SharedCache(4, cache_class=LRUCache)
+
+    @dispatch('obj', get_key_lookup=shared_cache.key_lookup)
+    def foo(obj):
+        return 'foo'
+
+    @dispatch('obj', get_key_lookup=shared_cache.key_lookup)
+    def bar(obj):
+        return 'bar'
+
+    # bar is only set up once it is used
+    assert shared_cache.occupancy() == {}
+    assert foo(1) == 'foo'
+    assert foo(None) == 'foo'
+    assert shared_cache.occupancy() == {foo.key_lookup: 2}
+    assert bar.cache_info()[:2] == (0, 0)
+    assert shared_cache.occupancy() == {foo.key_lookup: 2, bar.key_lookup: 0}
+
+    assert bar(1) == 'bar'
+    assert bar(None) == 'bar'
+    assert bar('') == 'bar'
+    # foo(1) was evicted
+    assert shared_cache.occupancy() == {foo.key_lookup: 1, bar.key_lookup: 3}
+    assert len(foo.key_lookup) == 1
+    assert foo.cache_info()[:4] == (0, 2, 1, 1)
+
+    assert foo.by_predicates(obj=int).component is None
+    assert len(foo.key_lookup) == 2
+    assert len(shared_cache.cache.data) == 4
+
+    # the entries of the old key lookup are dropped with it
+    bar.clean()
+    gc.collect()
+    assert shared_cache.occupancy()[bar.key_lookup] == 0
+    assert len(shared_cache.cache.data) == len(foo.key_lookup)
+    assert bar(1) == 'bar'
+    assert shared_cache.occupancy()[bar.key_lookup] == 1
+
+
+def test_shared_cache_partition_keys():
+    shared_cache = SharedCache(100)
+
+    @dispatch('obj', get_key_lookup=shared_cache.key_lookup)
+    def foo(obj):
+        return 'foo'
+
+    @dispatch('obj', get_key_lookup=shared_cache.key_lookup)
+    def bar(obj):
+        return 'bar'
+
+    for value in [1, None, '', 1.0, [], ()]:
+        assert foo(value) == 'foo'
+    assert bar(1) == 'bar'
+    partition = bar.key_lookup.target_cache
+    assert partition.keys == set([((int,),)])
+
+    class Data(dict):
+        def __iter__(self):
+            raise AssertionError("the whole shared cache is scanned")
+
+        def items(self):
+            raise AssertionError("the whole shared cache is scanned")
+
+    shared_cache.cache.data = Data(shared_cache.cache.data)
+    bar.register(lambda obj: 'int', obj=int)
+    assert partition.keys == set()
+    assert len(bar.key_lookup) == 0
+    assert len(foo.key_lookup) == 6
+    assert bar(1) == 'int'
+
+
+def test_shared_cache_partition_prune():
+    shared_cache = SharedCache(2, cache_class=LRUCache)
+
+    @dispatch('obj', get_key_lookup=shared_cache.key_lookup)
+    def foo(obj):
+        return 'foo'
+
+    partition = foo.key_lookup.target_cache
+    for value in [1, None, '', 1.0, [], ()]:
+        assert foo(value) == 'foo'
+    assert len(partition.keys) <= 4
+    assert len(partition.data) == 2
+    assert partition.keys == set([((list,),), ((tuple,),)])
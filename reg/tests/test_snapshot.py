@@ -0,0 +1,194 @@
+from __future__ import unicode_literals
+import sys
+import pytest
+from ..error import RegistrationError
+from ..context import dispatch_method
+from ..snapshot import write_snapshot, load_snapshot, fingerprint
+from .fixtures import app
+from .fixtures.app import App, Document, Image, Model, render
+
+
+@pytest.fixture
+def snapshot_dir(tmpdir, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmpdir))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+    app.clean()
+    yield tmpdir
+    app.clean()
+    for path in tmpdir.listdir('*.py'):
+        sys.modules.pop(path.purebasename, None)
+
+
+def write_app_snapshot(tmpdir, name='app_snapshot'):
+    app.register()
+    write_snapshot(
+        str(tmpdir.join(name + '.py')),
+        ['reg.tests.fixtures.app.render',
+         'reg.tests.fixtures.app.App.view'],
+        classes=[Document, Image])
+    app.clean()
+
+
+def test_snapshot(snapshot_dir):
+    write_app_snapshot(snapshot_dir)
+    source = snapshot_dir.join('app_snapshot.py').read()
+    assert 'from reg.tests.fixtures.app import render as _0' in source
+    assert 'MODULES = [\n    {0!r},\n]'.format(
+        'reg.tests.fixtures.app') in source
+
+    assert load_snapshot('app_snapshot')
+    assert render(Document(), 'html') == "document"
+    assert render(Image(), 'json') == "json"
+    assert render(Image(), 'html') == "default"
+    assert render(Model(), 'json') == "json"
+    assert App().view(Document()) == "document view"
+    assert App().view(Image()) == "default"
+    assert render.by_args(Document(), 'html').component is (
+        app.render_document)
+
+    # the snapshot is replaced by the key lookup once registrations
+    # change
+    render.register(app.render_document, obj=Image, format='html')
+    assert render(Image(), 'html') == "document"
+    assert render(Document(), 'json') == "json"
+
+
+def test_snapshot_table(snapshot_dir):
+    app.register()
+    registrations, targets = render.snapshot(classes=[Document])
+    assert sorted(registrations, key=repr) == [
+        ((Document, 'html'), app.render_document),
+        ((Model, 'json'), app.render_json)]
+    assert sorted(targets, key=repr) == [
+        ((Document, 'html'), app.render_document),
+        ((Document, 'json'), app.render_json)]
+
+    render.freeze()
+    with pytest.raises(RegistrationError):
+        render.snapshot()
+
+
+def test_restore_replaces_table(snapshot_dir):
+    render.restore([], [((Document, 'html'), app.render_json)])
+    assert render(Document(), 'html') == "json"
+    render.restore([], [((Image, 'html'), app.render_json)])
+    assert render(Document(), 'html') == "default"
+    assert render(Image(), 'html') == "json"
+
+
+def test_restore_registered(snapshot_dir):
+    render.register(app.render_json, obj=Model, format='json')
+    with pytest.raises(RegistrationError):
+        render.restore([((Document, 'html'), app.render_document),
+                        ((Model, 'json'), app.render_json)], [])
+    # nothing was restored
+    assert render(Document(), 'html') == "default"
+    assert render(Document(), 'json') == "json"
+
+
+def test_load_snapshot_registered(snapshot_dir):
+    write_app_snapshot(snapshot_dir)
+    App.view.register(app.document_view, obj=Document)
+    with pytest.raises(RegistrationError):
+        load_snapshot('app_snapshot')
+    # render comes first in the snapshot, and was not restored either
+    assert render(Document(), 'html') == "default"
+
+
+def test_load_snapshot_frozen(snapshot_dir):
+    write_app_snapshot(snapshot_dir)
+    App.view.freeze()
+    with pytest.raises(RegistrationError):
+        load_snapshot('app_snapshot')
+    assert render(Document(), 'html') == "default"
+
+
+def test_restore_frozen_dispatch_method():
+    class Foo(object):
+        @dispatch_method('obj', inherit=True)
+        def view(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    # the dispatch method of Sub shares the registry of Foo
+    Sub.view.freeze()
+    with pytest.raises(RegistrationError):
+        Sub.view.restore([((Document,), app.document_view)], [])
+    assert Sub().view(Document()) == "default"
+    assert Foo().view(Document()) == "default"
+
+
+def test_restore_shared_dispatch_method():
+    class Foo(object):
+        @dispatch_method('obj', inherit=True)
+        def view(self, obj):
+            return "default"
+
+    class Sub(Foo):
+        pass
+
+    Foo.view.register(lambda self, obj: "Foo", obj=Document)
+    assert Sub().view(Document()) == "Foo"
+    # restored registrations override those shared with Foo
+    Sub.view.restore([((Document,), app.document_view)],
+                     [((Document,), app.document_view)])
+    assert Sub().view(Document()) == "document view"
+    assert Foo().view(Document()) == "Foo"
+
+
+def test_load_snapshot_missing(snapshot_dir):
+    assert not load_snapshot('no_such_snapshot')
+
+
+def test_load_snapshot_stale(snapshot_dir):
+    write_app_snapshot(snapshot_dir)
+    snapshot = snapshot_dir.join('app_snapshot.py')
+    snapshot.write(snapshot.read().replace(
+        "FINGERPRINT = ", "FINGERPRINT = 'stale' + "))
+    assert not load_snapshot('app_snapshot')
+    assert render(Document(), 'html') == "default"
+
+
+def test_load_snapshot_renamed(snapshot_dir):
+    write_app_snapshot(snapshot_dir)
+    snapshot = snapshot_dir.join('app_snapshot.py')
+    snapshot.write(snapshot.read().replace(
+        "import render_json", "import render_xml"))
+    assert not load_snapshot('app_snapshot')
+
+
+def test_load_snapshot_version(snapshot_dir):
+    snapshot_dir.join('old_snapshot.py').write('VERSION = 0\n')
+    assert not load_snapshot('old_snapshot')
+
+
+def test_write_snapshot_not_dispatch(snapshot_dir):
+    with pytest.raises(ValueError):
+        write_snapshot(str(snapshot_dir.join('s.py')),
+                       ['reg.tests.fixtures.app.render_json'])
+
+
+def test_write_snapshot_unnamed(snapshot_dir):
+    render.register(lambda obj, format: "lambda", obj=Model, format='xml')
+    with pytest.raises(ValueError):
+        write_snapshot(str(snapshot_dir.join('s.py')),
+                       ['reg.tests.fixtures.app.render'])
+
+
+def test_write_snapshot_unknown_value(snapshot_dir):
+    render.register(app.render_json, obj=Model, format=object())
+    with pytest.raises(ValueError):
+        write_snapshot(str(snapshot_dir.join('s.py')),
+                       ['reg.tests.fixtures.app.render'])
+
+
+def test_fingerprint(tmpdir, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmpdir))
+    module = tmpdir.join('fingerprinted.py')
+    module.write('x = 1\n')
+    before = fingerprint(['fingerprinted', 'sys'])
+    assert fingerprint(['fingerprinted', 'sys']) == before
+    module.write('x = 10\n')
+    assert fingerprint(['fingerprinted', 'sys']) != before